@@ -1,20 +1,29 @@
+import io
 import json
 import traceback
 import sys
-import urllib.parse
-from threading import Lock
+import os
 import time
+import urllib.parse
 from PIL import Image
 from PIL import ImageDraw
 
 import retengine
 from retengine.models import param_sets
-from retengine.managers import query_key_cache
+from retengine.engine import backend_client
+from retengine.managers import query_key_cache, query_manager
+from retengine.managers.base_caches import max_size_cache
+from retengine import query_translations
 from retengine import interface
 from meta import metadata_handler
-from utils import cp_work_pools, pagination, imuptools
+from utils import cp_work_pools, pagination, imuptools, thumbnail_cache
 from visorgen import settings
 
+# maximum number of seconds of each wait for a query in wait_for_query
+WAIT_FOR_QUERY_STEP = 10
+# maximum number of regions of interest of results kept in memory
+ROI_CACHE_SIZE = 20000
+
 class VisorController:
     """ Base class for the VISOR frontend controller """
 
@@ -35,17 +44,34 @@ class VisorController:
 
         self.opts = param_sets.VisorOptions(**cfg_visor)
 
+        # limit the number of simultaneous connections to each backend
+        backend_client.set_pool_max_size(self.proc_opts.backend_pool_size)
+
         # initialize pools
         self.process_pool = cp_work_pools.CpProcessPool(self.proc_opts.pool_workers)
         self.process_pool.start()
         # NOTE: so far, there's no need to stop() or terminate() as the
         #       threads (not processes, see comments on CpProcessPool)
         #       are killed when the server is shutdown or restarted
-        self.query_available_lock = Lock()
 
         # initialize query cache for storing ongoing query definition dicts
         # by query session id
-        self.query_key_cache = query_key_cache.QueryKeyCache()
+        query_key_cache_path = None
+        if self.proc_opts.shared_cache_dir:
+            query_key_cache_path = os.path.join(self.proc_opts.shared_cache_dir, 'query_keys')
+        self.query_key_cache = query_key_cache.QueryKeyCache(shared_path=query_key_cache_path)
+
+        # initialize cache of the regions of interest of the results of the queries,
+        # keyed by (query hash, path of the result)
+        self.roi_cache = max_size_cache.MaxSizeCache(entry_limit=ROI_CACHE_SIZE)
+
+        # initialize the on-disk cache of rendered thumbnails and regions, if enabled
+        self.image_serving_opts = getattr(settings, 'IMAGE_SERVING', {})
+        self.thumbnail_cache = None
+        if self.image_serving_opts.get('thumbnail_cache_dir'):
+            self.thumbnail_cache = thumbnail_cache.ThumbnailCache(self.image_serving_opts['thumbnail_cache_dir'],
+                                                                  self.image_serving_opts.get('thumbnail_cache_max_bytes',
+                                                                                              512*1024*1024))
 
         # initialize class for metadata extraction
         self.metadata_handler = metadata_handler.MetaDataHandler(self.opts.datasets,
@@ -190,132 +216,198 @@ class VisorController:
             Returns: an image
         """
         try:
-            img = Image.open(path)
-            scale = 1
-            if as_thumbnail:
+            return self._render_image(path, roi, as_thumbnail, just_ROI)
+        except IOError:
+            print ('Exception while reading ' + path)
+            img = Image.new('RGBA', (1, 1), (255, 0, 0, 0))
+            return img
+
+
+    def _render_image(self, path, roi=None, as_thumbnail=False, just_ROI=False):
+        """
+            Opens an image and applies to it the transformations requested
+            to get_image. See get_image for the description of the arguments.
+            Returns: an image
+            Raises: IOError if the image cannot be read.
+        """
+        img = Image.open(path)
+        scale = 1
+        if as_thumbnail:
+
+            im_w, im_h = img.size
+            max_w = 200
+            max_h = 200
+            max_w = float(max_w)
+            max_h = float(max_h)
+
+            if max_w == None and max_h == None:
+                scale = 1
+            else:
+                if max_w == None:
+                    scale = max_h/im_h
+                elif max_h == None:
+                    scale = max_w/im_w
+                else:
+                    scale = min(max_h/im_h, max_w/im_h)
+
+            if scale < 1:
+                img.thumbnail((int(im_w*scale), int(im_h*scale)))
+            else:
+                scale = 1
+
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+        if roi:
+
+            values = [float(val)*scale for val in roi['roi'].split('_')]
+            points = []
+            for i in range(1, len(values), 2):
+                points.append((values[i-1], values[i]))
 
+            if just_ROI:
+
+                img = img.crop((
+                    int(min(values[0], values[2], values[4], values[6], values[8])),
+                    int(min(values[1], values[3], values[5], values[7], values[9])),
+                    int(max(values[0], values[2], values[4], values[6], values[8])),
+                    int(max(values[1], values[3], values[5], values[7], values[9]))
+                    ))
                 im_w, im_h = img.size
-                max_w = 200
-                max_h = 200
+                max_w = 100
+                max_h = 100
                 max_w = float(max_w)
                 max_h = float(max_h)
+                scale = min(max_h/im_h, max_w/im_h)
+                size = int(im_w*scale), int(im_h*scale)
+                img = img.resize(size)
+
+            else:
 
-                if max_w == None and max_h == None:
-                    scale = 1
+                if 'roi_colour' in roi:
+                    red, green, blue = [int(x) for x in  roi['roi_colour'].split('_')]
                 else:
-                    if max_w == None:
-                        scale = max_h/im_h
-                    elif max_h == None:
-                        scale = max_w/im_w
-                    else:
-                        scale = min(max_h/im_h, max_w/im_h)
-
-                if scale < 1:
-                    img.thumbnail((int(im_w*scale), int(im_h*scale)))
+                    red, green, blue = 255, 255, 0
+                linecol = (red, green, blue)
+
+                if 'roi_linewidth' in roi:
+                    linewidth = int(roi['roi_linewidth'])
                 else:
-                    scale = 1
+                    linewidth = 5
 
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
 
-            if roi:
-
-                values = [float(val)*scale for val in roi['roi'].split('_')]
-                points = []
-                for i in range(1, len(values), 2):
-                    points.append((values[i-1], values[i]))
-
-                if just_ROI:
-
-                    img = img.crop((
-                        int(min(values[0], values[2], values[4], values[6], values[8])),
-                        int(min(values[1], values[3], values[5], values[7], values[9])),
-                        int(max(values[0], values[2], values[4], values[6], values[8])),
-                        int(max(values[1], values[3], values[5], values[7], values[9]))
-                        ))
-                    im_w, im_h = img.size
-                    max_w = 100
-                    max_h = 100
-                    max_w = float(max_w)
-                    max_h = float(max_h)
-                    scale = min(max_h/im_h, max_w/im_h)
-                    size = int(im_w*scale), int(im_h*scale)
-                    img = img.resize(size)
-
-                else:
+                imd = ImageDraw.Draw(img)
+                for i in range(0, len(points)-1):
+                    imd.line((points[i][0], points[i][1], points[i+1][0], points[i+1][1]), fill=linecol, width=linewidth)
 
-                    if 'roi_colour' in roi:
-                        red, green, blue = [int(x) for x in  roi['roi_colour'].split('_')]
-                    else:
-                        red, green, blue = 255, 255, 0
-                    linecol = (red, green, blue)
+        return img
 
-                    if 'roi_linewidth' in roi:
-                        linewidth = int(roi['roi_linewidth'])
-                    else:
-                        linewidth = 5
 
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
+    def get_image_validators(self, path, roi=None, as_thumbnail=False, just_ROI=False):
+        """
+            Returns the HTTP validators of an image from the server, without reading it.
+            See get_image for the description of the arguments.
+            Returns: a tuple with a strong ETag, derived from the modification time and
+                     size of the file and the rendering parameters, and the modification
+                     time of the file (seconds since the epoch). Both are 'None' if the
+                     file does not exist.
+        """
+        render_key = thumbnail_cache.get_render_key(path, roi=roi, as_thumbnail=as_thumbnail, just_ROI=just_ROI)
+        if not render_key:
+            return (None, None)
+        try:
+            last_modified = int(os.path.getmtime(path))
+        except OSError:
+            return (None, None)
+        return ('"%s"' % render_key, last_modified)
 
-                    imd = ImageDraw.Draw(img)
-                    for i in range(0, len(points)-1):
-                        imd.line((points[i][0], points[i][1], points[i+1][0], points[i+1][1]), fill=linecol, width=linewidth)
 
-            return img
+    def get_encoded_image(self, path, roi=None, as_thumbnail=False, just_ROI=False):
+        """
+            Returns the encoded data of an image from the server. Thumbnails, regions
+            and images with a ROI drawn on them are kept in the on-disk cache of
+            thumbnails, if enabled, so that they are only decoded and rendered once.
+            See get_image for the description of the arguments.
+            Returns: a tuple with the bytes of the image and a boolean which is False
+                     if the image could not be read, in which case the bytes are those
+                     of a 1x1 transparent placeholder, which must not be cached.
+        """
+        cache_key = None
+        if self.thumbnail_cache and (as_thumbnail or roi):
+            cache_key = self.thumbnail_cache.get_key(path, roi=roi, as_thumbnail=as_thumbnail, just_ROI=just_ROI)
+            if cache_key:
+                data = self.thumbnail_cache.get(cache_key)
+                if data is not None:
+                    return (data, True)
 
+        try:
+            img = self._render_image(path, roi, as_thumbnail, just_ROI)
         except IOError:
-
             print ('Exception while reading ' + path)
             img = Image.new('RGBA', (1, 1), (255, 0, 0, 0))
-            return img
+            buffer = io.BytesIO()
+            # JPEG cannot hold the transparency of the placeholder
+            img.save(buffer, 'PNG')
+            return (buffer.getvalue(), False)
 
+        buffer = io.BytesIO()
+        img.save(buffer, img.format if img.format else 'JPEG')
+        data = buffer.getvalue()
+        if cache_key:
+            self.thumbnail_cache.put(cache_key, data)
+        return (data, True)
 
-    def check_query_in_cache_no_locking(self, query, user_session_id):
+
+    def get_rois(self, query, engine, frame_paths):
         """
-            Checks whether a query is cached or not. No locking between threads is done.
+            Gets the regions of interest of several results of a query from the
+            backend of an engine. The ROIs of all the results are requested at once,
+            and kept in memory for the next time they are needed.
             Arguments:
-                query: dictionary from of the query being checked
-                user_session_id: User session id
-            Returns: boolean indicating whether a query is cached or not.
+                query: dictionary from of the query
+                engine: engine used to execute the query
+                frame_paths: list of paths of results of the query
+            Returns: A dictionary with the ROI of the paths that have one, either
+                     as a string or as a list of coordinates.
         """
-        rlist = self.interface.result_cache[query['engine']].get_results(query, query_ses_id=None, user_ses_id=user_session_id)
-
-        return bool(rlist)
+        qhash = query_translations.get_qhash(query)
+        rois = {}
+        missing_paths = []
+        for path in frame_paths:
+            roi = self.roi_cache.get_data((qhash, path))
+            if roi is None:
+                missing_paths.append(path)
+            elif len(roi) > 0:
+                rois[path] = roi
+
+        backend_port = self.opts.engines_dict[engine]['backend_port']
+        if missing_paths and backend_port:
+            ses = backend_client.Session(backend_port)
+            backend_rois = ses.get_rois(missing_paths, query['qdef'])
+            for (path, roi) in backend_rois.items():
+                # results without ROI are cached too, to avoid asking again
+                if not roi:
+                    roi = ''
+                self.roi_cache.add_data(roi, (qhash, path))
+                if len(roi) > 0:
+                    rois[path] = roi
+
+        return rois
 
 
-    def check_query_in_cache_with_locking(self, query, user_session_id):
+    def check_query_in_cache_no_locking(self, query, user_session_id):
         """
-            Checks whether a query is cached or not.
-            If another thread arrives to this method while a previous thread is running the
-            same query, the arriving thread will wait until the query is finished to return
-            the output of this method.
+            Checks whether a query is cached or not. No locking between threads is done.
             Arguments:
                 query: dictionary from of the query being checked
                 user_session_id: User session id
-            Returns: boolean indicating whether a query is cached or not
+            Returns: boolean indicating whether a query is cached or not.
         """
-        try:
-            # lock
-            self.query_available_lock.acquire()
-            # check if it in the cache
-            rlist = self.interface.result_cache[query['engine']].get_results(query, query_ses_id=None, user_ses_id=user_session_id)
-            if rlist == None:
-                # if not cached, check the status to verify that is not being executed by another thread
-                status = self.interface.query_manager.get_query_status_from_definition(query)
-                while status != None and status.state <= retengine.models.opts.States.results_ready:
-                    # if it is begin executed, wait a bit and then query the status again ...
-                    time.sleep(1)
-                    status = self.interface.query_manager.get_query_status_from_definition(query)
-                    if status != None and status.state == retengine.models.opts.States.results_ready:
-                        # if ready, get the results and leave the loop
-                        rlist = self.interface.result_cache[query['engine']].get_results(query, query_ses_id=None, user_ses_id=user_session_id)
-            return bool(rlist)
-        finally:
-            # unlock
-            self.query_available_lock.release()
+        rlist = self.interface.result_cache[query['engine']].get_results(query, query_ses_id=None, user_ses_id=user_session_id)
 
-        return False
+        return bool(rlist)
 
 
     def create_query_session(self, query, user_session_id):
@@ -396,7 +488,23 @@ class VisorController:
                                               return_rlist_directly=return_rlist_directly,
                                               query_ses_id=qsid,
                                               user_ses_id=user_session_id)
-        else:
+
+        if qid is not None and query_data.status.state == retengine.models.opts.States.cancelled:
+            # the query was shared with another query session, which cancelled it,
+            # but this session still wants the results, so run it again
+            print ('RESTARTING CANCELLED QUERY WITH QID: ' + str(qid))
+            qid = None
+
+        if qid is not None and query is not None and \
+           query_data.status.state == retengine.models.opts.States.invalid_qid:
+            # the backend qid is unknown to this process, e.g. because it was read from
+            # a query key cache shared with other workers, or because the query worker
+            # was already released. Fall back to the query definition, which picks up
+            # cached results or an identical query in progress in this process
+            print ('QID %s NOT FOUND, FALLING BACK TO THE QUERY DEFINITION' % str(qid))
+            qid = None
+
+        if qid is None:
             # ELSE if no backend qid is associated with the current query session as yet
             # start a new query and then add the backend qid to the session data
             # for future calls to execquery
@@ -412,6 +520,89 @@ class VisorController:
         return query_data
 
 
+    def execquery_wait_impl(self, qsid, user_session_id, progress_key, timeout):
+        """
+            Long-polling variant of execquery_impl. If the status of the query is still
+            the one known by the caller, it waits until it changes before returning it,
+            so that the caller does not need to ask for the status repeatedly.
+            Arguments:
+                qsid: query id
+                user_session_id: user session id
+                progress_key: key of the last status known by the caller, as returned
+                              by retengine.managers.query_manager.get_progress_key
+                timeout: maximum number of seconds to wait for the status to change
+            Returns: An instance of the QueryData class.
+        """
+        query_data = self.execquery_impl(qsid, user_session_id)
+        status = query_data.status
+        if (status.qid is not None and
+                query_manager.get_progress_key(status.__dict__) == progress_key):
+            try:
+                self.interface.query_manager.wait_for_query_status_change(status.qid,
+                                                                          progress_key,
+                                                                          timeout)
+            except retengine.models.errors.QueryIdError:
+                # the worker is gone, let execquery_impl report it
+                pass
+            query_data = self.execquery_impl(qsid, user_session_id)
+
+        return query_data
+
+
+    def wait_for_query(self, qsid, user_session_id, timeout=None):
+        """
+            Starts the query of a query session, if needed, and waits until it is
+            done, without the need to call execquery_impl repeatedly. The waiting
+            is done on the worker of the query, so it ends as soon as the query
+            finishes. The results are not collected, as in execquery_impl.
+            Arguments:
+                qsid: query session id
+                user_session_id: user session id
+                timeout: maximum number of seconds to wait, or None to wait until
+                         the query is done.
+            Returns: An instance of the QueryData class, with the last status of the query.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        query_data = self.execquery_impl(qsid, user_session_id)
+        while (query_data.status.state < retengine.models.opts.States.results_ready and
+               query_data.status.qid is not None):
+            # wait in steps, so that the query is not taken as abandoned
+            # (see QueryManager.reap_workers)
+            wait_time = WAIT_FOR_QUERY_STEP
+            if deadline is not None:
+                wait_time = min(wait_time, deadline - time.time())
+                if wait_time <= 0:
+                    break
+            try:
+                self.interface.query_manager.wait_for_query_finished(query_data.status.qid,
+                                                                     wait_time)
+            except retengine.models.errors.QueryIdError:
+                # the worker is gone, let execquery_impl report it
+                pass
+            query_data = self.execquery_impl(qsid, user_session_id)
+
+        return query_data
+
+
+    def cancel_query(self, qsid):
+        """
+            Cancels the query associated to a query session, if it is still
+            running or its results have not been collected yet.
+            Arguments:
+                qsid: query session id
+            Returns: A QueryStatus instance with the status of the query when it
+                     was cancelled, or 'None' if no query was started for the session.
+        """
+        (query, qid) = self.query_key_cache.get_query_details_and_qid(qsid)
+        if qid is None:
+            return None
+
+        print ('CANCELLING QUERY WITH QID: ' + str(qid))
+        return self.interface.cancel_query(qid)
+
+
     def uploadimage(self, file=None, url=None, img_data=None, is_data_base64=False):
         """
             Helper method to upload an image to the server, must likely be request of
@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 
 import socket
+import select
+import time
 import simplejson as json
 import urllib.parse
+from threading import Lock, Condition
+from multiprocessing.dummy import Pool
 
 TCP_TERMINATOR = "$$$"
 SUCCESS_FIELD = "success"
 TCP_TIMEOUT = 86400.00
+TCP_RECV_SIZE = 65536
+POOL_MAX_SIZE = 8
+POOL_MAX_IDLE_TIME = 300.0
+# seconds to wait for a pooled connection before opening an extra one
+POOL_ACQUIRE_TIMEOUT = 10.0
+TRS_BATCH_SIZE = 50
+ROI_BATCH_SIZE = 100
+# seconds during which a backend that does not support 'getRoiLists' is not asked again
+ROI_LISTS_RETRY_INTERVAL = 600.0
 
 class Session(object):
     """
@@ -29,7 +42,6 @@ class Session(object):
         self.port = port
         self.host = host
         self.verbose = verbose
-        self.leftovers = ''
 
 
     def prepare_success_json_str_(self, success):
@@ -49,6 +61,9 @@ class Session(object):
         """
             Sends a request to the host and port specified in the creation
             of the class.
+            The request is sent over a connection borrowed from the pool
+            associated to the host and port, which is returned to the pool
+            once the response has been read.
             Arguments:
                 request: JSON object to be sent
                 append_end: Boolean to indicate whether or not to append
@@ -56,51 +71,60 @@ class Session(object):
             Returns:
                 JSON containing the response from the host
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            sock.connect((self.host, self.port))
-        except socket.error as msg:
-            print ('Connect failed', msg)
-            return self.prepare_success_json_str_(False)
-
-        sock.settimeout(TCP_TIMEOUT)
-
         print ('Request to VISOR backend at port %s: %s' % (str(self.port), request))
 
         if append_end:
             request += TCP_TERMINATOR
 
-        total_sent = 0
-        while total_sent < len(request):
-            sent = sock.send(request[total_sent:].encode())
-            if sent == 0:
-                raise RuntimeError("Socket connection broken at port " + str(self.port))
-            total_sent = total_sent + sent
+        pool = get_connection_pool(self.port, self.host)
+        try:
+            conn = pool.acquire()
+        except socket.error as msg:
+            print ('Connect failed', msg)
+            return self.prepare_success_json_str_(False)
 
-        term_idx = -1
-        response = self.leftovers
-        while term_idx < 0:
+        while True:
             try:
-                rep_chunk = sock.recv(1024)
-                rep_chunk = rep_chunk.decode()
-                if not rep_chunk:
-                    print ('Connection closed! at port ' + str(self.port))
-                    sock.close()
-                    return self.prepare_success_json_str_(False)
-
-                response = response + rep_chunk
-                term_idx = response.find(TCP_TERMINATOR)
+                conn.send(request)
+                break
             except socket.timeout:
                 print ('Socket timeout at port ' + str(self.port))
-                sock.close()
+                pool.discard(conn)
+                return self.prepare_success_json_str_(False)
+            except socket.error as msg:
+                if not conn.reused:
+                    print ('Socket error at port ' + str(self.port), msg)
+                    pool.discard(conn)
+                    return self.prepare_success_json_str_(False)
+            # the backend might have dropped an idle connection, so try
+            # once more with a brand-new one. This is only done when the
+            # request could not be sent: once it has been sent, the backend
+            # might have executed it, and requests like 'addTrs' or 'train'
+            # must not be repeated
+            pool.discard(conn)
+            try:
+                conn = pool.acquire(reuse=False)
+            except socket.error as msg:
+                print ('Connect failed', msg)
                 return self.prepare_success_json_str_(False)
 
-        excess_sz = term_idx + len(TCP_TERMINATOR)
-        self.leftovers = response[excess_sz:]
+        try:
+            response = conn.receive()
+        except socket.timeout:
+            print ('Socket timeout at port ' + str(self.port))
+            pool.discard(conn)
+            return self.prepare_success_json_str_(False)
+        except socket.error as msg:
+            print ('Socket error at port ' + str(self.port), msg)
+            pool.discard(conn)
+            return self.prepare_success_json_str_(False)
 
-        response = response[0:term_idx]
+        if response is None:
+            print ('Connection closed! at port ' + str(self.port))
+            pool.discard(conn)
+            return self.prepare_success_json_str_(False)
 
-        sock.close()
+        pool.release(conn)
         return response
 
 
@@ -234,7 +258,7 @@ class Session(object):
         else:
             func_in["func"] = "addNegTrs"
         func_in["query_id"] = query_id
-        func_in["impath"] = urllib.unquote(urllib.unquote(impath)) # decode possibly url-encoded image names
+        func_in["impath"] = urllib.parse.unquote(urllib.parse.unquote(impath)) # decode possibly url-encoded image names
         func_in["featpath"] = featpath
         func_in["from_dataset"] = (1 if from_dataset else 0)
 
@@ -248,6 +272,108 @@ class Session(object):
         return func_out[SUCCESS_FIELD]
 
 
+    def add_trs_batch(self, query_id, items):
+        """
+            Instructs the backend to add a batch of positive and/or negative
+            training images to a query, using as few requests as possible.
+            It calls 'addTrsBatch' in the backend, sending up to TRS_BATCH_SIZE
+            images per request. If the backend does not support 'addTrsBatch',
+            it falls back to one 'addPosTrs'/'addNegTrs' call per image for
+            the remaining images.
+            The backend should return the results in JSON format with
+            at least the field: 'results', a list of booleans in the same
+            order as the images in the request.
+            Arguments:
+                query_id: id of the query.
+                items: List of dictionaries, each with the fields:
+                       'impath': Full path to the training image.
+                       'featpath': Full path to the feature file.
+                       'anno': 1 for a positive image, -1 for a negative one.
+                               Any other value is ignored.
+                       'from_dataset': Boolean indicating whether the training
+                                       image is part of the dataset or not.
+                       'extra_params': (optional) Dictionary containing any other
+                                       parameter that can be useful to the backend.
+            Returns:
+               A list of booleans with the success of each item, in the
+               same order as 'items'.
+        """
+        # images which are neither positive nor negative are not sent
+        results = [True] * len(items)
+        trs_indexes = [idx for idx in range(len(items)) if items[idx]["anno"] in (1, -1)]
+
+        use_batch = True
+        for start_idx in range(0, len(trs_indexes), TRS_BATCH_SIZE):
+            batch_indexes = trs_indexes[start_idx:start_idx + TRS_BATCH_SIZE]
+            batch = [items[idx] for idx in batch_indexes]
+            batch_results = None
+            if use_batch:
+                batch_results = self._add_trs_batch_request(query_id, batch)
+            if batch_results is None:
+                # do not try again for the rest of the items
+                use_batch = False
+                batch_results = [self._add_trs_single(query_id, item) for item in batch]
+            for (idx, result) in zip(batch_indexes, batch_results):
+                results[idx] = result
+
+        return results
+
+
+    def _add_trs_batch_request(self, query_id, batch):
+        """
+            Sends one 'addTrsBatch' request to the backend.
+            Arguments:
+                query_id: id of the query.
+                batch: List of dictionaries, as described in add_trs_batch.
+            Returns:
+               A list of booleans with the success of each item, or 'None'
+               if the backend does not support 'addTrsBatch'.
+        """
+        func_in = {}
+        func_in["func"] = "addTrsBatch"
+        func_in["query_id"] = query_id
+        func_in["items"] = []
+        for item in batch:
+            item_in = {}
+            item_in["impath"] = urllib.parse.unquote(urllib.parse.unquote(item["impath"])) # decode possibly url-encoded image names
+            item_in["featpath"] = item["featpath"]
+            item_in["anno"] = item["anno"]
+            item_in["from_dataset"] = (1 if item["from_dataset"] else 0)
+            if item.get("extra_params"):
+                item_in["extra_params"] = item["extra_params"]
+            func_in["items"].append(item_in)
+        request = json.dumps(func_in)
+
+        response = self.custom_request(request)
+
+        func_out = json.loads(response)
+        if "results" not in func_out or len(func_out["results"]) != len(batch):
+            # only a response with per-item results shows the backend knows
+            # about batches. Anything else is treated as 'not supported'.
+            return None
+
+        return [bool(result) for result in func_out["results"]]
+
+
+    def _add_trs_single(self, query_id, item):
+        """
+            Adds a single training image to a query, as a fallback for
+            backends not supporting 'addTrsBatch'.
+            Arguments:
+                query_id: id of the query.
+                item: Dictionary, as described in add_trs_batch.
+            Returns:
+               True on success, False otherwise.
+        """
+        if item["anno"] == 1:
+            return self.add_pos_trs(query_id, item["impath"], item["featpath"],
+                                    item["from_dataset"], item.get("extra_params"))
+        elif item["anno"] == -1:
+            return self.add_neg_trs(query_id, item["impath"], item["featpath"],
+                                    item["from_dataset"], item.get("extra_params"))
+        return True
+
+
     def train(self, query_id, anno_path=None):
         """
             Executes the training process on the backend.
@@ -518,6 +644,155 @@ class Session(object):
         return False
 
 
+    def get_roi(self, frame_path, query_string):
+        """
+            Gets the region of interest of a result of a query.
+            It calls 'getRoi' in the backend.
+            The backend should return the results in JSON format with
+            the field 'roi', if the ROI is known.
+            Arguments:
+                frame_path: path of the result in the dataset.
+                query_string: definition of the query.
+            Returns:
+                The ROI, as a string or a list of coordinates. It can be empty
+                if the result has no ROI. 'None' if the backend did not return
+                the ROI.
+        """
+        func_in = {}
+        func_in["func"] = "getRoi"
+        func_in["frame_path"] = frame_path
+        func_in["query_string"] = query_string
+        request = json.dumps(func_in)
+
+        response = self.custom_request(request)
+
+        func_out = json.loads(response)
+        return func_out.get("roi", None)
+
+
+    def get_rois(self, frame_paths, query_string):
+        """
+            Gets the regions of interest of several results of a query, using
+            as few requests as possible.
+            It calls 'getRois' in the backend, sending up to ROI_BATCH_SIZE
+            paths per request. If the backend does not support 'getRois', it
+            falls back to one 'getRoi' call per path for the remaining paths.
+            The backend should return the results in JSON format with at least
+            the field: 'rois', a dictionary with the ROI of each path. Paths
+            not in the dictionary have no ROI.
+            Arguments:
+                frame_paths: List of paths of results in the dataset.
+                query_string: definition of the query.
+            Returns:
+                A dictionary with the ROI of each path for which the backend
+                answered, as returned by get_roi.
+        """
+        rois = {}
+        use_batch = True
+        for start_idx in range(0, len(frame_paths), ROI_BATCH_SIZE):
+            batch = frame_paths[start_idx:start_idx + ROI_BATCH_SIZE]
+            batch_rois = None
+            if use_batch:
+                func_in = {}
+                func_in["func"] = "getRois"
+                func_in["frame_paths"] = batch
+                func_in["query_string"] = query_string
+                request = json.dumps(func_in)
+
+                response = self.custom_request(request)
+
+                func_out = json.loads(response)
+                if isinstance(func_out.get("rois", None), dict):
+                    batch_rois = dict((path, func_out["rois"].get(path, "")) for path in batch)
+            if batch_rois is None:
+                # do not try again for the rest of the paths
+                use_batch = False
+                batch_rois = {}
+                for path in batch:
+                    roi = self.get_roi(path, query_string)
+                    if roi is not None:
+                        batch_rois[path] = roi
+            rois.update(batch_rois)
+
+        return rois
+
+
+    def get_roi_list(self, frame_path):
+        """
+            Gets all the regions of interest of an image of the dataset.
+            It calls 'getRoiList' in the backend.
+            The backend should return the results in JSON format with
+            the field 'rois', if the ROIs are known.
+            Arguments:
+                frame_path: path of the image in the dataset.
+            Returns:
+                A list of ROIs, each one a list of coordinates, possibly followed
+                by a label. 'None' if the backend did not return the ROIs.
+        """
+        func_in = {}
+        func_in["func"] = "getRoiList"
+        func_in["frame_path"] = frame_path
+        request = json.dumps(func_in)
+
+        response = self.custom_request(request)
+
+        func_out = json.loads(response)
+        return func_out.get("rois", None)
+
+
+    def get_roi_lists(self, frame_paths):
+        """
+            Gets all the regions of interest of several images of the dataset,
+            using as few requests as possible.
+            It calls 'getRoiLists' in the backend, sending up to ROI_BATCH_SIZE
+            paths per request. If the backend does not support 'getRoiLists',
+            it falls back to 'getRoiList' calls for the remaining paths, sent
+            concurrently over part of the connection pool of the backend, and
+            'getRoiLists' is not sent again to the same backend for
+            ROI_LISTS_RETRY_INTERVAL seconds.
+            The backend should return the results in JSON format with at least
+            the field: 'rois', a dictionary with the list of ROIs of each path.
+            Paths not in the dictionary have no ROIs.
+            Arguments:
+                frame_paths: List of paths of images in the dataset.
+            Returns:
+                A dictionary with the list of ROIs of each path for which the
+                backend answered, as returned by get_roi_list.
+        """
+        roi_lists = {}
+        remaining_paths = frame_paths
+        if _roi_lists_supported(self.port, self.host):
+            remaining_paths = []
+            for start_idx in range(0, len(frame_paths), ROI_BATCH_SIZE):
+                batch = frame_paths[start_idx:start_idx + ROI_BATCH_SIZE]
+                func_in = {}
+                func_in["func"] = "getRoiLists"
+                func_in["frame_paths"] = batch
+                request = json.dumps(func_in)
+
+                response = self.custom_request(request)
+
+                func_out = json.loads(response)
+                if not isinstance(func_out.get("rois", None), dict):
+                    # do not try again for the rest of the paths, nor for a while
+                    _roi_lists_unsupported[(self.host, self.port)] = time.time()
+                    remaining_paths = frame_paths[start_idx:]
+                    break
+                for path in batch:
+                    roi_lists[path] = func_out["rois"].get(path, [])
+
+        if remaining_paths:
+            # leave some connections of the pool free for other requests
+            num_threads = min(max(_pool_max_size // 2, 1), len(remaining_paths))
+            with Pool(num_threads) as pool:
+                remaining_rois = pool.map(self.get_roi_list, remaining_paths)
+            for (path, rois) in zip(remaining_paths, remaining_rois):
+                if rois is not None:
+                    roi_lists[path] = rois
+
+        return roi_lists
+
+
     def test_func(self):
         """
             Simple test function, which will invoke 'testFunc' in the backend
@@ -538,6 +813,301 @@ class Session(object):
         print (response)
 
 
+# ----------------------------------
+## Connection pooling
+# ----------------------------------
+
+class PooledConnection(object):
+    """
+        Keep-alive TCP/IP connection to a VISOR backend.
+
+        Keeps track of any data received after the TCP_TERMINATOR of the
+        last response, so that the connection can be safely reused for
+        the next request.
+    """
+
+    def __init__(self, port, host="localhost"):
+        """
+            Initializes the class and connects to the backend.
+            Arguments:
+                port: port number in the target machine
+                host: target machine host name
+            Returns:
+                It raises socket.error if the connection fails.
+        """
+        self.port = port
+        self.host = host
+        self.leftovers = b''
+        self.reused = False
+        # overflow connections are not counted by the pool and are
+        # closed instead of being returned to it
+        self.pooled = True
+        self.last_used = time.time()
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(TCP_TIMEOUT)
+
+
+    def is_healthy(self):
+        """
+            Checks whether the connection can still be used.
+            A healthy idle connection should have nothing to read, so if
+            the socket is readable the backend has either closed it or
+            sent unexpected data.
+            Returns:
+                True if the connection looks usable, False otherwise.
+        """
+        if self.sock is None or self.leftovers:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (socket.error, ValueError):
+            return False
+        return not readable
+
+
+    def send(self, request):
+        """
+            Sends a request.
+            Arguments:
+                request: string to be sent, including the TCP_TERMINATOR
+            Returns:
+                It raises socket.error and socket.timeout on failure.
+        """
+        self.last_used = time.time()
+        self.sock.sendall(request.encode())
+
+
+    def receive(self):
+        """
+            Reads a response up to the next TCP_TERMINATOR.
+            Returns:
+                The response without the TCP_TERMINATOR, or 'None' if the
+                backend closed the connection before a full response
+                was received.
+                It raises socket.error and socket.timeout on failure.
+        """
+        terminator = TCP_TERMINATOR.encode()
+        response = self.leftovers
+        term_idx = response.find(terminator)
+        while term_idx < 0:
+            rep_chunk = self.sock.recv(TCP_RECV_SIZE)
+            if not rep_chunk:
+                return None
+            # only search the newly received data, plus enough of the
+            # previous data to catch a terminator split between chunks
+            search_from = max(len(response) - len(terminator) + 1, 0)
+            response = response + rep_chunk
+            term_idx = response.find(terminator, search_from)
+
+        self.leftovers = response[term_idx + len(terminator):]
+        self.last_used = time.time()
+        return response[0:term_idx].decode()
+
+
+    def close(self):
+        """ Closes the connection """
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class ConnectionPool(object):
+    """
+        Pool of keep-alive connections to a single VISOR backend.
+
+        Connections are created on demand, up to max_size, and returned
+        to the pool after each request. Idle connections are checked
+        before being reused and discarded if they are no longer healthy
+        or have been idle for longer than max_idle_time.
+
+        If all the connections are busy for longer than acquire_timeout,
+        an extra connection outside the pool is opened for the request, so
+        that nested or long requests cannot block the others forever.
+    """
+
+    def __init__(self, port, host="localhost", max_size=POOL_MAX_SIZE,
+                 max_idle_time=POOL_MAX_IDLE_TIME, acquire_timeout=POOL_ACQUIRE_TIMEOUT):
+        """
+            Initializes the pool.
+            Arguments:
+                port: port number in the target machine
+                host: target machine host name
+                max_size: maximum number of simultaneous connections
+                max_idle_time: number of seconds after which an idle
+                               connection is closed instead of reused
+                acquire_timeout: number of seconds to wait for a free connection
+                                 before opening an overflow connection. If None,
+                                 wait until a connection is released.
+        """
+        self.port = port
+        self.host = host
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._num_open = 0
+        self._condition = Condition(Lock())
+
+
+    def acquire(self, reuse=True):
+        """
+            Borrows a connection from the pool, blocking if max_size
+            connections are already in use. If none is released within
+            acquire_timeout seconds, an overflow connection is returned.
+            Arguments:
+                reuse: set to False to force the creation of a new connection
+            Returns:
+                A PooledConnection. It raises socket.error if a new connection
+                cannot be established.
+        """
+        pooled = True
+        deadline = None
+        if self.acquire_timeout is not None:
+            deadline = time.time() + self.acquire_timeout
+        with self._condition:
+            while True:
+                while reuse and self._idle:
+                    conn = self._idle.pop()
+                    if (time.time() - conn.last_used) < self.max_idle_time and conn.is_healthy():
+                        conn.reused = True
+                        return conn
+                    conn.close()
+                    self._num_open = self._num_open - 1
+                if self._num_open < self.max_size:
+                    self._num_open = self._num_open + 1
+                    break
+                if not reuse and self._idle:
+                    # make room for the new connection
+                    self._idle.pop(0).close()
+                    self._num_open = self._num_open - 1
+                    continue
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print ('All connections to port %s are busy, opening an extra one' % str(self.port))
+                    pooled = False
+                    break
+                self._condition.wait(remaining)
+
+        try:
+            conn = PooledConnection(self.port, self.host)
+        except socket.error:
+            if pooled:
+                with self._condition:
+                    self._num_open = self._num_open - 1
+                    self._condition.notify()
+            raise
+        conn.pooled = pooled
+        return conn
+
+
+    def release(self, conn):
+        """
+            Returns a connection to the pool.
+            Arguments:
+                conn: PooledConnection previously obtained with acquire()
+        """
+        if not conn.pooled:
+            conn.close()
+            return
+        with self._condition:
+            if conn.sock is not None and len(self._idle) < self.max_size:
+                conn.reused = False
+                self._idle.append(conn)
+            else:
+                conn.close()
+                self._num_open = self._num_open - 1
+            self._condition.notify()
+
+
+    def discard(self, conn):
+        """
+            Closes a connection obtained with acquire() without returning it
+            to the pool, e.g. after a communication error.
+            Arguments:
+                conn: PooledConnection previously obtained with acquire()
+        """
+        conn.close()
+        if not conn.pooled:
+            return
+        with self._condition:
+            self._num_open = self._num_open - 1
+            self._condition.notify()
+
+
+    def close_idle(self):
+        """ Closes all idle connections in the pool """
+        with self._condition:
+            while self._idle:
+                self._idle.pop().close()
+                self._num_open = self._num_open - 1
+            self._condition.notify_all()
+
+
+_pools = {}
+_pools_lock = Lock()
+_pool_max_size = POOL_MAX_SIZE
+# time of the last failed 'getRoiLists' request, by backend
+_roi_lists_unsupported = {}
+
+
+def set_pool_max_size(max_size):
+    """
+        Sets the maximum number of simultaneous connections per backend.
+        It only affects the pools created after calling this function.
+        Arguments:
+            max_size: maximum number of connections per backend port
+    """
+    global _pool_max_size
+    _pool_max_size = max(int(max_size), 1)
+
+
+def get_connection_pool(port, host="localhost"):
+    """
+        Gets the connection pool associated to a backend, creating it
+        if necessary.
+        Arguments:
+            port: port number in the target machine
+            host: target machine host name
+        Returns:
+            A ConnectionPool instance shared by all Sessions to the same backend.
+    """
+    with _pools_lock:
+        if (host, port) not in _pools:
+            _pools[(host, port)] = ConnectionPool(port, host, max_size=_pool_max_size)
+        return _pools[(host, port)]
+
+
+def _roi_lists_supported(port, host="localhost"):
+    """
+        Checks whether 'getRoiLists' should be sent to a backend, i.e. whether
+        the backend did not fail to answer it in the last ROI_LISTS_RETRY_INTERVAL
+        seconds.
+        Arguments:
+            port: port number in the target machine
+            host: target machine host name
+        Returns:
+            True if 'getRoiLists' should be tried, False otherwise.
+    """
+    failed_at = _roi_lists_unsupported.get((host, port), None)
+    return failed_at is None or (time.time() - failed_at) >= ROI_LISTS_RETRY_INTERVAL
+
+
+def close_all_connections():
+    """ Closes all idle connections to all backends """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close_idle()
+
+
+
 if __name__ == "__main__":
     # if invoked from the command line, just start the session with the backend
     PORT = 35200
@@ -97,8 +97,9 @@ class CuratedQuery(object):
             )
 
         with timing.TimerBlock() as timer:
-            feat_comp = feature_computation.FeatureComputer(self.query_id, self.backend_port)
-            feat_comp.compute_feats(imgs_dict)
+            num_workers = self.compdata_cache.engines_dict[self.query['engine']].get('featcomp_workers', 1)
+            feat_comp = feature_computation.FeatureComputer(self.query_id, self.backend_port, num_workers)
+            feat_comp.compute_feats(imgs_dict, shared_vars)
 
         return timer.interval
 
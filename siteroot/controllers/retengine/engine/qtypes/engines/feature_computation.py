@@ -1,38 +1,97 @@
 import os
+import math
+from threading import Lock
+from multiprocessing.dummy import Pool
 from retengine.engine import backend_client
 from retengine.utils import timing
 from retengine.models import errors
 
+# maximum number of files sent together to the backend when computing
+# features in parallel, so that progress can be reported regularly
+FEATCOMP_GROUP_SIZE = 10
+
+# thread pools for the parallel computation of features, one per backend port
+_featcomp_pools = {}
+_featcomp_pools_lock = Lock()
+
+
+def _get_featcomp_pool(backend_port, num_workers):
+    """
+        Gets the thread pool used to compute features with a backend,
+        creating it if necessary. The pool is shared by all queries sent
+        to the same backend, so num_workers limits the total number of
+        concurrent feature computations on it.
+        Arguments:
+            backend_port: Communication port with the backend
+            num_workers: Number of threads in the pool.
+        Returns:
+            A multiprocessing.dummy.Pool instance.
+    """
+    with _featcomp_pools_lock:
+        if backend_port not in _featcomp_pools:
+            _featcomp_pools[backend_port] = Pool(processes=num_workers)
+        return _featcomp_pools[backend_port]
+
 
 class FeatureComputer(object):
     """ Contacts the backend to perform features computation """
 
-    def __init__(self, query_id, backend_port):
+    def __init__(self, query_id, backend_port, num_workers=1):
         """
             Initializes the class.
             Arguments:
                 query_id: id of the query being executed.
                 backend_port: Communication port with the backend
+                num_workers: Maximum number of concurrent requests to the
+                             backend. If 1, all files are processed serially.
         """
         self.query_id = query_id
         self.backend_port = backend_port
+        self.num_workers = num_workers
 
 
-    def compute_feats(self, out_dicts):
+    def compute_feats(self, out_dicts, shared_vars=None):
         """
             Performs the computation of features for a set of files.
+            All files are sent to the backend in batches (see
+            backend_client.Session.add_trs_batch), instead of one request
+            per file. If more than one worker was requested, the files are
+            split in groups which are processed in parallel.
             Arguments:
                 out_dicts: List of dictionaries where each entry contains
                            information about the file to process, the annotations
                            for the file and where to store the computed features.
+                shared_vars: holder of global shared variables. If specified,
+                             the number of processed and failed files is stored
+                             in it as the computation progresses, and the
+                             computation stops if the query is cancelled.
             Returns:
                 The time it took to compute the features
+                It raises a QueryCancelledError if the query is cancelled.
         """
         with timing.TimerBlock() as timer:
             out_dicts = [dict(list(self.__dict__.items()) + list(out_dict.items()))
                          for out_dict in out_dicts]
-            for adict in out_dicts:
-                _compute_feat(adict)
+            if shared_vars is not None:
+                shared_vars.featcomp_total = len(out_dicts)
+                shared_vars.featcomp_done = 0
+                shared_vars.featcomp_failed = 0
+
+            if self.num_workers > 1 and len(out_dicts) > 1:
+                group_size = int(math.ceil(float(len(out_dicts)) / self.num_workers))
+                group_size = min(group_size, FEATCOMP_GROUP_SIZE)
+                groups = [out_dicts[idx:idx + group_size]
+                          for idx in range(0, len(out_dicts), group_size)]
+                pool = _get_featcomp_pool(self.backend_port, self.num_workers)
+                for results in pool.imap_unordered(_compute_feats_batch, groups):
+                    self._report_progress(results, shared_vars)
+                    if shared_vars is not None and shared_vars.cancel_requested:
+                        # the groups already submitted to the pool are still
+                        # processed, but nothing else is waited for
+                        raise errors.QueryCancelledError('Query ID %d cancelled' % self.query_id)
+            else:
+                results = _compute_feats_batch(out_dicts)
+                self._report_progress(results, shared_vars)
 
         comp_time = timer.interval
 
@@ -40,11 +99,49 @@ class FeatureComputer(object):
         return comp_time
 
 
-def _compute_feat(out_dict):
+    def _report_progress(self, results, shared_vars):
+        """
+            Updates the feature computation counters in shared_vars.
+            Arguments:
+                results: List of booleans with the success of each processed file.
+                shared_vars: holder of global shared variables, or 'None'.
+        """
+        if shared_vars is not None:
+            shared_vars.featcomp_done = shared_vars.featcomp_done + len(results)
+            shared_vars.featcomp_failed = shared_vars.featcomp_failed + results.count(False)
+
+
+def _get_canonical_paths(out_dict):
+    """
+        Resolves the paths of the input file and feature file of one file,
+        in case any of them is a symbolic link.
+        Arguments:
+            out_dict: Dictionary with at least the entries 'clean_fn' and 'feat_fn'
+        Returns:
+            A tuple with the canonical paths of the input file and the feature file.
+    """
+    impath = out_dict['clean_fn']
+    featpath = out_dict['feat_fn']
+
+    if os.path.islink(impath):
+        canonical_impath = os.path.realpath(impath)
+    else:
+        canonical_impath = impath
+
+    if os.path.islink(featpath):
+        canonical_featpath = os.path.realpath(featpath)
+    else:
+        canonical_featpath = featpath
+
+    return (canonical_impath, canonical_featpath)
+
+
+def _compute_feats_batch(out_dicts):
     """
-        Performs the computation of features for one file.
+        Performs the computation of features for a set of files, sending
+        them to the backend in batches.
         Arguments:
-            out_dicts: Dictionary with at least the following entries:
+            out_dicts: List of dictionaries, each one with at least the following entries:
                        'clean_fn': Path to input file for processing.
                        'feat_fn': Path to file where features are stored.
                        'backend_port': Communication port with the backend
@@ -55,50 +152,38 @@ def _compute_feat(out_dict):
                                        is part of the dataset or not.
                        'extra_params': Dictionary containing any other parameter that
                                        can be useful to the backend.
+                       All entries must share the same 'backend_port' and 'query_id'.
         Returns:
-            It raises FeatureCompError is the backend reports something went
-            wrong with the feature computation.
+            A list of booleans with the success of each file, in the same order
+            as 'out_dicts'. Errors are printed, not raised.
     """
-    try:
-        impath = out_dict['clean_fn']
-        featpath = out_dict['feat_fn']
-
-        ses = backend_client.Session(out_dict['backend_port'])
+    if not out_dicts:
+        return []
+
+    items = []
+    for out_dict in out_dicts:
+        (canonical_impath, canonical_featpath) = _get_canonical_paths(out_dict)
+        items.append({'impath': canonical_impath,
+                      'featpath': canonical_featpath,
+                      'anno': out_dict['anno'],
+                      'from_dataset': out_dict['from_dataset'],
+                      'extra_params': out_dict['extra_params']})
 
-        is_symlink = os.path.islink(impath)
-        if is_symlink:
-            canonical_impath = os.path.realpath(impath)
-        else:
-            canonical_impath = impath
-
-        is_symlink_feat = os.path.islink(featpath)
-        if is_symlink_feat:
-            canonical_featpath = os.path.realpath(featpath)
-        else:
-            canonical_featpath = featpath
-
-        if out_dict['anno'] == 1:
-            call_succeeded = ses.add_pos_trs(out_dict['query_id'],
-                                             canonical_impath, canonical_featpath,
-                                             out_dict['from_dataset'],
-                                             out_dict['extra_params'])
-        elif out_dict['anno'] == -1:
-            call_succeeded = ses.add_neg_trs(out_dict['query_id'],
-                                             canonical_impath, canonical_featpath,
-                                             out_dict['from_dataset'],
-                                             out_dict['extra_params'])
-        else:
-            call_succeeded = True
+    try:
+        ses = backend_client.Session(out_dicts[0]['backend_port'])
+        results = ses.add_trs_batch(out_dicts[0]['query_id'], items)
+    except Exception as e:
+        print ("Error computing features for a batch of %d files: " % len(out_dicts), e)
+        return [False] * len(out_dicts)
 
+    for (out_dict, item, call_succeeded) in zip(out_dicts, items, results):
         if not call_succeeded:
-            raise errors.FeatureCompError('Failed computing features of ' + canonical_impath)
-
-        if is_symlink:
-            print ('computed features for: ' + impath +
-                             ' (=>' + canonical_impath + ')')
+            print ("Error computing features for %s: " % out_dict['clean_fn'],
+                   errors.FeatureCompError('Failed computing features of ' + item['impath']))
+        elif item['impath'] != out_dict['clean_fn']:
+            print ('computed features for: ' + out_dict['clean_fn'] +
+                             ' (=>' + item['impath'] + ')')
         else:
-            print('computed features for: ' + impath)
+            print('computed features for: ' + out_dict['clean_fn'])
 
-        ##print "Backend call done: ", impath
-    except Exception as e:
-        print ("Error computing features for %s: " % impath, e )
+    return results
@@ -4,7 +4,7 @@ import traceback
 import sys
 import os
 
-from retengine.models import param_sets, errors
+from retengine.models import param_sets, errors, rank_list
 from retengine.models.opts import RfRankTypes, States
 from retengine.utils import timing
 from retengine.managers import compdata_cache as compdata_cache_module
@@ -75,6 +75,19 @@ class VisorEngine(object):
         self.__dict__.update(a_dict)
 
 
+    def _get_backend_session(self, engine):
+        """
+            Creates a session with the backend of an engine. All sessions
+            to the same backend share the same pool of connections, so
+            creating a session is cheap.
+            Arguments:
+                engine: backend engine to contact
+            Returns:
+                A backend_client.Session instance.
+        """
+        return backend_client.Session(self.visor_opts.engines_dict[engine]['backend_port'])
+
+
     def get_query_id(self, engine, dsetname):
         """
             Contacts the backend requesting a new Query ID.
@@ -87,7 +100,7 @@ class VisorEngine(object):
                 A positive integer number corresponding to the new query ID.
                 It raises a QueryIdError if the ID is negative or 0.
         """
-        ses = backend_client.Session(self.visor_opts.engines_dict[engine]['backend_port'])
+        ses = self._get_backend_session(engine)
         query_id = ses.get_query_id(dsetname)
 
         if query_id <= 0:
@@ -96,6 +109,21 @@ class VisorEngine(object):
         return query_id
 
 
+    def _raise_if_cancelled(self, shared_vars, query_id):
+        """
+            Checks whether the query has been asked to stop. The check is done
+            between the stages of the processing of the query, so a cancelled
+            query stops as soon as the current stage finishes.
+            Arguments:
+                shared_vars: holder of global shared variables
+                query_id: ID of the query
+            Returns:
+                It raises a QueryCancelledError if the query has been cancelled.
+        """
+        if shared_vars.cancel_requested:
+            raise errors.QueryCancelledError('Query ID %d cancelled' % query_id)
+
+
     def process(self, query, query_id, shared_vars, opts, user_ses_id=None):
         """
             Executes a query using the VISOR backend
@@ -111,12 +139,15 @@ class VisorEngine(object):
                     ValueError: In the presence of incorrect options
                     ClassifierTrainError: In case the training fails
                     Exception: In case of any other error
+                If the query is cancelled (see QueryWorker.cancel), the processing
+                stops at the next stage, the state is set to States.cancelled and
+                'None' is returned.
         """
         if not isinstance(opts, param_sets.VisorEngineProcessOpts):
             raise ValueError('opts must be of type param_sets.VisorEngineProcessOpts')
 
         backend_port = self.visor_opts.engines_dict[query['engine']]['backend_port']
-        ses = backend_client.Session(backend_port)
+        ses = self._get_backend_session(query['engine'])
 
         try:
             # check if classifier has been trained and saved to file or not
@@ -136,6 +167,7 @@ class VisorEngine(object):
                                                              backend_port,
                                                              self.compdata_cache,
                                                              opts)
+                    self._raise_if_cancelled(shared_vars, query_id)
                     print ('Computing features for Query ID: %d' % query_id)
                     shared_vars.exectime_processing = query_handler.compute_feats(shared_vars)
 
@@ -143,6 +175,7 @@ class VisorEngine(object):
                                                          query_id=query_id,
                                                          user_ses_id=user_ses_id)
                 # train classifier now if it hasn't been already
+                self._raise_if_cancelled(shared_vars, query_id)
                 print ('Training classifier for Query ID: %d' % query_id)
                 shared_vars.state = States.training
                 with timing.TimerBlock() as timer:
@@ -165,6 +198,7 @@ class VisorEngine(object):
                 print ('Loaded classifier from file for Query ID: %d' % query_id)
 
             # compute ranking
+            self._raise_if_cancelled(shared_vars, query_id)
 
             do_regular_rank = False
 
@@ -205,6 +239,10 @@ class VisorEngine(object):
 
             # mark results as ready
             shared_vars.state = States.results_ready
+        except errors.QueryCancelledError as e:
+            # nothing to clean up: whatever was saved to the caches is still valid
+            print (e)
+            shared_vars.state = States.cancelled
         except Exception as e:
             # determine if on cache exclude list
             excl_query = self.result_cache[query['engine']].query_in_exclude_list(query, ses_id=user_ses_id)
@@ -230,11 +268,10 @@ class VisorEngine(object):
                 engine: backend engine to contact
                 query_id: ID of the query
             Results:
-                A List with all the results.
+                A RankList with all the results.
                 It raises a ResultReadError if the results cannot be read.
         """
-        backend_port = self.visor_opts.engines_dict[engine]['backend_port']
-        ses = backend_client.Session(backend_port)
+        ses = self._get_backend_session(engine)
 
         # get ranking from backend
         rlist = ses.get_ranking(query_id)
@@ -253,7 +290,19 @@ class VisorEngine(object):
         if isinstance(rlist, bool) and not rlist:
             raise errors.ResultReadError('Could not read in results from backend')
 
-        return rlist
+        return rank_list.RankList.from_items(rlist)
+
+
+    def release_query_id(self, engine, query_id):
+        """
+            Instructs the backend to release a query ID, discarding the
+            results of the query, if any.
+            Arguments:
+                engine: backend engine to contact
+                query_id: ID of the query
+        """
+        ses = self._get_backend_session(engine)
+        ses.release_query_id(query_id)
 
 
     def _save_classifier(self, query, fname, query_id):
@@ -267,8 +316,7 @@ class VisorEngine(object):
             Results:
                 It raises a ClassifierSaveLoadError in case of error.
         """
-        backend_port = self.visor_opts.engines_dict[query['engine']]['backend_port']
-        ses = backend_client.Session(backend_port)
+        ses = self._get_backend_session(query['engine'])
         if not ses.save_classifier(query_id, fname):
             raise errors.ClassifierSaveLoadError('Could not save classifier from %s' % fname)
 
@@ -287,8 +335,7 @@ class VisorEngine(object):
         """
         if not os.path.isfile(fname):
             return False
-        backend_port = self.visor_opts.engines_dict[query['engine']]['backend_port']
-        ses = backend_client.Session(backend_port)
+        ses = self._get_backend_session(query['engine'])
         if not ses.load_classifier(query_id, fname):
             raise errors.ClassifierSaveLoadError('Could not load classifier from %s' % fname)
         return True
@@ -305,8 +352,7 @@ class VisorEngine(object):
             Results:
                 It raises a AnnoSaveLoadError in case of error.
         """
-        backend_port = self.visor_opts.engines_dict[query['engine']]['backend_port']
-        ses = backend_client.Session(backend_port)
+        ses = self._get_backend_session(query['engine'])
         if not ses.save_annotations(query_id, fname):
             raise errors.AnnoSaveLoadError('Could not save annotations to %s' % fname)
 
@@ -324,8 +370,7 @@ class VisorEngine(object):
         """
         if not os.path.isfile(fname):
             return False
-        backend_port = self.visor_opts.engines_dict[query['engine']]['backend_port']
-        ses = backend_client.Session(backend_port)
+        ses = self._get_backend_session(query['engine'])
         loaded = ses.load_annotations_and_trs(query_id, fname)
         #if not loaded:
         #    raise errors.AnnoSaveLoadError('Could not get annotations from %s' % fname)
@@ -346,8 +391,7 @@ class VisorEngine(object):
         """
         if not os.path.isfile(fname):
             return []
-        backend_port = self.visor_opts.engines_dict[query['engine']]['backend_port']
-        ses = backend_client.Session(backend_port)
+        ses = self._get_backend_session(query['engine'])
         annos = ses.get_annotations(query_id, fname)
         if not annos:
             raise errors.AnnoSaveLoadError('Could not get annotations from %s' % fname)
@@ -2,7 +2,7 @@
 
 import os
 import shutil
-from retengine.models import query_data, opts, param_sets, errors
+from retengine.models import query_data, opts, param_sets, errors, rank_list
 from retengine.managers import result_cache, compdata_cache, query_manager
 from retengine.engine import backend_client
 from . import query_translations
@@ -53,11 +53,17 @@ class VisorInterface(object):
         for engine in self.opts.engines_dict:
             engine_ranklistpath = os.path.join(ranklistpath, engine)
             engine_predefined_ranklistpath = os.path.join(predefined_ranklistpath, engine)
+            engine_shared_cache_dir = None
+            if proc_opts.shared_cache_dir:
+                engine_shared_cache_dir = os.path.join(proc_opts.shared_cache_dir, 'results', engine)
             self.result_cache[engine] = result_cache.ResultCache(engine_predefined_ranklistpath,
                                                              engine_ranklistpath,
                                                              self.process_pool,
                                                              enabled_caches=enabled_result_caches,
-                                                             enabled_excl_caches=enabled_result_excl_caches)
+                                                             enabled_excl_caches=enabled_result_excl_caches,
+                                                             mem_cache_max_bytes=proc_opts.mem_cache_max_bytes,
+                                                             shared_cache_dir=engine_shared_cache_dir,
+                                                             ranklist_codec=proc_opts.ranklist_codec)
 
         self.compdata_cache = compdata_cache.CompDataCache(compdata_paths,
                                                      self.opts.engines_dict,
@@ -70,6 +76,33 @@ class VisorInterface(object):
                                                    self.process_pool,
                                                    proc_opts)
 
+        # load the most used ranking lists in memory, in background
+        if not proc_opts.disable_cache and proc_opts.cache_warmup_lists > 0:
+            self.process_pool.apply_async(func=self.warm_up_caches)
+
+
+    def warm_up_caches(self):
+        """
+            Loads the most used and the predefined ranking lists of each engine
+            into the memory cache (see ResultCache.warm_up).
+        """
+        for engine in self.result_cache:
+            try:
+                self.result_cache[engine].warm_up(self.proc_opts.cache_warmup_lists,
+                                                  self.proc_opts.cache_warmup_max_bytes)
+            except Exception as e:
+                print (e)
+
+
+    def get_cache_warmup_progress(self):
+        """
+            Gets the progress of the warm-up of the memory cache of each engine.
+            Returns:
+                A dictionary mapping each engine to the progress of its warm-up
+                (see ResultCache.get_warmup_progress).
+        """
+        return dict((engine, self.result_cache[engine].get_warmup_progress()) for engine in self.result_cache)
+
 
     def is_backend_available(self):
         """
@@ -144,7 +177,7 @@ class VisorInterface(object):
                     result['keywords'] = result_meta['keywords']
                 rlist.append(result)
             status = query_data.QueryStatus(state=opts.States.results_ready)
-            return query_data.QueryData(status, rlist)
+            return query_data.QueryData(status, rank_list.RankList(rlist))
 
         else:
             # get results directly from cache if possible
@@ -167,12 +200,18 @@ class VisorInterface(object):
                 if status.state == opts.States.fatal_error_or_socket_timeout:
                     print ('WARNING: Re-executing a previously failed query by fatal-error or timeout')
                     status = self.query_manager.start_query(query, user_ses_id, force_new_worker=True)
+                elif status.state == opts.States.cancelled:
+                    # a cancelled query being requested again must be executed again
+                    status = self.query_manager.start_query(query, user_ses_id, force_new_worker=True)
 
                 if return_rlist_directly and status.state == opts.States.results_ready:
                     try:
                         rlist = self._get_results(status, query_ses_id, user_ses_id)
                     except errors.ResultReadError:
                         status = query_data.QueryStatus(state=opts.States.result_read_error)
+                    except errors.QueryIdError:
+                        # the worker was released while reading its results
+                        status = query_data.QueryStatus(state=opts.States.invalid_qid)
 
             return query_data.QueryData(status, rlist)
 
@@ -205,10 +244,30 @@ class VisorInterface(object):
                 rlist = self._get_results(status, query_ses_id, user_ses_id)
             except errors.ResultReadError:
                 status = query_data.QueryStatus(state=opts.States.result_read_error)
+            except errors.QueryIdError:
+                # the worker was released while reading its results
+                status = query_data.QueryStatus(state=opts.States.invalid_qid)
 
         return query_data.QueryData(status, rlist)
 
 
+    def cancel_query(self, qid):
+        """
+            Cancels an existing query, releasing its resources in the backend.
+            Arguments:
+                qid: ID of the query being cancelled.
+            Returns:
+                A QueryStatus object with the status of the query at the time
+                of the cancellation.
+        """
+        try:
+            status = self.query_manager.cancel_query(qid)
+        except errors.QueryIdError:
+            # set error in status if Query ID doesn't exist
+            status = query_data.QueryStatus(state=opts.States.invalid_qid)
+        return status
+
+
     def _get_results(self, status, query_ses_id=None, user_ses_id=None):
         """
             Get the results of a query and also saves them to the results
@@ -259,9 +318,8 @@ class VisorInterface(object):
         q_excl_list = {}
         query_tuples = {}
         for engine in self.opts.engines_dict:
+            # text queries are returned sorted alphabetically
             querystrs[engine] = self.result_cache[engine].get_all_disk_cached_text_querystrs()
-            # sort text queries alphabetically
-            querystrs[engine].sort()
             # get cache exclude list
             q_excl_list[engine] = []
             for querystr in querystrs[engine]:
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import sys
 from threading import Lock
 from collections import OrderedDict
 
@@ -14,18 +15,42 @@ class MaxSizeCache(object):
         This class stores generic key-value data in a cache with an upper limit
         on maximum size. When this limit is reached, the cache is pruned until it
         is below the size limit (configurable by the entry_limit passed on initialization).
+
+        Optionally, the cache can also be bounded by an approximate number of bytes
+        (byte_limit), in which case the size of each entry is estimated with the
+        sizeof function when it is added. In both cases, the least recently used
+        entries are evicted first.
+
+        Keys which are tuples are also indexed by each of their prefixes, so that
+        all the entries starting with a partial tuple can be deleted without
+        scanning the whole cache (see delete_data_partial_tuple).
     """
 
-    def __init__(self, entry_limit=100):
+    def __init__(self, entry_limit=100, byte_limit=None, sizeof=None):
         """
             Initializes the cache.
             Arguments:
                 entry_limit: maximum number of entries on the cache.
-                             The default is 100 entries.
+                             The default is 100 entries. Use 'None' for no limit.
+                byte_limit: maximum approximate number of bytes of all entries
+                            on the cache. The default is 'None' (no limit).
+                sizeof: function returning the approximate size in bytes of
+                        an entry. By default, sys.getsizeof is used.
         """
         self._datastore_lock = Lock()
         self._datastore = OrderedDict()
         self._entry_limit = entry_limit
+        self._byte_limit = byte_limit
+        self._sizeof = sizeof
+        # approximate size of each entry, only kept if byte_limit is set
+        self._entry_sizes = {}
+        self._total_bytes = 0
+        # index from the prefixes of tuple keys to the set of keys starting with them
+        self._prefix_index = {}
+        # usage counters
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
 
 
     def __getstate__(self):
@@ -48,6 +73,74 @@ class MaxSizeCache(object):
         self._datastore_lock = Lock()
 
 
+    def _estimate_size(self, data):
+        """
+            Estimates the size in bytes of an entry.
+            Arguments:
+                data: Data to be stored in the cache
+            Returns:
+                The approximate size of data in bytes.
+        """
+        if self._sizeof:
+            return self._sizeof(data)
+        return sys.getsizeof(data)
+
+
+    def _index_key(self, key):
+        """
+            Adds a key to the prefix index, if it is a tuple.
+            The lock must be held by the caller.
+            Arguments:
+                key: ID of data being added
+        """
+        if isinstance(key, tuple):
+            for length in range(1, len(key)):
+                self._prefix_index.setdefault(key[:length], set()).add(key)
+
+
+    def _unindex_key(self, key):
+        """
+            Removes a key from the prefix index, if it is a tuple.
+            The lock must be held by the caller.
+            Arguments:
+                key: ID of data being deleted
+        """
+        if isinstance(key, tuple):
+            for length in range(1, len(key)):
+                prefix = key[:length]
+                keys = self._prefix_index.get(prefix)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._prefix_index[prefix]
+
+
+    def _pop_entry(self, key):
+        """
+            Removes an entry from the datastore and updates the byte count
+            and the prefix index. The lock must be held by the caller.
+            Arguments:
+                key: ID of data to be deleted
+        """
+        del self._datastore[key]
+        self._total_bytes -= self._entry_sizes.pop(key, 0)
+        self._unindex_key(key)
+
+
+    def _is_over_limit(self):
+        """
+            Checks whether the cache is above any of its limits.
+            The lock must be held by the caller.
+            Returns:
+                True if the cache must be pruned, False otherwise.
+        """
+        if self._entry_limit is not None and len(self._datastore) > self._entry_limit:
+            return True
+        if self._byte_limit is not None and self._total_bytes > self._byte_limit:
+            return True
+        return False
+
+
     def purge_old_data(self, lock=True):
         """
             Clears all data which are above the storage limit.
@@ -56,15 +149,22 @@ class MaxSizeCache(object):
                       to guarantee exclusive access to the cache before
                       purging the data.
         """
+        evicted = 0
         try:
             if lock:
                 self._datastore_lock.acquire()
-            while len(self._datastore) > self._entry_limit:
-                print ('entry count is: %d vs entry limit of : %d' % (len(self._datastore), self._entry_limit))
-                self._datastore.popitem(False)
+            while self._datastore and self._is_over_limit():
+                key = next(iter(self._datastore))
+                self._pop_entry(key)
+                evicted += 1
+            self._evictions += evicted
         finally:
             if lock:
                 self._datastore_lock.release()
+        # report outside the lock, to keep the purge short
+        if evicted:
+            print ('evicted %d entries. entry count is: %d (%d bytes) vs entry limit of : %s (%s bytes)' %
+                   (evicted, len(self._datastore), self._total_bytes, self._entry_limit, self._byte_limit))
 
 
     def delete_data(self, key):
@@ -75,7 +175,7 @@ class MaxSizeCache(object):
         """
         with self._datastore_lock:
             if key in self._datastore:
-                del self._datastore[key]
+                self._pop_entry(key)
 
 
     def delete_data_partial_tuple(self, partial_tuple):
@@ -87,15 +187,20 @@ class MaxSizeCache(object):
                                cache.
         """
         with self._datastore_lock:
-            self._datastore = OrderedDict((key, ritem)
-                                          for (key, ritem) in self._datastore.items()
-                                          if not partial_tuple == key[:len(partial_tuple)])
+            keys = list(self._prefix_index.get(partial_tuple, ()))
+            if partial_tuple in self._datastore:
+                keys.append(partial_tuple)
+            for key in keys:
+                self._pop_entry(key)
 
 
     def clear_cache(self):
         """ Clears up the entire cache """
         with self._datastore_lock:
             self._datastore = OrderedDict()
+            self._entry_sizes = {}
+            self._total_bytes = 0
+            self._prefix_index = {}
 
 
     def get_data(self, key):
@@ -110,10 +215,12 @@ class MaxSizeCache(object):
         data = None
         with self._datastore_lock:
             if key in self._datastore:
-                # reinsert to update ordering
+                # move to the end to update ordering
                 data = self._datastore[key]
-                del self._datastore[key]
-                self._datastore[key] = data
+                self._datastore.move_to_end(key)
+                self._hits += 1
+            else:
+                self._misses += 1
 
         return data
 
@@ -126,8 +233,33 @@ class MaxSizeCache(object):
                 key: ID of data to be stored.
                 data: Data to be stored in the cache
         """
+        # estimate the size outside the lock, as it might be slow
+        size = self._estimate_size(data) if self._byte_limit is not None else 0
         with self._datastore_lock:
             if key in self._datastore:
-                del self._datastore[key]
+                self._pop_entry(key)
             self._datastore[key] = data
+            self._index_key(key)
+            if self._byte_limit is not None:
+                self._entry_sizes[key] = size
+                self._total_bytes += size
             self.purge_old_data(False)
+
+
+    def get_stats(self):
+        """
+            Gets the usage counters of the cache.
+            Returns:
+                A dictionary with the number of entries ('entries'), their
+                approximate size in bytes ('bytes'), the limits of the cache
+                ('entry_limit', 'byte_limit') and the number of cache
+                hits ('hits'), misses ('misses') and evictions ('evictions').
+        """
+        with self._datastore_lock:
+            return {'entries': len(self._datastore),
+                    'bytes': self._total_bytes,
+                    'entry_limit': self._entry_limit,
+                    'byte_limit': self._byte_limit,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions}
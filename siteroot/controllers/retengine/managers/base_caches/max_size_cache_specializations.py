@@ -1,7 +1,49 @@
 #!/usr/bin/env python
 
+import sys
+
 from retengine import query_translations
-from . import max_size_cache
+from . import max_size_cache, shared_cache
+
+# number of items of a list of results used to estimate its size
+RLIST_SIZE_SAMPLE = 100
+
+def _estimate_item_size(item):
+    """
+        Estimates the size in bytes of an item of a list of results,
+        including the size of its keys and values.
+        Arguments:
+            item: element of the list of results.
+        Returns:
+            The approximate size of the item in bytes.
+    """
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        for (key, value) in item.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+def estimate_rlist_size(rlist):
+    """
+        Estimates the size in bytes of a list of results. To keep it fast
+        for very long lists, only a sample of the items is measured.
+        Arguments:
+            rlist: the list of results.
+        Returns:
+            The approximate size of the list in bytes.
+    """
+    if hasattr(rlist, 'nbytes'):
+        # e.g. a RankList, which knows its own size
+        return rlist.nbytes()
+    if not isinstance(rlist, list):
+        return sys.getsizeof(rlist)
+    size = sys.getsizeof(rlist)
+    if rlist:
+        step = max(1, len(rlist) // RLIST_SIZE_SAMPLE)
+        sample = rlist[::step]
+        size += len(rlist) * sum(_estimate_item_size(item) for item in sample) // len(sample)
+    return size
 
 # ----------------------------------
 ## Session Cache for Results
@@ -10,14 +52,27 @@ from . import max_size_cache
 class MaxSizeResultCache(object):
     """ Result cache class for max-size memory cache """
 
-    def __init__(self, entry_limit=100):
+    def __init__(self, entry_limit=100, byte_limit=None, shared_path=None):
         """
             Initializes the cache.
             Arguments:
                 entry_limit: maximum number of entries on the cache.
-                             The default is 100 entries.
+                             The default is 100 entries. Use 'None' for no limit.
+                byte_limit: maximum approximate number of bytes used by all the
+                            lists of results in the cache. The default is 'None'
+                            (no limit).
+                shared_path: folder for storing the cache so that it is shared
+                             with other processes. The default is 'None', which
+                             keeps the cache in the memory of this process.
         """
-        self._max_size_cache = max_size_cache.MaxSizeCache(entry_limit)
+        if shared_path:
+            self._max_size_cache = shared_cache.SharedFileCache(shared_path,
+                                                                entry_limit=entry_limit,
+                                                                byte_limit=byte_limit)
+        else:
+            self._max_size_cache = max_size_cache.MaxSizeCache(entry_limit,
+                                                               byte_limit=byte_limit,
+                                                               sizeof=estimate_rlist_size)
 
 
     def get_results(self, query):
@@ -61,3 +116,12 @@ class MaxSizeResultCache(object):
     def clear_cache(self):
         """ Clears up the entire cache """
         self._max_size_cache.clear_cache()
+
+
+    def get_stats(self):
+        """
+            Gets the usage counters of the cache.
+            Returns:
+                A dictionary with the counters (see MaxSizeCache.get_stats).
+        """
+        return self._max_size_cache.get_stats()
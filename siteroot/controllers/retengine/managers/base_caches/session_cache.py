@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
+import heapq
 from time import time
 from threading import Lock
 
+# number of buckets of the expiry wheel spanning the lifetime of a session
+EXPIRY_WHEEL_BUCKETS = 60
+
 # ----------------------------------
 ## Session Cache Class
 # ----------------------------------
@@ -17,6 +21,11 @@ class SessionCache(object):
         index are required. Any data associated with a 'session' which has not been
         read or written to recently will be periodically removed (configurable by the
         session_lifetime argument passed on initialization).
+
+        To avoid checking all the sessions on every access, the sessions are grouped
+        in buckets by their expiry time (an expiry wheel), and only the buckets whose
+        time has passed are checked. Sessions can expire up to a bucket width later
+        than their lifetime, but never earlier.
     """
 
     class SessionData(object):
@@ -24,6 +33,8 @@ class SessionCache(object):
         def __init__(self):
             self.last_update = time()
             self.data = {}
+            # bucket of the expiry wheel the session is in
+            self.bucket = None
 
 
     def __init__(self, session_lifetime=1200):
@@ -36,6 +47,11 @@ class SessionCache(object):
         self._sessions_lock = Lock()
         self._sessions = dict()
         self._session_lifetime = session_lifetime
+        # expiry wheel: bucket number -> IDs of the sessions expiring in that bucket,
+        # plus a heap with the bucket numbers in use, to find the oldest one
+        self._bucket_width = max(float(session_lifetime) / EXPIRY_WHEEL_BUCKETS, 1e-3)
+        self._expiry_buckets = {}
+        self._expiry_heap = []
 
 
     def __getstate__(self):
@@ -58,9 +74,50 @@ class SessionCache(object):
         self._sessions_lock = Lock()
 
 
+    def _touch_session(self, ses_id):
+        """
+            Updates the time of the last access to a session, creating the
+            session if it does not exist, and moves it to its new bucket of
+            the expiry wheel. The lock must be held by the caller.
+            Arguments:
+                ses_id: ID of the session
+            Returns:
+                The SessionData of the session.
+        """
+        session = self._sessions.get(ses_id)
+        if session is None:
+            session = self.SessionData()
+            self._sessions[ses_id] = session
+        session.last_update = time()
+        # round up, so that sessions are never removed before their lifetime
+        bucket = int((session.last_update + self._session_lifetime) // self._bucket_width) + 1
+        if bucket != session.bucket:
+            if session.bucket is not None:
+                self._expiry_buckets[session.bucket].discard(ses_id)
+            if bucket not in self._expiry_buckets:
+                self._expiry_buckets[bucket] = set()
+                heapq.heappush(self._expiry_heap, bucket)
+            self._expiry_buckets[bucket].add(ses_id)
+            session.bucket = bucket
+        return session
+
+
+    def _remove_session(self, ses_id):
+        """
+            Removes a session and its entry in the expiry wheel.
+            The lock must be held by the caller.
+            Arguments:
+                ses_id: ID of the session
+        """
+        session = self._sessions.pop(ses_id)
+        if session.bucket in self._expiry_buckets:
+            self._expiry_buckets[session.bucket].discard(ses_id)
+
+
     def purge_old_sessions(self, lock=True):
         """
             Clears all sessions which haven't been accessed recently.
+            Only the buckets of the expiry wheel whose time has passed are checked.
             Arguments:
                 lock: Boolean indicating whether to use a lock
                       to guarantee exclusive access to the cache before
@@ -69,9 +126,11 @@ class SessionCache(object):
         try:
             if lock:
                 self._sessions_lock.acquire()
-            for key in list(self._sessions.keys()):
-                if (time() - self._sessions[key].last_update) > self._session_lifetime:
-                    del self._sessions[key]
+            now = time()
+            while self._expiry_heap and self._expiry_heap[0] * self._bucket_width <= now:
+                bucket = heapq.heappop(self._expiry_heap)
+                for ses_id in self._expiry_buckets.pop(bucket):
+                    del self._sessions[ses_id]
         finally:
             if lock:
                 self._sessions_lock.release()
@@ -85,7 +144,7 @@ class SessionCache(object):
         """
         with self._sessions_lock:
             if ses_id in self._sessions:
-                del self._sessions[ses_id]
+                self._remove_session(ses_id)
 
             self.purge_old_sessions(False)
 
@@ -116,10 +175,10 @@ class SessionCache(object):
         """
         with self._sessions_lock:
             if ses_id in self._sessions:
-                self._sessions[ses_id] = dict((key, item)
-                                              for (key, item)
-                                              in self._sessions[ses_id].items()
-                                              if not partial_tuple == key[:len(partial_tuple)])
+                self._sessions[ses_id].data = dict((key, item)
+                                                   for (key, item)
+                                                   in self._sessions[ses_id].data.items()
+                                                   if not partial_tuple == key[:len(partial_tuple)])
 
 
     def get_data(self, ses_id, key=None):
@@ -134,16 +193,17 @@ class SessionCache(object):
         """
         data = None
         with self._sessions_lock:
+            # purge first, so that expired sessions are not renewed
+            self.purge_old_sessions(False)
+
             if ses_id in self._sessions:
-                self._sessions[ses_id].last_update = time()
+                self._touch_session(ses_id)
                 if key:
                     if key in self._sessions[ses_id].data:
                         data = self._sessions[ses_id].data[key]
                 else:
                     data = self._sessions[ses_id].data
 
-            self.purge_old_sessions(False)
-
         return data
 
 
@@ -164,7 +224,7 @@ class SessionCache(object):
                         if data == item:
                             found_ses.append(ses_id)
             for ses_id in found_ses:
-                del self._sessions[ses_id]
+                self._remove_session(ses_id)
 
             self.purge_old_sessions(False)
 
@@ -179,14 +239,14 @@ class SessionCache(object):
                 data: Data to be stored in the cache
         """
         with self._sessions_lock:
-            if ses_id not in self._sessions:
-                self._sessions[ses_id] = self.SessionData()
-            self._sessions[ses_id].last_update = time()
-            self._sessions[ses_id].data[key] = data
+            self._touch_session(ses_id).data[key] = data
 
             self.purge_old_sessions(False)
 
 
     def clear_all_sessions(self):
         """ Clears up the entire cache """
-        self._sessions = dict()
+        with self._sessions_lock:
+            self._sessions = dict()
+            self._expiry_buckets = {}
+            self._expiry_heap = []
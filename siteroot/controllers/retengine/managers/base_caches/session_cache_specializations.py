@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from retengine import query_translations
-from . import session_cache
+from . import session_cache, shared_cache
 
 
 # ----------------------------------
@@ -11,16 +11,22 @@ from . import session_cache
 class SessionExcludeListCache(object):
     """ Exclude list session cache class """
 
-    def __init__(self, session_lifetime=1800):
+    def __init__(self, session_lifetime=1800, shared_path=None):
         """
             Initializes the cache.
             Arguments:
                 session_lifetime: number of seconds before a cache entry
                                   expires. The default is 30 minutes.
+                shared_path: folder for storing the cache so that it is shared
+                             with other processes. The default is 'None', which
+                             keeps the cache in the memory of this process.
         """
         self.cache_exclude_list = set([])
         # initialize session cache with expiry time of 30 mins
-        self._session_cache = session_cache.SessionCache(session_lifetime)
+        if shared_path:
+            self._session_cache = shared_cache.SharedFileSessionCache(shared_path, session_lifetime)
+        else:
+            self._session_cache = session_cache.SessionCache(session_lifetime)
 
 
     def query_in_exclude_list(self, query, ses_id=None):
@@ -86,14 +92,20 @@ class SessionExcludeListCache(object):
 class SessionResultCache(object):
     """ Result session cache class """
 
-    def __init__(self, session_lifetime=900):
+    def __init__(self, session_lifetime=900, shared_path=None):
         """
             Initializes the cache.
             Arguments:
                 session_lifetime: number of seconds before a cache entry
                                   expires. The default is 15 minutes.
+                shared_path: folder for storing the cache so that it is shared
+                             with other processes. The default is 'None', which
+                             keeps the cache in the memory of this process.
         """
-        self._session_cache = session_cache.SessionCache(session_lifetime)
+        if shared_path:
+            self._session_cache = shared_cache.SharedFileSessionCache(shared_path, session_lifetime)
+        else:
+            self._session_cache = session_cache.SessionCache(session_lifetime)
 
 
     def get_results(self, ses_id, query=None):
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+
+import os
+import pickle
+import tempfile
+from hashlib import md5
+from time import time
+from threading import Lock
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # not available in Windows
+    fcntl = None
+
+from retengine.models import rank_list
+
+# minimum number of seconds between two purges of expired entries
+PURGE_INTERVAL = 60
+
+# ----------------------------------
+## Shared File Cache Class
+# ----------------------------------
+
+class SharedFileCache(object):
+    """
+        Cache for storing generic key-value data in a folder, so that it can
+        be shared by several processes of the same host (e.g. the workers of
+        a uWSGI deployment).
+
+        It provides the same interface as MaxSizeCache. Each entry is stored in
+        two files named after a hash of its key: one with the key itself and
+        one with the data. Ranking lists (RankList objects) are stored in the
+        binary ranking list format and memory-mapped when read, so all the
+        processes share the same copy through the operating system page cache.
+        Any other data is pickled.
+
+        Entries can be limited by number, by total size in bytes and by
+        lifetime. The modification time of the data files is updated on every
+        access and used to evict the least recently used entries first.
+    """
+
+    KEY_EXT = '.key'
+    DATA_EXTS = ('.ranklist', '.pickle')
+
+    def __init__(self, path, entry_limit=None, byte_limit=None, lifetime=None):
+        """
+            Initializes the cache.
+            Arguments:
+                path: folder where the entries are stored. It is created if
+                      it does not exist.
+                entry_limit: maximum number of entries on the cache, or 'None'
+                             for no limit.
+                byte_limit: maximum number of bytes of all entries on the cache,
+                            or 'None' for no limit.
+                lifetime: number of seconds before an entry that has not been
+                          accessed expires, or 'None' if entries do not expire.
+        """
+        self._path = path
+        self._entry_limit = entry_limit
+        self._byte_limit = byte_limit
+        self._lifetime = lifetime
+        self._last_purge = 0
+        # usage counters of this process
+        self._counters_lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+
+
+    def __getstate__(self):
+        """
+            Returns a picklable object with class information for
+            reconstructing the instance.
+        """
+        # avoid attempting to pickle unpickleable lock when serializing
+        a_dict = dict(self.__dict__)
+        del a_dict['_counters_lock']
+        return a_dict
+
+
+    def __setstate__(self, a_dict):
+        """
+            Reconfigures the instance from the object specified in the parameter.
+        """
+        # in the deserialized output, the lock object is created anew
+        self.__dict__.update(a_dict)
+        self._counters_lock = Lock()
+
+
+    def _get_base_fname(self, key):
+        """
+            Gets the path of the files of an entry, without extension.
+            Arguments:
+                key: ID of the data.
+            Returns:
+                A file path.
+        """
+        return os.path.join(self._path, md5(repr(key).encode('utf-8')).hexdigest())
+
+
+    def _find_data_fname(self, base_fname):
+        """
+            Finds the data file of an entry.
+            Arguments:
+                base_fname: path of the files of the entry, without extension.
+            Returns:
+                The path to the data file, or 'None' if it does not exist.
+        """
+        for ext in self.DATA_EXTS:
+            if os.path.isfile(base_fname + ext):
+                return base_fname + ext
+        return None
+
+
+    def _list_entries(self):
+        """
+            Lists the entries in the cache folder.
+            Returns:
+                A list of tuples (base file name, data file name, size in bytes,
+                last access time), for all complete entries.
+        """
+        entries = []
+        for fname in os.listdir(self._path):
+            (base, ext) = os.path.splitext(fname)
+            if ext not in self.DATA_EXTS:
+                continue
+            data_fname = os.path.join(self._path, fname)
+            try:
+                stat = os.stat(data_fname)
+            except OSError:
+                # deleted by another process in the meantime
+                continue
+            entries.append((os.path.join(self._path, base), data_fname, stat.st_size, stat.st_mtime))
+        return entries
+
+
+    def _remove_entry(self, base_fname):
+        """
+            Removes the files of an entry.
+            Arguments:
+                base_fname: path of the files of the entry, without extension.
+        """
+        for ext in self.DATA_EXTS + (self.KEY_EXT,):
+            try:
+                os.remove(base_fname + ext)
+            except OSError:
+                pass
+
+
+    def purge_old_data(self, lock=True, keep=None):
+        """
+            Clears all data which are expired or above the storage limits.
+            Arguments:
+                lock: kept for compatibility with MaxSizeCache. Files are
+                      replaced atomically, so no lock is needed.
+                keep: path of the files of an entry, without extension, which
+                      must not be evicted (e.g. the entry just added).
+        """
+        self._last_purge = time()
+        entries = self._list_entries()
+        now = time()
+        if self._lifetime is not None:
+            for entry in [entry for entry in entries if now - entry[3] > self._lifetime]:
+                self._remove_entry(entry[0])
+                entries.remove(entry)
+        # least recently used first, and the entry to keep last
+        entries.sort(key=lambda entry: (entry[0] == keep, entry[3]))
+        total_bytes = sum(entry[2] for entry in entries)
+        while entries and ((self._entry_limit is not None and len(entries) > self._entry_limit) or
+                           (self._byte_limit is not None and total_bytes > self._byte_limit)):
+            if entries[0][0] == keep:
+                break
+            entry = entries.pop(0)
+            self._remove_entry(entry[0])
+            total_bytes -= entry[2]
+            with self._counters_lock:
+                self._evictions += 1
+
+
+    def _purge_if_needed(self, keep=None):
+        """
+            Purges old data, unless it has been done recently and no limits are set.
+            Arguments:
+                keep: path of the files of an entry, without extension, which
+                      must not be evicted.
+        """
+        if (self._entry_limit is not None or self._byte_limit is not None or
+                time() - self._last_purge > PURGE_INTERVAL):
+            self.purge_old_data(keep=keep)
+
+
+    def delete_data(self, key):
+        """
+            Deletes the data associated with the specified key.
+            Arguments:
+                key: ID of data to be deleted
+        """
+        self._remove_entry(self._get_base_fname(key))
+
+
+    def delete_data_partial_tuple(self, partial_tuple):
+        """
+            Deletes the specified tuple from the cache. Note the
+            tuple is deleted from all entries.
+            Arguments:
+                partial_tuple: tuple to be searched and deleted from the
+                               cache.
+        """
+        for (key, base_fname) in self.keys():
+            if isinstance(key, tuple) and partial_tuple == key[:len(partial_tuple)]:
+                self._remove_entry(base_fname)
+
+
+    def keys(self):
+        """
+            Lists the keys stored in the cache.
+            Returns:
+                A list of tuples (key, path of the files of the entry without extension).
+        """
+        keys = []
+        for (base_fname, data_fname, size, mtime) in self._list_entries():
+            try:
+                with open(base_fname + self.KEY_EXT, 'rb') as kfile:
+                    keys.append((pickle.load(kfile), base_fname))
+            except Exception:
+                # incomplete or deleted entry
+                continue
+        return keys
+
+
+    def clear_cache(self):
+        """ Clears up the entire cache """
+        for (base_fname, data_fname, size, mtime) in self._list_entries():
+            self._remove_entry(base_fname)
+
+
+    def get_data(self, key):
+        """
+            Retrieves the data associated with the specified key.
+            Arguments:
+                key: ID of data to be retrieved.
+            Returns:
+                Data associated to the key, or 'None' if the key
+                is not found in the cache.
+        """
+        data = None
+        data_fname = self._find_data_fname(self._get_base_fname(key))
+        if data_fname:
+            try:
+                if self._lifetime is not None and time() - os.path.getmtime(data_fname) > self._lifetime:
+                    raise OSError('Expired entry')
+                if data_fname.endswith('.ranklist'):
+                    # files in use cannot be deleted in Windows, so do not map them
+                    data = rank_list.RankList.load(data_fname, use_mmap=(os.name != 'nt'))
+                else:
+                    with open(data_fname, 'rb') as dfile:
+                        data = pickle.load(dfile)
+                # update the access time used for the expiry and eviction
+                os.utime(data_fname, None)
+            except Exception:
+                # expired, or deleted by another process in the meantime
+                data = None
+
+        with self._counters_lock:
+            if data is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+
+        return data
+
+
+    def add_data(self, data, key):
+        """
+            Adds data to the cache and associates it with the specified key.
+            If necessary, purges old data to make room for the new entry.
+            Arguments:
+                key: ID of data to be stored.
+                data: Data to be stored in the cache
+        """
+        base_fname = self._get_base_fname(key)
+        if isinstance(data, rank_list.RankList):
+            data.save(base_fname + '.ranklist')
+            stale_ext = '.pickle'
+        else:
+            _atomic_write(base_fname + '.pickle', pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+            stale_ext = '.ranklist'
+        try:
+            os.remove(base_fname + stale_ext)
+        except OSError:
+            pass
+        _atomic_write(base_fname + self.KEY_EXT, pickle.dumps(key, pickle.HIGHEST_PROTOCOL))
+        self._purge_if_needed(keep=base_fname)
+
+
+    def get_stats(self):
+        """
+            Gets the usage counters of the cache.
+            Returns:
+                A dictionary with the number of entries ('entries'), their
+                size in bytes ('bytes'), the limits of the cache
+                ('entry_limit', 'byte_limit') and the number of cache
+                hits ('hits'), misses ('misses') and evictions ('evictions')
+                in this process.
+        """
+        entries = self._list_entries()
+        with self._counters_lock:
+            return {'entries': len(entries),
+                    'bytes': sum(entry[2] for entry in entries),
+                    'entry_limit': self._entry_limit,
+                    'byte_limit': self._byte_limit,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions}
+
+
+# ----------------------------------
+## Shared File Session Cache Class
+# ----------------------------------
+
+class SharedFileSessionCache(object):
+    """
+        Cache for storing generic key-value data for a time-limited session,
+        in a folder shared by several processes of the same host.
+
+        It provides the same interface as SessionCache. The data of each
+        session is stored as a single entry of a SharedFileCache. Changes to
+        a session are serialized between processes with a file lock, when
+        the platform supports it.
+    """
+
+    def __init__(self, path, session_lifetime=1200):
+        """
+            Initializes the cache.
+            Arguments:
+                path: folder where the sessions are stored.
+                session_lifetime: number of seconds before a cache entry
+                                  expires. The default is 20 minutes.
+        """
+        self._file_cache = SharedFileCache(path, lifetime=session_lifetime)
+        self._lock_fname = os.path.join(path, '.lock')
+
+
+    @contextmanager
+    def _sessions_lock(self):
+        """ Context manager for exclusive access to the sessions """
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_fname, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+    def purge_old_sessions(self, lock=True):
+        """
+            Clears all sessions which haven't been accessed recently.
+            Arguments:
+                lock: kept for compatibility with SessionCache.
+        """
+        self._file_cache.purge_old_data()
+
+
+    def delete_session(self, ses_id):
+        """
+            Deletes the data associated with the specified session.
+            Arguments:
+                ses_id: ID of the session
+        """
+        with self._sessions_lock():
+            self._file_cache.delete_data(ses_id)
+
+
+    def delete_data(self, ses_id, key):
+        """
+            Deletes the data associated with the specified key within a
+            session.
+            Arguments:
+                key: ID of data to be deleted within the session
+                ses_id: ID of the session
+        """
+        with self._sessions_lock():
+            data = self._file_cache.get_data(ses_id)
+            if data is not None and key in data:
+                del data[key]
+                self._file_cache.add_data(data, ses_id)
+
+
+    def delete_data_partial_tuple(self, ses_id, partial_tuple):
+        """
+            Deletes the specified tuple from the specified session. Note the
+            tuple is deleted from all entries in the session.
+            Arguments:
+                ses_id: ID of the session
+                partial_tuple: tuple to be searched and deleted
+        """
+        with self._sessions_lock():
+            data = self._file_cache.get_data(ses_id)
+            if data is not None:
+                data = dict((key, item) for (key, item) in data.items()
+                            if not partial_tuple == key[:len(partial_tuple)])
+                self._file_cache.add_data(data, ses_id)
+
+
+    def get_data(self, ses_id, key=None):
+        """
+            Retrieves the data associated with a session and a key.
+            Arguments:
+                ses_id: ID of the session
+                key: ID of data to be retrieved within the session.
+            Returns:
+                Data associated to the key, or 'None' if the key
+                is not found in the session.
+        """
+        data = self._file_cache.get_data(ses_id)
+        if data is not None and key:
+            return data.get(key, None)
+        return data
+
+
+    def delete_data_unknown_session(self, data, key):
+        """
+            Searches for a data value associated with a key within all sessions
+            and deletes each session where an exact match is found
+            Arguments:
+                data: data value to search
+                key: ID associated to the data to be searched.
+        """
+        with self._sessions_lock():
+            for (ses_id, base_fname) in self._file_cache.keys():
+                ses_data = self._file_cache.get_data(ses_id)
+                if ses_data and key and key in ses_data:
+                    if any(data == item for (key_, item) in ses_data[key].items()):
+                        self._file_cache.delete_data(ses_id)
+
+
+    def add_data(self, data, ses_id, key):
+        """
+            Adds data to a session and associates it with the specified key.
+            Arguments:
+                ses_id: ID of the session
+                key: ID of data to be stored.
+                data: Data to be stored in the cache
+        """
+        with self._sessions_lock():
+            ses_data = self._file_cache.get_data(ses_id)
+            if ses_data is None:
+                ses_data = {}
+            ses_data[key] = data
+            self._file_cache.add_data(ses_data, ses_id)
+
+
+    def clear_all_sessions(self):
+        """ Clears up the entire cache """
+        with self._sessions_lock():
+            self._file_cache.clear_cache()
+
+
+def _atomic_write(fname, content):
+    """
+        Writes a file atomically, through a temporary file in the same folder.
+        Arguments:
+            fname: Full path to the file.
+            content: bytes to write.
+    """
+    (fd, tmp_fname) = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_fname, fname)
+    except Exception:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
@@ -105,6 +105,22 @@ class CompDataCache(session_cache_specializations.SessionExcludeListCache):
         return False
 
 
+    def has_classifier(self, query, user_ses_id=None):
+        """
+            Checks whether the classifier of the specified query has been
+            saved to a local file and can be loaded, i.e., whether the query
+            can be executed without computing any features or training.
+            Arguments:
+                query: query in dictionary form.
+                user_ses_id: user session id
+            Returns:
+                True if the classifier can be loaded, False otherwise.
+        """
+        if self.disable_cache or self.query_in_exclude_list(query, ses_id=user_ses_id):
+            return False
+        return os.path.isfile(self._get_classifier_fname(query))
+
+
     def load_classifier(self, query, **kwargs):
         """
             Loads the classifier of the specified query from a local file,
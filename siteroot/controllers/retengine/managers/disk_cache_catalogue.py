@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import os
+import time
+import json
+import sqlite3
+from threading import Lock
+
+from retengine.models import errors, opts
+from retengine.utils import tag_utils
+
+# name of the catalogue file, stored in the folder of the ranking lists
+CATALOGUE_FNAME = '.catalogue.sqlite3'
+
+class DiskCacheCatalogue(object):
+    """
+        Persistent index of the ranking lists stored in the disk cache.
+
+        It keeps one entry per cached (dataset, query) pair, with the engine,
+        dataset, query type and, for text queries, the query string, so that
+        the disk cache can be inspected without listing and decoding the whole
+        folder of ranking lists. The index is stored in a SQLite database in
+        the same folder, so it is shared by all the processes of the frontend.
+
+        If the database does not exist (e.g. the first time the frontend is run
+        after an upgrade, or after the folder has been cleared), it is rebuilt
+        by listing the folder once.
+
+        The database also keeps an access log with the number of hits and the
+        time of the last access of each query, including queries with
+        predefined ranking lists, which is used to warm up the memory cache
+        when the frontend starts.
+    """
+
+    def __init__(self, ranklistpath, engine, file_extensions):
+        """
+            Initializes the catalogue.
+            Arguments:
+                ranklistpath: Path to folder with ranking lists
+                engine: name of the engine the ranking lists belong to
+                file_extensions: extensions of the ranking list files, used
+                                 when the catalogue is rebuilt
+        """
+        self.ranklistpath = ranklistpath
+        self.engine = engine
+        self.file_extensions = file_extensions
+        self._dbpath = os.path.join(ranklistpath, CATALOGUE_FNAME)
+        # serializes the (re)creation of the database within this process
+        self._init_lock = Lock()
+        # whether the tables have been created, in case the database was
+        # created by a previous version of the frontend
+        self._schema_ready = False
+
+
+    def __getstate__(self):
+        """
+            Returns a picklable object with class information for
+            reconstructing the instance.
+        """
+        # avoid attempting to pickle unpickleable lock when serializing
+        a_dict = dict(self.__dict__)
+        del a_dict['_init_lock']
+        return a_dict
+
+
+    def __setstate__(self, a_dict):
+        """
+            Reconfigures the instance from the object specified in the parameter.
+        """
+        # in the deserialized output, the lock object is created anew
+        self.__dict__.update(a_dict)
+        self._init_lock = Lock()
+        self._schema_ready = False
+
+
+    def _connect(self):
+        """
+            Opens a connection to the database, creating and filling it if
+            it does not exist. A new connection is used for each operation,
+            as SQLite connections cannot be shared between threads.
+            Returns:
+                A sqlite3.Connection object.
+        """
+        with self._init_lock:
+            is_new = not os.path.isfile(self._dbpath)
+            if is_new:
+                try:
+                    os.makedirs(self.ranklistpath)
+                except OSError:
+                    pass
+            conn = sqlite3.connect(self._dbpath, timeout=30)
+            if is_new or not self._schema_ready:
+                self._create_schema(conn)
+                self._schema_ready = True
+            if is_new:
+                self._fill_from_folder(conn)
+        return conn
+
+
+    def _create_schema(self, conn):
+        """
+            Creates the tables of the database.
+            Arguments:
+                conn: connection to the database
+        """
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'dsetname TEXT NOT NULL, '
+                         'strid TEXT NOT NULL, '
+                         'engine TEXT NOT NULL, '
+                         'qtype TEXT NOT NULL, '
+                         'querystr TEXT, '
+                         'PRIMARY KEY (dsetname, strid))')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_strid ON entries (strid)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_querystr ON entries (qtype, querystr)')
+            conn.execute('CREATE TABLE IF NOT EXISTS accesses ('
+                         'dsetname TEXT NOT NULL, '
+                         'strid TEXT NOT NULL, '
+                         'qtype TEXT NOT NULL, '
+                         'qdef TEXT NOT NULL, '
+                         'hits INTEGER NOT NULL, '
+                         'last_access REAL NOT NULL, '
+                         'PRIMARY KEY (dsetname, strid))')
+
+
+    def _fill_from_folder(self, conn):
+        """
+            Adds to the database an entry for every ranking list file in the folder.
+            Arguments:
+                conn: connection to the database
+        """
+        rows = []
+        if os.path.exists(self.ranklistpath):
+            for rankfile in os.listdir(self.ranklistpath):
+                (rankfile, rankfileext) = os.path.splitext(rankfile)
+                if rankfileext not in self.file_extensions:
+                    continue
+                try:
+                    (dsetname, strid) = rankfile.split('___', 1)
+                except ValueError:
+                    print ('Invalid filename for cached query: %s' % rankfile)
+                    continue
+                rows.append(self._make_row(dsetname, strid))
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+        print ('Disk cache catalogue of %s rebuilt with %d entries' % (self.engine, len(rows)))
+
+
+    def _make_row(self, dsetname, strid):
+        """
+            Builds the row of the database for a ranking list.
+            Arguments:
+                dsetname: name of the dataset
+                strid: string id of the query (see tag_utils.get_query_strid)
+            Returns:
+                A tuple with the values of the row.
+        """
+        qtype = strid.split('__', 1)[0]
+        try:
+            (querystr, qtype) = tag_utils.decode_query_strid(strid)
+        except errors.StrIdDecodeError:
+            querystr = None
+        return (dsetname, strid, self.engine, qtype, querystr)
+
+
+    def add(self, dsetname, strid):
+        """
+            Adds a ranking list to the catalogue.
+            Arguments:
+                dsetname: name of the dataset
+                strid: string id of the query (see tag_utils.get_query_strid)
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                             self._make_row(dsetname, strid))
+        finally:
+            conn.close()
+
+
+    def remove(self, strid, dsetname=None):
+        """
+            Removes a ranking list from the catalogue.
+            Arguments:
+                strid: string id of the query (see tag_utils.get_query_strid)
+                dsetname: name of the dataset. If 'None', the entries of
+                          the query for all datasets are removed.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                if dsetname is None:
+                    conn.execute('DELETE FROM entries WHERE strid = ?', (strid,))
+                    conn.execute('DELETE FROM accesses WHERE strid = ?', (strid,))
+                else:
+                    conn.execute('DELETE FROM entries WHERE dsetname = ? AND strid = ?', (dsetname, strid))
+                    conn.execute('DELETE FROM accesses WHERE dsetname = ? AND strid = ?', (dsetname, strid))
+        finally:
+            conn.close()
+
+
+    def get_datasets(self, strid):
+        """
+            Gets the datasets for which a query is in the catalogue.
+            Arguments:
+                strid: string id of the query (see tag_utils.get_query_strid)
+            Returns:
+                A list of dataset names.
+        """
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute('SELECT dsetname FROM entries WHERE strid = ?', (strid,))]
+        finally:
+            conn.close()
+
+
+    def get_text_querystrs(self):
+        """
+            Gets the query strings of all text queries in the catalogue.
+            Returns:
+                A list with one query string per cached (dataset, query)
+                pair, sorted alphabetically.
+        """
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute('SELECT querystr FROM entries '
+                                                   'WHERE qtype = ? AND querystr IS NOT NULL '
+                                                   'ORDER BY querystr', (opts.Qtypes.text,))]
+        finally:
+            conn.close()
+
+
+    def record_accesses(self, accesses):
+        """
+            Adds a batch of accesses to the access log.
+            Arguments:
+                accesses: dictionary mapping (dsetname, strid) tuples to a
+                          tuple (qtype, qdef, hits, last_access), where
+                          'qdef' is the query definition, 'hits' the number of
+                          accesses since the last batch and 'last_access' the
+                          time of the most recent access, in seconds since
+                          the epoch.
+        """
+        rows = [(dsetname, strid, qtype, json.dumps(qdef), hits, last_access)
+                for ((dsetname, strid), (qtype, qdef, hits, last_access)) in accesses.items()]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO accesses VALUES (?, ?, ?, ?, 0, 0)',
+                                 [row[:4] for row in rows])
+                conn.executemany('UPDATE accesses SET hits = hits + ?, last_access = MAX(last_access, ?) '
+                                 'WHERE dsetname = ? AND strid = ?',
+                                 [(row[4], row[5], row[0], row[1]) for row in rows])
+        finally:
+            conn.close()
+
+
+    def get_most_used(self, limit, half_life=7*24*3600):
+        """
+            Gets the most used queries according to the access log. The number
+            of hits of each query is weighted by the time since its last access,
+            so that queries that were popular a long time ago are ranked lower.
+            Arguments:
+                limit: maximum number of queries to return.
+                half_life: number of seconds after which the weight of the hits
+                           of a query that has not been accessed is halved.
+            Returns:
+                A list of tuples (dsetname, qtype, qdef), most used first.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT dsetname, qtype, qdef, hits, last_access FROM accesses').fetchall()
+        finally:
+            conn.close()
+        now = time.time()
+        rows.sort(key=lambda row: row[3] * 0.5 ** (max(0.0, now - row[4]) / half_life), reverse=True)
+        return [(dsetname, qtype, json.loads(qdef)) for (dsetname, qtype, qdef, hits, last_access) in rows[:limit]]
+
+
+    def rebuild(self):
+        """
+            Discards the entries of the catalogue and rebuilds them from the files
+            in the folder. The access log is kept.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM entries')
+            self._fill_from_folder(conn)
+        finally:
+            conn.close()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
+import uuid
 from hashlib import md5
 from time import time as unix_time
 
-from retengine.managers.base_caches import session_cache
+from retengine.managers.base_caches import session_cache, shared_cache
 
 #
 # Cache Inheritance Hierarchy:
@@ -23,14 +24,20 @@ class QueryKeyCache(object):
         It uses an internal SessionCache object to store the keys.
     """
 
-    def __init__(self, session_lifetime=900):
+    def __init__(self, session_lifetime=900, shared_path=None):
         """
             Initializes the cache.
             Arguments:
                 session_lifetime: number of seconds before a cache entry
                                   expires. The default is 15 minutes.
+                shared_path: folder for storing the cache so that it is shared
+                             with other processes. The default is 'None', which
+                             keeps the cache in the memory of this process.
         """
-        self._session_cache = session_cache.SessionCache(session_lifetime)
+        if shared_path:
+            self._session_cache = shared_cache.SharedFileSessionCache(shared_path, session_lifetime)
+        else:
+            self._session_cache = session_cache.SessionCache(session_lifetime)
 
 
     def delete_text_query_unknown_session(self, query_text):
@@ -52,7 +59,8 @@ class QueryKeyCache(object):
             Returns:
                 The generated ID.
         """
-        query_ses_id = md5( str(unix_time()).encode('utf-8') ).hexdigest()
+        # include a random part, as several processes might generate an ID at the same time
+        query_ses_id = md5( (str(unix_time()) + uuid.uuid4().hex).encode('utf-8') ).hexdigest()
 
         self._session_cache.add_data(query, query_ses_id, "query")
         self._session_cache.add_data(None, query_ses_id, "backend_qid")
@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 
+import time
+from threading import Lock, Event, Thread, Condition
+
 from retengine.models import opts, query_data, param_sets, errors
 from retengine import query_translations
 from retengine.engine.visor_engine import VisorEngine
+from retengine.managers.query_scheduler import QueryScheduler
+from retengine.utils.single_flight import SingleFlight
 
-# initialise manager to create new shared memory area for the retrieval
-from multiprocessing import Manager
-manager = Manager()
+# the multiprocessing manager is only started if the status of the queries
+# needs to be shared with other processes (see QueryWorker)
+_manager = None
+_manager_lock = Lock()
+
+def get_manager():
+    """
+        Gets the multiprocessing manager used to share the status of the
+        queries between processes, starting it on first use.
+        Returns:
+            A multiprocessing.Manager instance.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            from multiprocessing import Manager
+            _manager = Manager()
+        return _manager
 
 # for pickling of visor_engine method prior to sending to worker pool
 def call_it(instance, name, args=(), kwargs=None):
@@ -15,6 +35,115 @@ def call_it(instance, name, args=(), kwargs=None):
         kwargs = {}
     return getattr(instance, name)(*args, **kwargs)
 
+
+# fields of the shared status of a query, with their initial values
+QUERY_VARS_DEFAULTS = (
+    ('state', opts.States.processing),
+    ('postrainimg_paths', []),
+    ('curatedtrainimgs_paths', []),
+    ('negtrainimg_count', 0),
+    ('exectime_processing', 0.0),
+    ('exectime_training', 0.0),
+    ('exectime_ranking', 0.0),
+    ('err_msg', ''),
+    ('featcomp_total', 0),
+    ('featcomp_done', 0),
+    ('featcomp_failed', 0),
+    ('cancel_requested', False),
+    ('queue_position', 0),
+)
+
+# priority of the queries whose type is not in the 'query_priorities' option
+DEFAULT_QUERY_PRIORITY = 1
+# number of seconds between checks of the status of a query when waiting for
+# it to change, if the status is kept in a multiprocessing Manager
+STATUS_POLL_INTERVAL = 0.25
+
+
+def get_progress_key(values):
+    """
+        Gets the part of the status of a query shown to the user while the
+        query is running. The status is said to change when this key changes.
+        Arguments:
+            values: dictionary with the fields of the status of a query.
+        Returns:
+            A tuple with the state, the number of training images and the
+            position in the queue of the query.
+    """
+    return (values['state'],
+            len(values['postrainimg_paths']) + len(values['curatedtrainimgs_paths']),
+            values['queue_position'])
+
+
+class QueryVars(object):
+    """
+        In-process holder of the variables shared between a QueryWorker and
+        the thread executing its query.
+        It can be used in place of a multiprocessing.Manager Namespace when
+        the query is executed by a thread of the same process, without
+        the cost of contacting the manager process on every access.
+        Threads can also wait for the fields to change (see wait_for), as
+        every change is notified.
+    """
+
+    __slots__ = ['_lock', '_changed'] + [field for (field, default) in QUERY_VARS_DEFAULTS]
+
+    def __init__(self):
+        """ Initializes all fields to their default value """
+        object.__setattr__(self, '_lock', Lock())
+        object.__setattr__(self, '_changed', Condition(self._lock))
+        for (field, default) in QUERY_VARS_DEFAULTS:
+            # copy lists to avoid sharing them between instances
+            object.__setattr__(self, field, list(default) if isinstance(default, list) else default)
+
+
+    def __setattr__(self, name, value):
+        """ Sets the value of a field while holding the lock, and notifies the change """
+        with self._lock:
+            object.__setattr__(self, name, value)
+            self._changed.notify_all()
+
+
+    def _snapshot(self):
+        """
+            Copies all fields. The lock must be held by the caller.
+            Returns:
+                A dictionary with the value of every field.
+        """
+        snapshot = {}
+        for (field, default) in QUERY_VARS_DEFAULTS:
+            value = getattr(self, field)
+            snapshot[field] = list(value) if isinstance(value, list) else value
+        return snapshot
+
+
+    def to_dict(self):
+        """
+            Gets a consistent snapshot of all fields. Lists are copied, as
+            a Manager Namespace would do, so that callers can modify them.
+            Returns:
+                A dictionary with the value of every field.
+        """
+        with self._lock:
+            return self._snapshot()
+
+
+    def wait_for(self, predicate, timeout=None):
+        """
+            Waits until the fields satisfy a condition.
+            Arguments:
+                predicate: function receiving a dictionary with the value of
+                           every field and returning True once the wait is over.
+                timeout: maximum number of seconds to wait, or None to wait
+                         indefinitely.
+            Returns:
+                A dictionary with the value of every field when the wait ended.
+        """
+        with self._lock:
+            self._changed.wait_for(lambda: predicate(self._snapshot()), timeout)
+            return self._snapshot()
+
+
 class QueryWorker(object):
     """
         Query worker manager for the VISOR frontend.
@@ -22,7 +151,7 @@ class QueryWorker(object):
         and de-serialization of the query results.
     """
 
-    def __init__(self, query, visor_engine, on_cache_exclude_list):
+    def __init__(self, query, visor_engine, on_cache_exclude_list, use_process_manager=False):
         """
             Initializes the worker.
             Arguments:
@@ -32,6 +161,10 @@ class QueryWorker(object):
                 on_cache_exclude_list: boolean indicating if the query in
                                        on the list of excluded cached text
                                        queries.
+                use_process_manager: boolean indicating whether to keep the
+                                     status of the query in a multiprocessing
+                                     Manager, so that it can be updated from
+                                     another process.
         """
         # get a new query ID
         # print ('Generating a new query ID...')
@@ -39,17 +172,22 @@ class QueryWorker(object):
         self.query = query
         self.qindex = query_translations.get_qhash(query)
         # print ('Initializing query namespace...')
-        self.shared_vars = manager.Namespace()
-
-        # configure initial shared memory namespace values
-        self.shared_vars.state = opts.States.processing
-        self.shared_vars.postrainimg_paths = []
-        self.shared_vars.curatedtrainimgs_paths = []
-        self.shared_vars.negtrainimg_count = 0
-        self.shared_vars.exectime_processing = 0.0
-        self.shared_vars.exectime_training = 0.0
-        self.shared_vars.exectime_ranking = 0.0
-        self.shared_vars.err_msg = ''
+        if use_process_manager:
+            self.shared_vars = get_manager().Namespace()
+            # configure initial shared memory namespace values
+            for (field, default) in QUERY_VARS_DEFAULTS:
+                setattr(self.shared_vars, field, default)
+        else:
+            self.shared_vars = QueryVars()
+        # set once the engine has finished processing the query
+        self.finished = Event()
+        # time of the last request of the status of the query, used to
+        # detect queries abandoned by the client (see QueryManager.reap_workers)
+        self.last_polled = time.time()
+
+    def on_finished(self, result=None):
+        """ Callback for the process pool, invoked when the query ends """
+        self.finished.set()
 
     def get_status(self):
         """
@@ -57,16 +195,52 @@ class QueryWorker(object):
             Returns:
                 A QueryStatus object.
         """
+        self.last_polled = time.time()
         return query_data.QueryStatus(qid=self.qid,
-                                  query=self.query,
-                                  state=self.shared_vars.state,
-                                  postrainimg_paths=self.shared_vars.postrainimg_paths,
-                                  curatedtrainimgs_paths=self.shared_vars.curatedtrainimgs_paths,
-                                  negtrainimg_count=self.shared_vars.negtrainimg_count,
-                                  exectime_processing=self.shared_vars.exectime_processing,
-                                  exectime_training=self.shared_vars.exectime_training,
-                                  exectime_ranking=self.shared_vars.exectime_ranking,
-                                  err_msg=self.shared_vars.err_msg)
+                                      query=self.query,
+                                      **self._get_shared_values())
+
+    def _get_shared_values(self):
+        """
+            Gets the fields of the status of the query.
+            Returns:
+                A dictionary with the value of every field.
+        """
+        if isinstance(self.shared_vars, QueryVars):
+            return self.shared_vars.to_dict()
+        return dict((field, getattr(self.shared_vars, field))
+                    for (field, default) in QUERY_VARS_DEFAULTS)
+
+    def wait_for_change(self, progress_key, timeout):
+        """
+            Waits until the status of the query shown to the user changes.
+            If the status is kept in a multiprocessing Manager, which cannot
+            notify the changes, the status is checked periodically instead.
+            Arguments:
+                progress_key: key of the last status known by the caller (see
+                              get_progress_key).
+                timeout: maximum number of seconds to wait.
+            Returns:
+                A QueryStatus object.
+        """
+        self.last_polled = time.time()
+        if isinstance(self.shared_vars, QueryVars):
+            self.shared_vars.wait_for(lambda values: get_progress_key(values) != progress_key, timeout)
+        else:
+            deadline = time.time() + timeout
+            while (time.time() < deadline and
+                   get_progress_key(self._get_shared_values()) == progress_key):
+                if self.finished.wait(min(STATUS_POLL_INTERVAL, max(0, deadline - time.time()))):
+                    break
+        return self.get_status()
+
+    def cancel(self):
+        """
+            Asks the engine to stop processing the query. The engine checks
+            the request between the stages of the query, so the worker is
+            only finished once the current stage is over.
+        """
+        self.shared_vars.cancel_requested = True
 
 
 
@@ -93,10 +267,34 @@ class QueryManager(object):
         """
         self.process_pool = process_pool
         self._proc_opts = proc_opts
+        self._visor_opts = visor_opts
         self.result_cache = result_cache
 
         # dictionary for keeping track of active workers
         self._workers = {}
+        # index of the active workers by query hash (qindex -> qid)
+        self._workers_by_qindex = {}
+        self._workers_lock = Lock()
+        # deduplicates concurrent starts of the same query
+        self._start_flight = SingleFlight()
+        # workers replaced or unregistered before their query finished, whose
+        # query ID must be released in the backend once they are done
+        self._detached_workers = []
+        # thread releasing the workers of abandoned and cancelled queries,
+        # started when the first worker is registered
+        self._reaper = None
+        self._reaper_stop = Event()
+
+        # limit the number of queries running at the same time, so that
+        # the pool of workers is not monopolized by slow queries
+        max_running = proc_opts.max_running_queries
+        if max_running is None:
+            # leave a worker free for the other tasks of the pool
+            max_running = max(1, proc_opts.pool_workers - 1)
+        engine_limits = dict((engine, visor_opts.engines_dict[engine]['max_running_queries'])
+                             for engine in visor_opts.engines_dict
+                             if visor_opts.engines_dict[engine].get('max_running_queries', None))
+        self._scheduler = QueryScheduler(process_pool, max_running, engine_limits)
 
         # initialize engine
         self._engine = VisorEngine(visor_opts, compdata_cache, self.result_cache)
@@ -111,18 +309,192 @@ class QueryManager(object):
                 A QueryWorker object
         """
         qindex = query_translations.get_qhash(query)
-        for key, value in self._workers.items():
-            if value.qindex == qindex:
-                return value
+        with self._workers_lock:
+            qid = self._workers_by_qindex.get(qindex, None)
+            if qid is not None:
+                return self._workers.get(qid, None)
 
         return None
 
 
+    def _add_worker(self, worker):
+        """
+            Registers a worker, replacing any previous worker for the same query.
+            Arguments:
+                worker: QueryWorker object
+        """
+        with self._workers_lock:
+            self._workers[worker.qid] = worker
+            self._workers_by_qindex[worker.qindex] = worker.qid
+            idle_timeout = self._proc_opts.worker_idle_timeout
+            if self._reaper is None and idle_timeout:
+                # check the workers several times per timeout period
+                interval = max(1.0, min(60.0, idle_timeout / 4.0))
+                self._reaper = Thread(target=self._run_reaper, args=(interval,))
+                self._reaper.daemon = True
+                self._reaper.start()
+
+
+    def _remove_worker(self, qid):
+        """
+            Unregisters a worker.
+            Arguments:
+                qid: query id of the worker
+        """
+        with self._workers_lock:
+            worker = self._workers.pop(qid, None)
+            # only remove the index entry if it still points to this worker
+            if worker and self._workers_by_qindex.get(worker.qindex, None) == qid:
+                del self._workers_by_qindex[worker.qindex]
+
+
+    def _release_worker(self, worker):
+        """
+            Releases the query ID of a worker in the backend, discarding the
+            results of its query, and unregisters the worker.
+            If the query is still being processed, it is cancelled first, and
+            the query ID is released once the engine is done with it.
+            Arguments:
+                worker: QueryWorker object
+        """
+        self._remove_worker(worker.qid)
+        if not worker.finished.is_set():
+            self._cancel_worker(worker)
+        if not worker.finished.is_set():
+            with self._workers_lock:
+                self._detached_workers.append(worker)
+            return
+        try:
+            self._engine.release_query_id(worker.query['engine'], worker.qid)
+        except Exception as e:
+            # the backend might have been restarted in the meantime
+            print (e)
+
+
+    def _cancel_worker(self, worker):
+        """
+            Cancels the query of a worker. If the query is still queued, it
+            is removed from the queue and finishes straight away.
+            Arguments:
+                worker: QueryWorker object
+        """
+        worker.cancel()
+        if self._scheduler.discard(worker):
+            worker.shared_vars.state = opts.States.cancelled
+            worker.shared_vars.queue_position = 0
+            worker.on_finished()
+
+
+    def _get_query_priority(self, query, user_ses_id):
+        """
+            Gets the priority of a query in the queue of queries waiting to run.
+            Queries which can be answered quickly, i.e., the ones of engines which
+            return results almost instantly and the ones with a saved classifier,
+            go first. Otherwise, the priority is given by the type of the query
+            (see the 'query_priorities' option).
+            Arguments:
+                query: query in dictionary form.
+                user_ses_id: user session id.
+            Returns:
+                The priority of the query. Lower values run first.
+        """
+        if self._visor_opts.engines_dict[query['engine']].get('skip_query_progress', False):
+            return 0
+        try:
+            if self._engine.compdata_cache.has_classifier(query, user_ses_id=user_ses_id):
+                return 0
+        except Exception as e:
+            print (e)
+        return self._proc_opts.query_priorities.get(query['qtype'], DEFAULT_QUERY_PRIORITY)
+
+
+    def _run_reaper(self, interval):
+        """
+            Body of the thread which periodically releases the workers
+            of abandoned and cancelled queries.
+            Arguments:
+                interval: number of seconds between checks.
+        """
+        while not self._reaper_stop.wait(interval):
+            try:
+                self.reap_workers()
+            except Exception as e:
+                print (e)
+
+
+    def reap_workers(self):
+        """
+            Releases the workers of the queries whose status has not been
+            requested for longer than the 'worker_idle_timeout' option, and
+            the workers of cancelled queries which have finished. Running
+            queries are cancelled, and their query ID is released in the
+            backend when they finish. The results of abandoned queries are
+            discarded.
+            Returns:
+                The number of workers released.
+        """
+        now = time.time()
+        idle_timeout = self._proc_opts.worker_idle_timeout
+        with self._workers_lock:
+            workers = list(self._workers.values())
+            detached = self._detached_workers
+            self._detached_workers = []
+
+        released = 0
+        for worker in workers:
+            abandoned = idle_timeout and (now - worker.last_polled) > idle_timeout
+            if worker.finished.is_set():
+                if abandoned or worker.shared_vars.cancel_requested:
+                    self._release_worker(worker)
+                    released += 1
+            elif abandoned:
+                print ('Cancelling abandoned Query ID %d' % worker.qid)
+                self._release_worker(worker)
+                released += 1
+
+        for worker in detached:
+            if worker.finished.is_set():
+                self._release_worker(worker)
+            else:
+                with self._workers_lock:
+                    self._detached_workers.append(worker)
+
+        return released
+
+
+    def stop_reaper(self):
+        """ Stops the thread releasing the workers of abandoned queries """
+        self._reaper_stop.set()
+        if self._reaper is not None:
+            self._reaper.join()
+
+
+    def get_metrics(self):
+        """
+            Gets some figures about the state of the manager.
+            Returns:
+                A dictionary with the number of active workers ('workers'),
+                the number of entries in the query hash index ('qindex_entries'),
+                the number of cancelled workers waiting for their query to
+                finish ('detached_workers') and the figures of the queue of
+                queries (see QueryScheduler.get_metrics).
+        """
+        with self._workers_lock:
+            metrics = {'workers': len(self._workers),
+                       'qindex_entries': len(self._workers_by_qindex),
+                       'detached_workers': len(self._detached_workers)}
+        metrics.update(self._scheduler.get_metrics())
+        return metrics
+
+
     def start_query(self, query,
                     user_ses_id=None, force_new_worker=False):
         """
             Starts a new worker and return its status (or if the worker
             already exists, return its status directly).
+            If too many queries are running, the query is queued and the
+            'queue_position' field of its status indicates how many queries
+            will run before it.
             Arguments:
                 query: query in dictionary form.
                 user_ses_id: user session id.
@@ -133,49 +505,98 @@ class QueryManager(object):
                 A QueryStatus object.
         """
         # start a query only if an existing query of the same name does not exist
-        worker = None
-        qindex = query_translations.get_qhash(query)
-        for key, value in self._workers.items():
-            if value.qindex == qindex:
-                if not force_new_worker:
-                    # return the already created worker
-                    worker = value
-                else:
-                    # if force_new_worker is True, create a new worker
-                    # for the same qhash and remove the previous one
-                    del self._workers[key]
-                break
+        worker = self._get_worker_from_definition(query)
+        if worker and not force_new_worker:
+            return worker.get_status()
 
+        # concurrent requests for the same query share a single worker
+        qindex = query_translations.get_qhash(query)
+        worker = self._start_flight.do(qindex, self._start_worker,
+                                       query, user_ses_id, force_new_worker)
         if not worker:
-            # determine if on cache exclude list
-            excl_query = self.result_cache[query['engine']].query_in_exclude_list(query, ses_id=user_ses_id)
-
-            # print ('Initializing query worker process...')
-            try:
-                worker = QueryWorker(query, self._engine, excl_query)
-                self._workers[worker.qid] = worker
-
-                # start the query
-                # print ('Launching query process...')
-                self.process_pool.apply_async(func=call_it,
-                                              args=(self._engine,
-                                                    'process',
-                                                    (query,
-                                                     worker.qid,
-                                                     worker.shared_vars,
-                                                     self._proc_opts,
-                                                     user_ses_id)
-                                                    )
-                                             )
-            except errors.QueryIdError:
-                # this exception is triggered by the constructor of QueryWorker
-                # if the backend cannot be contacted
-                return query_data.QueryStatus(state=opts.States.fatal_error_or_socket_timeout)
+            return query_data.QueryStatus(state=opts.States.fatal_error_or_socket_timeout)
 
         # return query status (including qid as a field)
         return worker.get_status()
 
 
+    def _start_worker(self, query, user_ses_id, force_new_worker):
+        """
+            Creates a new worker for a query and launches the query.
+            Only one thread at a time executes this function for the same
+            query (see start_query).
+            Arguments:
+                query: query in dictionary form.
+                user_ses_id: user session id.
+                force_new_worker: Boolean instructing this function to
+                                  mandatorily create a new worker for the
+                                  query.
+            Returns:
+                A QueryWorker object, or None if the backend could not
+                be contacted.
+        """
+        worker = self._get_worker_from_definition(query)
+        if worker:
+            if not force_new_worker:
+                # the worker was created while waiting for the flight
+                return worker
+            # if force_new_worker is True, create a new worker
+            # for the same qhash and remove the previous one
+            self._release_worker(worker)
+
+        # determine if on cache exclude list
+        excl_query = self.result_cache[query['engine']].query_in_exclude_list(query, ses_id=user_ses_id)
+
+        # print ('Initializing query worker process...')
+        try:
+            worker = QueryWorker(query, self._engine, excl_query,
+                                 self._proc_opts.use_process_manager)
+        except errors.QueryIdError:
+            # this exception is triggered by the constructor of QueryWorker
+            # if the backend cannot be contacted
+            return None
+
+        self._add_worker(worker)
+
+        # start the query, or queue it if too many queries are running
+        # print ('Launching query process...')
+        self._scheduler.submit(worker,
+                               self._get_query_priority(query, user_ses_id),
+                               call_it,
+                               (self._engine,
+                                'process',
+                                (query,
+                                 worker.qid,
+                                 worker.shared_vars,
+                                 self._proc_opts,
+                                 user_ses_id)
+                               ))
+        return worker
+
+
+    def wait_for_query_from_definition(self, query, timeout=None):
+        """
+            Waits until the worker associated to a query has finished, either
+            with its results ready or with an error. Only the worker of the
+            query is waited for, so that unrelated queries never block each
+            other. The collection of the results is not waited for, as it
+            might never happen if no session asks for them.
+            Arguments:
+                query: query in dictionary form.
+                timeout: maximum number of seconds to wait, or None to
+                         wait until the query finishes.
+            Returns:
+                The last QueryStatus object of the worker, or 'None' if there
+                is no worker associated to the query.
+        """
+        worker = self._get_worker_from_definition(query)
+        if not worker:
+            return None
+
+        worker.finished.wait(timeout)
+        return worker.get_status()
+
+
     def get_query_status(self, qid):
         """
             Returns status of the worker specified by a Query ID.
@@ -186,12 +607,80 @@ class QueryManager(object):
                 It will raise a QueryIdError if there is no worker
                 associated to the specified id.
         """
-        if qid in self._workers:
-            return self._workers[qid].get_status()
+        worker = self._workers.get(qid, None)
+        if worker:
+            return worker.get_status()
         else:
             raise errors.QueryIdError('Query ID %d is invalid' % qid)
 
 
+    def cancel_query(self, qid):
+        """
+            Cancels the query specified by a Query ID. If the query is still
+            being processed, the engine stops at the next stage of the query
+            and the worker is released afterwards. Otherwise, the worker is
+            released straight away, discarding its results.
+            Arguments:
+                qid: query id
+            Returns:
+                A QueryStatus object with the status of the query at the
+                time of the cancellation.
+                It will raise a QueryIdError if there is no worker
+                associated to the specified id.
+        """
+        worker = self._workers.get(qid, None)
+        if not worker:
+            raise errors.QueryIdError('Query ID %d is invalid' % qid)
+
+        self._cancel_worker(worker)
+        status = worker.get_status()
+        if worker.finished.is_set():
+            self._release_worker(worker)
+        return status
+
+
+    def wait_for_query_finished(self, qid, timeout=None):
+        """
+            Waits until the engine has finished processing the query of the
+            worker specified by a Query ID. The results are not collected.
+            Arguments:
+                qid: query id
+                timeout: maximum number of seconds to wait, or None to
+                         wait indefinitely.
+            Returns:
+                A QueryStatus object.
+                It will raise a QueryIdError if there is no worker
+                associated to the specified id.
+        """
+        worker = self._workers.get(qid, None)
+        if not worker:
+            raise errors.QueryIdError('Query ID %d is invalid' % qid)
+        worker.last_polled = time.time()
+        worker.finished.wait(timeout)
+        return worker.get_status()
+
+
+    def wait_for_query_status_change(self, qid, progress_key, timeout):
+        """
+            Waits until the status of the worker specified by a Query ID
+            differs from the one known by the caller. Used to answer status
+            requests only when there is something new to report.
+            Arguments:
+                qid: query id
+                progress_key: key of the last status known by the caller (see
+                              get_progress_key).
+                timeout: maximum number of seconds to wait.
+            Returns:
+                A QueryStatus object.
+                It will raise a QueryIdError if there is no worker
+                associated to the specified id.
+        """
+        worker = self._workers.get(qid, None)
+        if not worker:
+            raise errors.QueryIdError('Query ID %d is invalid' % qid)
+        return worker.wait_for_change(progress_key, timeout)
+
+
     def get_query_status_from_definition(self, query):
         """
             Returns the status of the query specified by a (query, qtype,
@@ -221,15 +710,19 @@ class QueryManager(object):
                 the path to an image but it might also contain information
                 such as the ROI, annotation type, etc.
                 It raises a ResultReadError if there is a problem getting
-                the query result.
+                the query result, or a QueryIdError if the worker has been
+                released in the meantime.
         """
         if not isinstance(status, query_data.QueryStatus):
             raise ValueError('status must be of type query_data.QueryStatus')
 
-        engine = self._workers[status.qid].query['engine']
+        worker = self._workers.get(status.qid, None)
+        if not worker:
+            raise errors.QueryIdError('Query ID %d is invalid' % status.qid)
+        engine = worker.query['engine']
         rlist = self._engine.release_query_id_and_return_results(engine, status.qid)
 
         # free worker
-        del self._workers[status.qid]
+        self._remove_worker(status.qid)
 
         return rlist
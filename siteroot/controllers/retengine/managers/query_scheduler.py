@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import bisect
+import itertools
+from threading import Lock
+
+# ----------------------------------
+## Query Scheduler Class
+# ----------------------------------
+
+class QueryScheduler(object):
+    """
+        Admission control for the queries executed in the pool of workers.
+
+        The pool of workers is shared with other tasks (metadata loading, disk
+        writes, etc.), so the number of queries running at the same time is
+        limited, both overall and for each engine. The queries that cannot run
+        straight away are kept in a queue ordered by priority (lower values
+        first) and then by arrival, so that cheap queries do not wait behind
+        slow ones. When a query finishes, the first queued query whose engine
+        has a free slot is launched.
+
+        The position of each queued query (1 for the next one to run, 0 once
+        it is running) is stored in the 'queue_position' field of the shared
+        variables of its worker.
+    """
+
+    def __init__(self, process_pool, max_running=None, engine_limits=None):
+        """
+            Initializes the scheduler.
+            Arguments:
+                process_pool: pool of workers where the queries are executed
+                max_running: maximum number of queries running at the same time,
+                             or None for no limit.
+                engine_limits: dictionary with the maximum number of queries of
+                               each engine running at the same time. Engines not
+                               in the dictionary are only bound by max_running.
+        """
+        self.process_pool = process_pool
+        self._max_running = max_running
+        self._engine_limits = engine_limits if engine_limits else {}
+        self._lock = Lock()
+        # queued queries as (priority, arrival, worker, func, args), in order
+        self._queue = []
+        self._arrivals = itertools.count()
+        # number of running queries of each engine
+        self._running = {}
+        self._total_running = 0
+
+
+    def _has_free_slot(self, engine):
+        """
+            Checks whether a query of an engine can be launched.
+            The lock must be held by the caller.
+            Arguments:
+                engine: engine of the query
+            Returns:
+                True if the query can be launched, False otherwise.
+        """
+        if self._max_running is not None and self._total_running >= self._max_running:
+            return False
+        limit = self._engine_limits.get(engine, None)
+        return limit is None or self._running.get(engine, 0) < limit
+
+
+    def _dispatch(self):
+        """
+            Removes from the queue the queries that can be launched, and
+            updates the position of the rest.
+            The lock must be held by the caller.
+            Returns:
+                A list with the entries of the queue to be launched.
+        """
+        to_launch = []
+        queue = []
+        for entry in self._queue:
+            engine = entry[2].query['engine']
+            if self._has_free_slot(engine):
+                self._running[engine] = self._running.get(engine, 0) + 1
+                self._total_running += 1
+                to_launch.append(entry)
+            else:
+                queue.append(entry)
+        if to_launch:
+            self._queue = queue
+            for (position, entry) in enumerate(self._queue):
+                entry[2].shared_vars.queue_position = position + 1
+        return to_launch
+
+
+    def _launch(self, entries):
+        """
+            Submits queries to the pool of workers.
+            Arguments:
+                entries: list of entries of the queue to be launched.
+        """
+        for (priority, arrival, worker, func, args) in entries:
+            worker.shared_vars.queue_position = 0
+
+            def on_done(result=None, worker=worker):
+                worker.on_finished(result)
+                self._task_done(worker.query['engine'])
+
+            self.process_pool.apply_async(func=func,
+                                          args=args,
+                                          callback=on_done,
+                                          error_callback=on_done
+                                         )
+
+
+    def _task_done(self, engine):
+        """
+            Frees the slot of a finished query and launches the queued
+            queries which can run now.
+            Arguments:
+                engine: engine of the finished query
+        """
+        with self._lock:
+            self._running[engine] -= 1
+            self._total_running -= 1
+            to_launch = self._dispatch()
+        self._launch(to_launch)
+
+
+    def submit(self, worker, priority, func, args):
+        """
+            Launches a query, or queues it if there are too many queries running.
+            Arguments:
+                worker: QueryWorker of the query. Its 'on_finished' method is
+                        called when the query finishes.
+                priority: priority of the query. Queries with lower values run first.
+                func: function executing the query in the pool of workers.
+                args: arguments of func.
+        """
+        entry = (priority, next(self._arrivals), worker, func, args)
+        with self._lock:
+            position = bisect.bisect(self._queue, entry[:2])
+            self._queue.insert(position, entry)
+            worker.shared_vars.queue_position = position + 1
+            for (idx, queued) in enumerate(self._queue[position + 1:]):
+                queued[2].shared_vars.queue_position = position + idx + 2
+            to_launch = self._dispatch()
+        self._launch(to_launch)
+
+
+    def discard(self, worker):
+        """
+            Removes a query from the queue, if it has not been launched yet.
+            Arguments:
+                worker: QueryWorker of the query.
+            Returns:
+                True if the query was in the queue, False otherwise.
+        """
+        with self._lock:
+            for (position, entry) in enumerate(self._queue):
+                if entry[2] is worker:
+                    del self._queue[position]
+                    for (idx, queued) in enumerate(self._queue[position:]):
+                        queued[2].shared_vars.queue_position = position + idx + 1
+                    return True
+        return False
+
+
+    def get_metrics(self):
+        """
+            Gets some figures about the state of the scheduler.
+            Returns:
+                A dictionary with the number of queued queries ('queued'), the
+                number of running queries ('running') and the number of running
+                queries of each engine ('running_per_engine').
+        """
+        with self._lock:
+            return {'queued': len(self._queue),
+                    'running': self._total_running,
+                    'running_per_engine': dict(self._running)}
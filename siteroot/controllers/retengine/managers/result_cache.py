@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 
 import os
+import time
 import string
+import atexit
 import msgpack
+from threading import Lock
 
-from retengine.utils import tag_utils
-from retengine.models import errors
+from retengine.utils import tag_utils, write_behind_queue
+from retengine.models import errors, rank_list
 from retengine.utils import fileutils
+from retengine.managers import disk_cache_catalogue
 from retengine.managers.base_caches import (session_cache_specializations,
                                            max_size_cache_specializations,
-                                           max_size_cache)
+                                           max_size_cache,
+                                           shared_cache)
 
 #
 # Cache Inheritance Hierarchy:
@@ -28,7 +33,7 @@ from retengine.managers.base_caches import (session_cache_specializations,
 #                                 --------------
 #
 #      mem cache provided by MaxSizeResultCache
-#          (stores results in memory indefinitely, up to last 100 results)
+#          (stores results in memory indefinitely, up to a maximum number of bytes)
 #      query_ses cache provided by SessionResultCache
 #          (stores results only for lifetime of query + 15 mins)
 #      disk cache managed directly
@@ -38,7 +43,12 @@ from retengine.managers.base_caches import (session_cache_specializations,
 #      which the cache to use is determined
 
 # can contain query_strid
-PATTERN_FNAME_RESULTS = '${dsetname}___${query_strid}.msgpack'
+PATTERN_FNAME_RESULTS = '${dsetname}___${query_strid}.ranklist'
+# previous format of the ranking list files, still supported for reading
+PATTERN_FNAME_RESULTS_MSGPACK = '${dsetname}___${query_strid}.msgpack'
+RANKLIST_FILE_EXTENSIONS = ('.ranklist', '.msgpack')
+# minimum number of seconds between writes of the access log to the catalogue
+ACCESS_LOG_FLUSH_INTERVAL = 30
 
 class ResultCache(session_cache_specializations.SessionExcludeListCache):
     """
@@ -46,7 +56,8 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
 
         All saving/loading of results can operate through three possible cache systems:
 
-          memory cache        - stores last N results to memory
+          memory cache        - stores most recently used results to memory,
+                                  up to an approximate number of bytes
           disk cache          - stores unlimited results to disk
           query session cache - stores result to memory over short-term (~15 mins)
                                   accessible only to callers specifying the same
@@ -83,7 +94,8 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
     # ----------------------------------
 
     def __init__(self, predefined_ranklistpath, ranklistpath, process_pool, enabled_caches=CacheCfg.all,
-                 enabled_excl_caches=CacheCfg.none):
+                 enabled_excl_caches=CacheCfg.none, mem_cache_max_bytes=256*1024*1024,
+                 shared_cache_dir=None, ranklist_codec=None):
         """
             Initializes the cache.
             Arguments:
@@ -94,25 +106,61 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
                                 It should be a valid CacheCfg value.
                 enabled_excl_caches: caches to use for queries on exclude list.
                                      It should be a valid CacheCfg value.
+                mem_cache_max_bytes: approximate maximum number of bytes used
+                                     by the memory cache.
+                shared_cache_dir: folder for storing the memory, query session
+                                  and exclude list caches so that they are shared
+                                  with other processes of the same host. If 'None',
+                                  they are kept in the memory of this process.
+                ranklist_codec: name of the codec used to compress the ranking
+                                lists saved to disk, or 'None' to save them
+                                uncompressed.
         """
         self.ranklistpath = ranklistpath
+        self.ranklist_codec = ranklist_codec
         self.predefined_ranklistpath = predefined_ranklistpath
 
-        # process pool for saving ranking lists in background
+        # process pool for multi-threading processing
         self.process_pool = process_pool
 
         self.enabled_caches = enabled_caches
         self.enabled_excl_caches = enabled_excl_caches
 
-        self._mem_cache = max_size_cache_specializations.MaxSizeResultCache(entry_limit=5)
-        self._query_ses_cache = session_cache_specializations.SessionResultCache()
+        shared_path = lambda name: os.path.join(shared_cache_dir, name) if shared_cache_dir else None
+
+        self._mem_cache = max_size_cache_specializations.MaxSizeResultCache(entry_limit=None,
+                                                                           byte_limit=mem_cache_max_bytes,
+                                                                           shared_path=shared_path('mem'))
+        self._query_ses_cache = session_cache_specializations.SessionResultCache(shared_path=shared_path('query_ses'))
 
         # following cache used to store query_ses_id -> query obj lookup
-        self._query_ses_id_cache = max_size_cache.MaxSizeCache()
+        if shared_cache_dir:
+            self._query_ses_id_cache = shared_cache.SharedFileCache(shared_path('query_ses_ids'), entry_limit=100)
+        else:
+            self._query_ses_id_cache = max_size_cache.MaxSizeCache()
 
         self._bg_worker = None
 
-        super(ResultCache, self).__init__()
+        # index of the ranking lists in the disk cache
+        self._catalogue = disk_cache_catalogue.DiskCacheCatalogue(ranklistpath,
+                                                                  os.path.basename(ranklistpath),
+                                                                  RANKLIST_FILE_EXTENSIONS)
+
+        # dedicated queue for saving ranking lists to disk in background,
+        # so that it does not compete with the queries for the process pool
+        self._persist_queue = self._create_persist_queue()
+        # make sure the pending lists are saved when the server stops
+        atexit.register(self.flush_to_disk)
+
+        # accesses to the ranking lists not yet written to the access log of the catalogue
+        self._pending_accesses = {}
+        self._last_access_flush = time.time()
+        self._access_lock = Lock()
+
+        # progress of the warm-up of the memory cache (see warm_up)
+        self._warmup_progress = {'state': 'idle', 'processed': 0, 'loaded': 0, 'total': 0, 'bytes': 0}
+
+        super(ResultCache, self).__init__(shared_path=shared_path('exclude_list'))
 
 
     def __getstate__(self):
@@ -123,6 +171,8 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
         # avoid attempting to pickle unpickleable worker pools when serializing
         a_dict = dict(self.__dict__)
         del a_dict['process_pool']
+        del a_dict['_persist_queue']
+        del a_dict['_access_lock']
         return a_dict
 
 
@@ -133,38 +183,85 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
         # in the deserialized output, process_pool is set to None
         self.__dict__.update(a_dict)
         self.process_pool = None
+        self._persist_queue = self._create_persist_queue()
+        self._access_lock = Lock()
+
+
+    def _create_persist_queue(self):
+        """
+            Creates the queue for saving ranking lists to disk in background.
+            Returns:
+                A WriteBehindQueue instance.
+        """
+        return write_behind_queue.WriteBehindQueue(self._save_results_to_disk,
+                                                   name='ResultCache-%s' % os.path.basename(self.ranklistpath))
+
+
+    def flush_to_disk(self, timeout=None):
+        """
+            Waits until all the ranking lists pending to be saved have been
+            written to disk, and writes the pending accesses to the access log.
+            Arguments:
+                timeout: maximum number of seconds to wait, or 'None' to wait
+                         until all lists are saved.
+            Returns:
+                True if all lists have been saved, False if the timeout expired.
+        """
+        self._flush_access_log()
+        return self._persist_queue.flush(timeout)
+
+
+    def _record_access(self, query):
+        """
+            Records an access to the results of a query in the access log,
+            which is used to decide which lists to load when warming up the
+            memory cache. The accesses are kept in memory and written to the
+            catalogue at most every ACCESS_LOG_FLUSH_INTERVAL seconds.
+            Arguments:
+                query: query in dictionary form.
+        """
+        now = time.time()
+        key = (query['dsetname'], tag_utils.get_query_strid(query))
+        with self._access_lock:
+            (qtype, qdef, hits, last_access) = self._pending_accesses.get(key, (query['qtype'], query['qdef'], 0, 0))
+            self._pending_accesses[key] = (qtype, qdef, hits + 1, now)
+            if now - self._last_access_flush < ACCESS_LOG_FLUSH_INTERVAL:
+                return
+        self._flush_access_log()
+
+
+    def _flush_access_log(self):
+        """ Writes the pending accesses to the access log of the catalogue """
+        with self._access_lock:
+            accesses = self._pending_accesses
+            self._pending_accesses = {}
+            self._last_access_flush = time.time()
+        if accesses:
+            try:
+                self._catalogue.record_accesses(accesses)
+            except Exception as e:
+                print ('Failed to update the access log: %s' % e)
 
 
     def get_all_disk_cached_text_querystrs(self, return_empty_list_if_cache_enabled=False):
         """
             Gets a list of all queries in the disk cache as query objects.
             ONLY qtype TEXT is supported (as other types are hashed).
+            The queries are read from the catalogue of the disk cache, instead
+            of listing the folder of ranking lists.
             Arguments:
                 return_empty_list_if_cache_enabled: Set to True to return an
                             empty list when the cache is enabled.
             Returns:
-                A list of queries, regardless of whether the disk cache is
-                enabled or not by default. This behaviour can be changed using
-                'return_empty_list_if_cache_enabled'.
+                A list of queries, sorted alphabetically, regardless of whether
+                the disk cache is enabled or not by default. This behaviour can
+                be changed using 'return_empty_list_if_cache_enabled'.
         """
         querystrs = []
 
         if (not return_empty_list_if_cache_enabled or
                 self.Caches.disk in self.enabled_caches):
-            if os.path.exists(self.ranklistpath):
-                rankfiles = os.listdir(self.ranklistpath)
-                for rankfile in rankfiles:
-                    try:
-                        rankfile, rankfileext = os.path.splitext(rankfile)
-                        dsetname, strid = rankfile.split('___', 2)
-                        querystr, qtype = tag_utils.decode_query_strid(strid)
-                    except errors.StrIdDecodeError:
-                        continue
-                    except ValueError:
-                        print ('Invalid filename for cached text query: %s' % rankfile)
-                        continue
-
-                    querystrs.append(querystr)
+            querystrs = self._catalogue.get_text_querystrs()
 
         return querystrs
 
@@ -215,6 +312,10 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
             rlist = self._query_ses_cache.get_results(query_ses_id, query)
             # print ('Retrieved from query session cache: %s' % (rlist is not None))
 
+        # keep track of the lists in the disk cache that are used most
+        if rlist and self.Caches.disk in ctxt_enabled_caches:
+            self._record_access(query)
+
         # finally, add query object to query session id cache
         # if it is not there already
         if query_ses_id:
@@ -266,13 +367,16 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
         ctxt_enabled_caches = self.enabled_caches if not excl_query \
             else self.enabled_excl_caches
 
+        # keep the results in compact form in the memory caches
+        rlist = rank_list.RankList.from_items(rlist)
+
         if self.Caches.mem in ctxt_enabled_caches:
             # save to memory cache first
             self._mem_cache.add_results(rlist, query)
         if self.Caches.disk in ctxt_enabled_caches:
-            # finally, save result to disk cache in background
-            self.process_pool.apply_async(func=self._save_results_to_disk,
-                                          args=(query,))
+            # finally, save result to disk cache in background. Repeated saves
+            # of the same list are coalesced by the queue
+            self._persist_queue.put(self._get_disk_fname(query), query, rlist)
         if self.Caches.query_ses in ctxt_enabled_caches and query_ses_id:
             # also save to query session cache if required
             self._query_ses_cache.add_results(rlist, query_ses_id, query)
@@ -302,30 +406,138 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
 
         # remove from disk cache
         if self.Caches.disk in caches:
+            # first, make sure pending saves do not write the results back
             if for_all_datasets:
-                cache_fname = self._get_disk_fname(query)
-                a_dir = os.path.dirname(cache_fname)
-                a_files = os.listdir(a_dir)
-                cache_fname = cache_fname.split(query['dsetname'])[-1]
+                suffix = self._get_disk_fname(query).split(query['dsetname'])[-1]
+                self._persist_queue.discard(lambda key: key.endswith(suffix))
+            else:
+                fname = self._get_disk_fname(query)
+                self._persist_queue.discard(lambda key: key == fname)
 
-                all_fnames = [os.path.join(a_dir, a_file) for a_file in a_files]
-                # just get fnames which conform to regular expression
-                fnames = [fname for fname in all_fnames if cache_fname in fname]
+            # the catalogue tells which datasets have results for the query
+            query_strid = tag_utils.get_query_strid(query)
+            if for_all_datasets:
+                dsetnames = set(self._catalogue.get_datasets(query_strid))
+                dsetnames.add(query['dsetname'])
+            else:
+                dsetnames = [query['dsetname']]
 
-                for fname in fnames:
+            for dsetname in dsetnames:
+                dset_query = dict(query, dsetname=dsetname)
+                for pattern in (PATTERN_FNAME_RESULTS, PATTERN_FNAME_RESULTS_MSGPACK):
+                    fname = self._get_disk_fname(dset_query, pattern)
                     if os.path.isfile(fname):
                         os.remove(fname)
-                        print ('REMOVED FILE: ' + fname)
-            else:
-                fname = self._get_disk_fname(query)
-                if os.path.isfile(fname):
-                    # print ('Removed ranking file from disk: %s' % fname)
-                    os.remove(fname)
+                        # print ('Removed ranking file from disk: %s' % fname)
+
+            self._catalogue.remove(query_strid, None if for_all_datasets else query['dsetname'])
 
         # remove from query session cache
         if self.Caches.query_ses in caches and query_ses_id:
             self._query_ses_cache.delete_results(query_ses_id, query)
 
+    def get_mem_cache_stats(self):
+        """
+            Gets the usage counters of the memory cache.
+            Returns:
+                A dictionary with the number of entries ('entries'), their
+                approximate size in bytes ('bytes'), the limits of the cache
+                ('entry_limit', 'byte_limit') and the number of cache
+                hits ('hits'), misses ('misses') and evictions ('evictions').
+        """
+        return self._mem_cache.get_stats()
+
+    def get_warmup_progress(self):
+        """
+            Gets the progress of the warm-up of the memory cache.
+            Returns:
+                A dictionary with the state of the warm-up ('state', which is
+                'idle', 'running' or 'done'), the number of lists to check
+                ('total'), the number of lists checked so far ('processed'), the
+                number of lists loaded ('loaded') and the number of bytes loaded
+                ('bytes').
+        """
+        return dict(self._warmup_progress)
+
+
+    def _get_predefined_queries(self):
+        """
+            Gets the queries with a predefined ranking list. Only text
+            queries can be obtained, as the query definition of other
+            queries cannot be decoded from the name of the file.
+            Returns:
+                A list of tuples (dsetname, qtype, qdef).
+        """
+        queries = []
+        if os.path.exists(self.predefined_ranklistpath):
+            for rankfile in sorted(os.listdir(self.predefined_ranklistpath)):
+                (rankfile, rankfileext) = os.path.splitext(rankfile)
+                if rankfileext not in RANKLIST_FILE_EXTENSIONS:
+                    continue
+                try:
+                    (dsetname, strid) = rankfile.split('___', 1)
+                    (querystr, qtype) = tag_utils.decode_query_strid(strid)
+                except (ValueError, errors.StrIdDecodeError):
+                    continue
+                queries.append((dsetname, qtype, querystr))
+        return queries
+
+
+    def warm_up(self, max_lists, max_bytes):
+        """
+            Loads into the memory cache the most used ranking lists, according
+            to the access log, followed by the predefined ranking lists, so that
+            the first users after a restart do not have to wait for them to be
+            read from disk. Memory-mapped lists are also read, so that they are
+            kept in memory by the operating system.
+            This can take a while, so it should be run in background.
+            Arguments:
+                max_lists: maximum number of most used lists to load,
+                           besides the predefined lists.
+                max_bytes: approximate maximum number of bytes to load.
+        """
+        if self.Caches.mem not in self.enabled_caches or self.Caches.disk not in self.enabled_caches:
+            return
+        self._warmup_progress = {'state': 'running', 'processed': 0, 'loaded': 0, 'total': 0, 'bytes': 0}
+        try:
+            candidates = self._catalogue.get_most_used(max_lists) + self._get_predefined_queries()
+        except Exception as e:
+            print (e)
+            candidates = []
+        engine = os.path.basename(self.ranklistpath)
+        queries = []
+        seen = set()
+        for (dsetname, qtype, qdef) in candidates:
+            query = {'qtype': qtype, 'qdef': qdef, 'dsetname': dsetname, 'engine': engine}
+            key = (dsetname, tag_utils.get_query_strid(query))
+            if key not in seen:
+                seen.add(key)
+                queries.append(query)
+        self._warmup_progress['total'] = len(queries)
+
+        total_bytes = 0
+        for query in queries:
+            self._warmup_progress['processed'] += 1
+            if self._mem_cache.get_results(query):
+                # e.g. already loaded by another process sharing the cache
+                continue
+            rlist = self._load_results_from_disk(query)
+            if not rlist:
+                continue
+            size = max(max_size_cache_specializations.estimate_rlist_size(rlist), rlist.preload())
+            if total_bytes + size > max_bytes:
+                # skip it, smaller lists might still fit
+                continue
+            total_bytes += size
+            self._mem_cache.add_results(rlist, query)
+            self._warmup_progress['loaded'] += 1
+            self._warmup_progress['bytes'] = total_bytes
+
+        self._warmup_progress['state'] = 'done'
+        print ('Memory cache of %s warmed up with %d lists (%d bytes)' % (engine,
+                                                                           self._warmup_progress['loaded'],
+                                                                           total_bytes))
+
     # ----------------------------------
     ## Clear caches
     # ----------------------------------
@@ -342,24 +554,30 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
         # clear session caches
         self.clear_all_sessions()
         self._query_ses_cache.clear_all_sessions()
-        # clear disk cache
-        fileutils.delete_directory_contents(self.ranklistpath, name_filter)
+        # clear disk cache, including the lists pending to be saved
+        self._persist_queue.discard(lambda key: name_filter is None or name_filter in key)
+        # keep the catalogue (and its journal), which also holds the access log,
+        # and might be open in other processes
+        fileutils.delete_directory_contents(self.ranklistpath, name_filter,
+                                            keep_prefixes=(disk_cache_catalogue.CATALOGUE_FNAME,))
+        self._catalogue.rebuild()
 
     # ----------------------------------
     ## Get paths and disk filenames
     # ----------------------------------
 
-    def _get_disk_fname(self, query):
+    def _get_disk_fname(self, query, pattern=PATTERN_FNAME_RESULTS):
         """
             Gets the full path and filename of the ranking file associated
             to the query.
             Arguments:
                 query: query in dictionary form.
+                pattern: pattern of the file name. By default, PATTERN_FNAME_RESULTS.
             Returns:
-                A file path where the file name follows PATTERN_FNAME_RESULTS.
+                A file path where the file name follows the specified pattern.
         """
         query_strid = tag_utils.get_query_strid(query)
-        fname_template = string.Template(PATTERN_FNAME_RESULTS)
+        fname_template = string.Template(pattern)
         fname = fname_template.substitute(query_strid=query_strid,
                                           dsetname=query['dsetname'])
         try:
@@ -375,28 +593,39 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
             Loads from a local ranking list file the results associated
             to the specified query. Pre-defined ranking list have priority over
             ranking list produced by the application.
+            Ranking list files in the binary format (see RankList.save) are
+            memory-mapped, so only the pages of results that are accessed
+            are read. Files in the previous msgpack format are read entirely.
             Arguments:
                 query: query in dictionary form.
             Returns:
-                The list of results associated to the query, or 'None' if
+                The RankList of results associated to the query, or 'None' if
                 it was not possible to read the file.
         """
         rlist = None
         fname = self._get_disk_fname(query)
-        predefined_fname = fname.replace(self.ranklistpath, self.predefined_ranklistpath)
-        if os.path.isfile(predefined_fname): # give priority to the predefined list
-            try:
-                with open(predefined_fname, 'rb') as rfile:
-                    rlist = msgpack.load(rfile, encoding='utf-8')
-            except Exception as e:
-                rlist = None
-                print (e)
-
-        if rlist == None:
-            if os.path.isfile(fname):
+        msgpack_fname = self._get_disk_fname(query, PATTERN_FNAME_RESULTS_MSGPACK)
+        # give priority to the predefined list
+        candidates = [(fname.replace(self.ranklistpath, self.predefined_ranklistpath), True),
+                      (msgpack_fname.replace(self.ranklistpath, self.predefined_ranklistpath), False),
+                      (fname, True),
+                      (msgpack_fname, False)]
+        for (candidate, is_ranklist) in candidates:
+            if candidate == fname:
+                # results not saved yet can be read from the persistence queue
+                pending = self._persist_queue.peek(fname)
+                if pending:
+                    rlist = rank_list.RankList.from_items(pending[1])
+                    break
+            if os.path.isfile(candidate):
                 try:
-                    with open(fname, 'rb') as rfile:
-                        rlist = msgpack.load(rfile, encoding='utf-8')
+                    if is_ranklist:
+                        # files in use cannot be deleted in Windows, so do not map them
+                        rlist = rank_list.RankList.load(candidate, use_mmap=(os.name != 'nt'))
+                    else:
+                        with open(candidate, 'rb') as rfile:
+                            rlist = rank_list.RankList.from_items(msgpack.load(rfile, encoding='utf-8'))
+                    break
                 except Exception as e:
                     rlist = None
                     print (e)
@@ -404,18 +633,25 @@ class ResultCache(session_cache_specializations.SessionExcludeListCache):
         return rlist
 
 
-    def _save_results_to_disk(self, query):
+    def _save_results_to_disk(self, query, rlist):
         """
             Saves the results of a query to a local ranking list file. If there is
             already a pre-defined ranking list associated to the query, the results
             are not saved so as to not overwrite the pre-defined list.
             Arguments:
                 query: query in dictionary form.
+                rlist: List of results associated to the query. It is captured
+                       when the save is enqueued, as it might have been evicted
+                       from the memory cache by the time this function runs.
         """
         fname = self._get_disk_fname(query)
-        predefined_fname = fname.replace(self.ranklistpath, self.predefined_ranklistpath)
-        if not os.path.isfile(predefined_fname): # only save it if there is no predefined list
-                                                 # associated to the same query
-            rlist = self._mem_cache.get_results(query)
-            with open(fname, 'wb') as rfile:
-                msgpack.dump(rlist, rfile)
+        msgpack_fname = self._get_disk_fname(query, PATTERN_FNAME_RESULTS_MSGPACK)
+        predefined_fnames = [a_fname.replace(self.ranklistpath, self.predefined_ranklistpath)
+                             for a_fname in (fname, msgpack_fname)]
+        # only save it if there is no predefined list associated to the same query
+        if not any(os.path.isfile(predefined_fname) for predefined_fname in predefined_fnames):
+            rank_list.RankList.from_items(rlist).save(fname, codec=self.ranklist_codec)
+            # remove the list in the previous format, if any, as it is now outdated
+            if os.path.isfile(msgpack_fname):
+                os.remove(msgpack_fname)
+            self._catalogue.add(query['dsetname'], tag_utils.get_query_strid(query))
@@ -102,3 +102,13 @@ class StrIdDecodeError(Exception):
 
     def __str__(self):
         return repr(self.msg)
+
+
+class QueryCancelledError(Exception):
+    """ Class for reporting that the execution of a query has been cancelled """
+    def __init__(self, msg):
+        super(QueryCancelledError, self).__init__()
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
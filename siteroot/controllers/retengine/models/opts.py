@@ -13,6 +13,7 @@ class States:
     fatal_error_or_socket_timeout = 800
     invalid_qid = 850
     result_read_error = 870
+    cancelled = 880
     inactive = 890
 
 
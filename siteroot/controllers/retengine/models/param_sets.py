@@ -104,7 +104,17 @@ class VisorEngineProcessOpts(object):
                  rf_rank_type=opts.RfRankTypes.full,
                  rf_rank_topn=2000,
                  rf_train_type=opts.RfTrainTypes.regular,
-                 feat_detector_type=opts.FeatDetectorType.fast
+                 feat_detector_type=opts.FeatDetectorType.fast,
+                 backend_pool_size=8,
+                 use_process_manager=False,
+                 mem_cache_max_bytes=256*1024*1024,
+                 shared_cache_dir=None,
+                 ranklist_codec=None,
+                 cache_warmup_lists=100,
+                 cache_warmup_max_bytes=128*1024*1024,
+                 worker_idle_timeout=300,
+                 max_running_queries=None,
+                 query_priorities=dict(dsetimage=0, refine=0, curated=1, image=1, text=2)
                 ):
         """
             Initializes the class
@@ -126,6 +136,34 @@ class VisorEngineProcessOpts(object):
                 rf_rank_topn: Relevance feedback rank type - Top N
                 rf_train_type: Relevance feedback train type
                 feat_detector_type: feature detector type to be used in the backend
+                backend_pool_size: Maximum number of simultaneous connections to each backend
+                use_process_manager: Boolean indicating whether the status of the queries should be
+                                     kept in a multiprocessing Manager. Only needed if the queries are
+                                     executed in a pool of processes instead of threads.
+                mem_cache_max_bytes: Approximate maximum number of bytes used by the in-memory cache
+                                     of results of each engine
+                shared_cache_dir: Folder where the caches of results and query sessions are stored so
+                                  that they are shared by all the processes of the same host (e.g. the
+                                  workers of a uWSGI deployment). If None, each process keeps its own
+                                  caches in memory.
+                ranklist_codec: Name of the codec used to compress the ranking lists saved to the
+                                disk cache (see retengine.utils.compression). If None, the lists
+                                are not compressed and can be memory-mapped when loaded.
+                cache_warmup_lists: Number of most used ranking lists of each engine loaded into the
+                                    in-memory cache when the frontend starts, besides the predefined
+                                    ranking lists. Use 0 to disable the warm-up.
+                cache_warmup_max_bytes: Approximate maximum number of bytes loaded by the warm-up of
+                                        the in-memory cache of each engine
+                worker_idle_timeout: Number of seconds after which a query whose status has not been
+                                     requested is considered abandoned. Abandoned queries are cancelled
+                                     and their query ID is released in the backend.
+                max_running_queries: Maximum number of queries executed at the same time in the pool
+                                     of workers. The rest wait in a queue. If None, all the pool
+                                     workers but one are used. The queries of each engine can be
+                                     further limited with the 'max_running_queries' engine setting.
+                query_priorities: Dictionary with the priority in the queue of each query type. Lower
+                                  values run first. The queries of engines which return results
+                                  almost instantly and the ones with a saved classifier always go first.
         """
         self.pool_workers = pool_workers
         self.resize_width = resize_width
@@ -136,3 +174,13 @@ class VisorEngineProcessOpts(object):
         self.rf_rank_topn = rf_rank_topn
         self.rf_train_type = rf_train_type
         self.feat_detector_type = feat_detector_type
+        self.backend_pool_size = backend_pool_size
+        self.use_process_manager = use_process_manager
+        self.mem_cache_max_bytes = mem_cache_max_bytes
+        self.shared_cache_dir = shared_cache_dir
+        self.ranklist_codec = ranklist_codec
+        self.cache_warmup_lists = cache_warmup_lists
+        self.cache_warmup_max_bytes = cache_warmup_max_bytes
+        self.worker_idle_timeout = worker_idle_timeout
+        self.max_running_queries = max_running_queries
+        self.query_priorities = query_priorities
@@ -13,7 +13,9 @@ class QueryStatus(object):
                  state=opts.States.inactive,
                  postrainimg_paths=[], curatedtrainimgs_paths=[], negtrainimg_count=0,
                  exectime_processing=0.0, exectime_training=0.0,
-                 exectime_ranking=0.0, err_msg=''):
+                 exectime_ranking=0.0, err_msg='',
+                 featcomp_total=0, featcomp_done=0, featcomp_failed=0,
+                 cancel_requested=False, queue_position=0):
         """
             Initializes the class
             Arguments:
@@ -27,6 +29,12 @@ class QueryStatus(object):
                  exectime_training: Execution time spent on training
                  exectime_ranking: Execution time spent on ranking
                  err_msg: Message indicating the cause of an error with the query.
+                 featcomp_total: Number of images for which features must be computed
+                 featcomp_done: Number of images for which features have been computed
+                 featcomp_failed: Number of images for which the feature computation failed
+                 cancel_requested: Boolean indicating whether the query has been asked to stop
+                 queue_position: Position of the query in the queue of queries waiting to
+                                 run, starting from 1, or 0 if the query is not queued
         """
         self.qid = qid
         self.query = query
@@ -38,6 +46,11 @@ class QueryStatus(object):
         self.exectime_training = exectime_training
         self.exectime_ranking = exectime_ranking
         self.err_msg = err_msg
+        self.featcomp_total = featcomp_total
+        self.featcomp_done = featcomp_done
+        self.featcomp_failed = featcomp_failed
+        self.cancel_requested = cancel_requested
+        self.queue_position = queue_position
 
 
     def to_dict(self):
@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import tempfile
+import math
+import mmap
+import struct
+import bisect
+from array import array
+
+import msgpack
+
+from retengine.utils import compression
+
+# header of the binary ranking list files (see RankList.save):
+# magic, version, byte order, number of items, number of strings,
+# length of the string blob and length of the extra fields
+RANKLIST_MAGIC = b'VRLS'
+RANKLIST_VERSION = 1
+RANKLIST_HEADER = struct.Struct('<4sBBxxQQQQ')
+# all sections of the file start at a multiple of this number of bytes
+RANKLIST_ALIGNMENT = 8
+# header of the compressed ranking list files: magic and length of the codec
+# name, which is followed by the codec name and the compressed binary file
+RANKLIST_COMPRESSED_MAGIC = b'VRLZ'
+RANKLIST_COMPRESSED_HEADER = struct.Struct('<4sB')
+# files smaller than this number of bytes are read instead of memory-mapped, as
+# mapping them saves little and each memory map keeps a file descriptor open
+RANKLIST_MMAP_MIN_BYTES = 1024*1024
+
+# ----------------------------------
+## Ranking list container
+# ----------------------------------
+
+class RankList(object):
+    """
+        Compact, read-only container for a ranking list.
+
+        A ranking list is usually a list of dictionaries such as
+        {'path': ..., 'score': ..., 'roi': ...}, which costs hundreds of bytes
+        of dictionary overhead per item. This class stores the same data in
+        columns instead:
+
+          scores  - float32 array (NaN when the item has no score)
+          paths   - int32 array of ids into an interned string table
+          rois    - int32 array of ids into the same table (-1 when the item
+                    has no ROI)
+          extras  - sparse dictionary with any other field of an item. In
+                    lists loaded from a file, the fields of each item are
+                    kept encoded with msgpack, and only decoded when the
+                    item is accessed
+
+        The string table is a single UTF-8 blob plus an array of offsets.
+        Paths are stored with prefix dictionary encoding: the folder of each
+        path is a separate string of the table, and each path only stores the
+        id of its folder (see str_prefixes) followed by the rest of the path.
+
+        The class behaves like a list of dictionaries: indexing returns a new
+        dictionary built on demand, and slicing returns a list of
+        dictionaries, so callers can modify the items of a page without
+        affecting the cached ranking list.
+
+        The columns can be saved to a binary file with fixed-width sections,
+        which can later be memory-mapped (see load), so that reading a page
+        of results only touches the parts of the file holding that page.
+        The file can optionally be compressed with any of the codecs of
+        retengine.utils.compression, in which case it is read into memory.
+    """
+
+    NO_ID = -1
+
+    def __init__(self, items=None):
+        """
+            Initializes the container.
+            Arguments:
+                items: iterable of dictionaries, in ranking order.
+        """
+        self._scores = array('f')
+        self._paths = array('i')
+        self._rois = array('i')
+        self._extras = {}
+        # encoded extra fields of lists loaded from a file: sorted positions of
+        # the items with extra fields, offsets of their fields in the blob and blob
+        self._extra_items = array('q')
+        self._extra_offsets = array('q', [0])
+        self._extra_blob = b''
+        self._str_offsets = array('q', [0])
+        self._str_prefixes = array('i')
+        self._str_blob = b''
+        # memory map backing the columns, if loaded with use_mmap=True
+        self._mmap = None
+
+        if items is not None:
+            self._build(items)
+
+
+    @classmethod
+    def from_items(cls, items):
+        """
+            Builds a RankList from a list of dictionaries. If items is
+            already a RankList, it is returned unchanged.
+            Arguments:
+                items: iterable of dictionaries, in ranking order.
+            Returns:
+                A RankList instance.
+        """
+        if isinstance(items, cls):
+            return items
+        return cls(items)
+
+
+    def __getstate__(self):
+        """
+            Returns a picklable object with class information for
+            reconstructing the instance.
+        """
+        # memory-mapped columns cannot be pickled, so copy them
+        a_dict = dict(self.__dict__)
+        if self._mmap is not None:
+            a_dict['_scores'] = array('f', self._scores)
+            a_dict['_paths'] = array('i', self._paths)
+            a_dict['_rois'] = array('i', self._rois)
+            a_dict['_str_offsets'] = array('q', self._str_offsets)
+            a_dict['_str_prefixes'] = array('i', self._str_prefixes)
+            a_dict['_str_blob'] = bytes(self._str_blob)
+            a_dict['_extra_items'] = array('q', self._extra_items)
+            a_dict['_extra_offsets'] = array('q', self._extra_offsets)
+            a_dict['_extra_blob'] = bytes(self._extra_blob)
+            a_dict['_mmap'] = None
+        return a_dict
+
+
+    def _build(self, items):
+        """
+            Fills the columns from a list of dictionaries.
+            Arguments:
+                items: iterable of dictionaries, in ranking order.
+        """
+        str_ids = {}
+        str_parts = []
+        offset = 0
+
+        def intern(value, split_prefix=False):
+            """ Returns the id of a string in the table, adding it if needed """
+            nonlocal offset
+            str_id = str_ids.get(value, None)
+            if str_id is None:
+                prefix_id = self.NO_ID
+                suffix = value
+                if split_prefix:
+                    (head, sep, tail) = value.rpartition('/')
+                    if head:
+                        prefix_id = intern(head + sep)
+                        suffix = tail
+                encoded = suffix.encode('utf-8')
+                str_parts.append(encoded)
+                offset += len(encoded)
+                self._str_offsets.append(offset)
+                self._str_prefixes.append(prefix_id)
+                # take the id from the table, as the recursive call for the
+                # prefix might already have added value (e.g. for 'a/b/')
+                str_id = len(self._str_prefixes) - 1
+                str_ids[value] = str_id
+            return str_id
+
+        for (idx, item) in enumerate(items):
+            extra = dict(item)
+
+            score = extra.pop('score', None)
+            if isinstance(score, (int, float)) and not isinstance(score, bool):
+                self._scores.append(score)
+            else:
+                self._scores.append(math.nan)
+                if score is not None:
+                    extra['score'] = score
+
+            path = extra.pop('path', None)
+            if isinstance(path, str):
+                self._paths.append(intern(path, split_prefix=True))
+            else:
+                self._paths.append(self.NO_ID)
+                if path is not None:
+                    extra['path'] = path
+
+            roi = extra.pop('roi', None)
+            if isinstance(roi, str):
+                self._rois.append(intern(roi))
+            else:
+                self._rois.append(self.NO_ID)
+                if roi is not None:
+                    extra['roi'] = roi
+
+            if extra:
+                self._extras[idx] = extra
+
+        self._str_blob = b''.join(str_parts)
+
+
+    def _get_str(self, str_id):
+        """
+            Gets a string from the table.
+            Arguments:
+                str_id: id of the string.
+            Returns:
+                The string.
+        """
+        start = self._str_offsets[str_id]
+        end = self._str_offsets[str_id + 1]
+        value = bytes(self._str_blob[start:end]).decode('utf-8')
+        prefix_id = self._str_prefixes[str_id]
+        if prefix_id != self.NO_ID:
+            value = self._get_str(prefix_id) + value
+        return value
+
+
+    def _get_extra(self, idx):
+        """
+            Gets the extra fields of an item, decoding them if needed.
+            Arguments:
+                idx: non-negative position of the item.
+            Returns:
+                A dictionary with the extra fields, or 'None' if the item has none.
+        """
+        extra = self._extras.get(idx, None)
+        if extra is None and len(self._extra_items):
+            pos = bisect.bisect_left(self._extra_items, idx)
+            if pos < len(self._extra_items) and self._extra_items[pos] == idx:
+                encoded = bytes(self._extra_blob[self._extra_offsets[pos]:self._extra_offsets[pos + 1]])
+                extra = msgpack.unpackb(encoded, encoding='utf-8')
+        return extra
+
+
+    def _iter_encoded_extras(self):
+        """
+            Iterates over the extra fields of all the items, encoded with msgpack.
+            Returns:
+                A generator of (position of the item, encoded fields) tuples, by position.
+        """
+        encoded = dict((idx, msgpack.packb(extra)) for (idx, extra) in self._extras.items())
+        for (pos, idx) in enumerate(self._extra_items):
+            if idx not in encoded:
+                encoded[idx] = bytes(self._extra_blob[self._extra_offsets[pos]:self._extra_offsets[pos + 1]])
+        for idx in sorted(encoded):
+            yield (idx, encoded[idx])
+
+
+    def _get_item(self, idx):
+        """
+            Builds the dictionary of an item.
+            Arguments:
+                idx: non-negative position of the item.
+            Returns:
+                A new dictionary with the fields of the item.
+        """
+        item = {}
+        path_id = self._paths[idx]
+        if path_id != self.NO_ID:
+            item['path'] = self._get_str(path_id)
+        score = self._scores[idx]
+        if not math.isnan(score):
+            item['score'] = score
+        roi_id = self._rois[idx]
+        if roi_id != self.NO_ID:
+            item['roi'] = self._get_str(roi_id)
+        extra = self._get_extra(idx)
+        if extra:
+            item.update(extra)
+        return item
+
+
+    def __len__(self):
+        """ Returns the number of items """
+        return len(self._scores)
+
+
+    def __getitem__(self, key):
+        """
+            Gets one item, or a list of items if key is a slice.
+            Arguments:
+                key: index or slice.
+            Returns:
+                A dictionary, or a list of dictionaries.
+        """
+        if isinstance(key, slice):
+            return [self._get_item(idx) for idx in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('RankList index out of range')
+        return self._get_item(key)
+
+
+    def __iter__(self):
+        """ Iterates over the items, as dictionaries """
+        for idx in range(len(self)):
+            yield self._get_item(idx)
+
+
+    def __repr__(self):
+        """ Returns a short description of the container """
+        return '<RankList: %d items>' % len(self)
+
+
+    def get_path(self, idx):
+        """
+            Gets the path of an item without building its dictionary.
+            Arguments:
+                idx: position of the item.
+            Returns:
+                The path of the item, or 'None' if it has no path.
+        """
+        path_id = self._paths[idx]
+        if path_id != self.NO_ID:
+            return self._get_str(path_id)
+        extra = self._get_extra(idx % len(self))
+        return extra.get('path', None) if extra else None
+
+
+    def has_roi(self, idx):
+        """
+            Checks whether an item has a ROI.
+            Arguments:
+                idx: position of the item.
+            Returns:
+                True if the item has a ROI, False otherwise.
+        """
+        if self._rois[idx] != self.NO_ID:
+            return True
+        extra = self._get_extra(idx % len(self))
+        return bool(extra) and 'roi' in extra
+
+
+    def subset_with_roi(self):
+        """
+            Gets the items that have a ROI.
+            Returns:
+                A new RankList with the items that have a ROI, in the same order.
+        """
+        return RankList(self._get_item(idx) for idx in range(len(self)) if self.has_roi(idx))
+
+
+    def to_list(self):
+        """
+            Converts the container to a list of dictionaries.
+            Returns:
+                A list of dictionaries, e.g. for serialization.
+        """
+        return list(self)
+
+
+    def nbytes(self):
+        """
+            Estimates the memory used by the container. The memory-mapped
+            columns are counted with the whole length of the file, as they can
+            be paged in by the operating system, and so that a cache bounded by
+            bytes also bounds the number of memory maps (and open files) it holds.
+            Returns:
+                The approximate size of the container in bytes.
+        """
+        size = sys.getsizeof(self)
+        if self._mmap is None:
+            size += sys.getsizeof(self._scores) + sys.getsizeof(self._paths) + sys.getsizeof(self._rois)
+            size += sys.getsizeof(self._str_offsets) + sys.getsizeof(self._str_prefixes)
+            size += sys.getsizeof(self._str_blob)
+            size += sys.getsizeof(self._extra_items) + sys.getsizeof(self._extra_offsets)
+            size += sys.getsizeof(self._extra_blob)
+        else:
+            size += len(self._mmap)
+        size += sys.getsizeof(self._extras)
+        for extra in self._extras.values():
+            size += sys.getsizeof(extra)
+            for (key, value) in extra.items():
+                size += sys.getsizeof(key) + sys.getsizeof(value)
+        return size
+
+
+    def preload(self):
+        """
+            Reads the whole memory-mapped file, if any, so that the operating
+            system keeps it in memory and the first accesses to the container
+            do not have to wait for the disk.
+            Returns:
+                The number of bytes read, which is 0 if the container is not
+                memory-mapped.
+        """
+        if self._mmap is None:
+            return 0
+        if hasattr(self._mmap, 'madvise'):
+            self._mmap.madvise(mmap.MADV_WILLNEED)
+        # touch one byte of each page
+        for offset in range(0, len(self._mmap), mmap.PAGESIZE):
+            self._mmap[offset]
+        return len(self._mmap)
+
+
+    def save(self, fname, codec=None):
+        """
+            Saves the container to a binary file. The file contains a header
+            (see RANKLIST_HEADER) followed by the scores, path ids, ROI ids,
+            string offsets, string prefix ids, string blob and the extra fields.
+            Each section starts at a multiple of RANKLIST_ALIGNMENT bytes.
+            The extra fields section holds the number of items with extra fields,
+            their positions, the offsets of their fields and the fields of each
+            item encoded with msgpack, so that they can be decoded one by one.
+            If a codec is specified, the whole file is compressed and preceded by
+            RANKLIST_COMPRESSED_HEADER and the name of the codec.
+            The file is written to a temporary file which then replaces the
+            output file, so that existing memory maps of a previous version of
+            the file remain valid.
+            Arguments:
+                fname: Full path to the output file.
+                codec: name of a codec registered in retengine.utils.compression,
+                       or 'None' to leave the file uncompressed.
+        """
+        extra_items = array('q')
+        extra_offsets = array('q', [0])
+        extra_parts = []
+        for (idx, encoded) in self._iter_encoded_extras():
+            extra_items.append(idx)
+            extra_parts.append(encoded)
+            extra_offsets.append(extra_offsets[-1] + len(encoded))
+        extras = (array('q', [len(extra_items)]).tobytes() + extra_items.tobytes() +
+                  extra_offsets.tobytes() + b''.join(extra_parts))
+        str_blob = bytes(self._str_blob)
+        byteorder = 0 if sys.byteorder == 'little' else 1
+        sections = [RANKLIST_HEADER.pack(RANKLIST_MAGIC, RANKLIST_VERSION, byteorder,
+                                         len(self), len(self._str_offsets) - 1,
+                                         len(str_blob), len(extras)),
+                    array('f', self._scores).tobytes(),
+                    array('i', self._paths).tobytes(),
+                    array('i', self._rois).tobytes(),
+                    array('q', self._str_offsets).tobytes(),
+                    array('i', self._str_prefixes).tobytes(),
+                    str_blob,
+                    extras]
+        content = b''.join(section + b'\0' * _padding(len(section)) for section in sections)
+        if codec:
+            codec_name = codec.encode('ascii')
+            content = (RANKLIST_COMPRESSED_HEADER.pack(RANKLIST_COMPRESSED_MAGIC, len(codec_name)) +
+                       codec_name + compression.compress(content, codec))
+
+        (fd, tmp_fname) = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as rfile:
+                rfile.write(content)
+            os.replace(tmp_fname, fname)
+        except Exception:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+
+
+    @classmethod
+    def load(cls, fname, use_mmap=True):
+        """
+            Loads a container from a binary file created with save.
+            Arguments:
+                fname: Full path to the input file.
+                use_mmap: Boolean indicating whether to memory-map the file
+                          instead of reading it. With a memory map, only the
+                          parts of the file that are accessed are read.
+                          Compressed files and files smaller than
+                          RANKLIST_MMAP_MIN_BYTES are always read.
+            Returns:
+                A RankList instance.
+                It raises a ValueError if the file is not a valid ranking list.
+        """
+        with open(fname, 'rb') as rfile:
+            magic = rfile.read(len(RANKLIST_MAGIC))
+            if magic == RANKLIST_COMPRESSED_MAGIC:
+                rfile.seek(0)
+                content = rfile.read()
+                (magic, name_len) = RANKLIST_COMPRESSED_HEADER.unpack_from(content)
+                start = RANKLIST_COMPRESSED_HEADER.size
+                codec = content[start:start + name_len].decode('ascii')
+                buf = memoryview(compression.decompress(content[start + name_len:], codec))
+                return cls._from_buffer(buf, None, fname)
+
+            rfile.seek(0)
+            header = rfile.read(RANKLIST_HEADER.size)
+            if len(header) < RANKLIST_HEADER.size:
+                raise ValueError('Invalid ranking list file: %s' % fname)
+            (magic, version, byteorder, num_items) = RANKLIST_HEADER.unpack(header)[:4]
+            # the columns can only be used in place if the byte order matches
+            swap = byteorder != (0 if sys.byteorder == 'little' else 1)
+            if (use_mmap and not swap and num_items > 0 and
+                    os.fstat(rfile.fileno()).st_size >= RANKLIST_MMAP_MIN_BYTES):
+                # the map does not need the file once created, so do not let
+                # it keep a duplicate of the descriptor, where supported
+                if sys.version_info >= (3, 13):
+                    data = mmap.mmap(rfile.fileno(), 0, access=mmap.ACCESS_READ, trackfd=False)
+                else:
+                    data = mmap.mmap(rfile.fileno(), 0, access=mmap.ACCESS_READ)
+                return cls._from_buffer(memoryview(data), data, fname)
+            rfile.seek(0)
+            return cls._from_buffer(memoryview(rfile.read()), None, fname)
+
+
+    @classmethod
+    def _from_buffer(cls, buf, mmap_obj, fname):
+        """
+            Builds a container from the content of a binary file.
+            Arguments:
+                buf: memoryview with the uncompressed content of the file.
+                mmap_obj: memory map backing buf, or 'None' if buf is in memory.
+                          If it is not 'None', the columns are used in place.
+                fname: Full path to the file, for error messages.
+            Returns:
+                A RankList instance.
+                It raises a ValueError if the content is not a valid ranking list.
+        """
+        if len(buf) < RANKLIST_HEADER.size:
+            raise ValueError('Invalid ranking list file: %s' % fname)
+        (magic, version, byteorder, num_items, num_strings,
+         blob_len, extras_len) = RANKLIST_HEADER.unpack_from(buf)
+        if magic != RANKLIST_MAGIC or version != RANKLIST_VERSION:
+            raise ValueError('Invalid ranking list file: %s' % fname)
+        swap = byteorder != (0 if sys.byteorder == 'little' else 1)
+
+        layout = [('_scores', 'f', num_items), ('_paths', 'i', num_items), ('_rois', 'i', num_items),
+                  ('_str_offsets', 'q', num_strings + 1), ('_str_prefixes', 'i', num_strings),
+                  ('_str_blob', 'B', blob_len), ('_extras', 'B', extras_len)]
+
+        rlist = cls()
+        offset = RANKLIST_HEADER.size + _padding(RANKLIST_HEADER.size)
+        columns = {}
+        for (name, typecode, count) in layout:
+            length = count * array(typecode).itemsize
+            if offset + length > len(buf):
+                raise ValueError('Truncated ranking list file: %s' % fname)
+            columns[name] = (typecode, buf[offset:offset + length])
+            offset += length + _padding(length)
+
+        extras = columns.pop('_extras')[1]
+        if len(extras):
+            int_size = array('q').itemsize
+            counts = array('q')
+            counts.frombytes(extras[:int_size])
+            if swap:
+                counts.byteswap()
+            num_extras = counts[0]
+            start = int_size
+            for (name, count) in (('_extra_items', num_extras), ('_extra_offsets', num_extras + 1)):
+                length = count * int_size
+                if start + length > len(extras):
+                    raise ValueError('Truncated ranking list file: %s' % fname)
+                columns[name] = ('q', extras[start:start + length])
+                start += length
+            rlist._extra_blob = extras[start:]
+            if mmap_obj is None:
+                rlist._extra_blob = bytes(rlist._extra_blob)
+        rlist._str_blob = columns.pop('_str_blob')[1]
+        if mmap_obj is None:
+            rlist._str_blob = bytes(rlist._str_blob)
+        for (name, (typecode, column)) in columns.items():
+            if mmap_obj is not None:
+                setattr(rlist, name, column.cast(typecode))
+            else:
+                values = array(typecode)
+                values.frombytes(column)
+                if swap:
+                    values.byteswap()
+                setattr(rlist, name, values)
+        rlist._mmap = mmap_obj
+        return rlist
+
+
+def _padding(length):
+    """
+        Gets the number of bytes needed to align a section of a ranking
+        list file to RANKLIST_ALIGNMENT.
+        Arguments:
+            length: length of the section in bytes.
+        Returns:
+            The number of padding bytes.
+    """
+    return (RANKLIST_ALIGNMENT - length % RANKLIST_ALIGNMENT) % RANKLIST_ALIGNMENT
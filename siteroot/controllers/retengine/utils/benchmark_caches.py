@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+    Micro-benchmark of the base caches of the frontend (MaxSizeCache and SessionCache),
+    comparing the current implementation with the previous one, which refreshed the
+    recency of an entry by deleting and reinserting it, deleted partial tuples by
+    scanning all the keys and checked all the sessions for expiry on every access.
+
+    Usage example, from the 'siteroot/controllers' folder:
+
+        python -m retengine.utils.benchmark_caches --sizes 10000 100000 1000000
+
+    For each number of entries, it prints the time taken by each implementation.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from threading import Lock
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from retengine.managers.base_caches import max_size_cache, session_cache
+
+
+class LegacyMaxSizeCache(object):
+    """ Previous implementation of MaxSizeCache (without byte limit), for comparison """
+
+    def __init__(self, entry_limit=100):
+        self._datastore_lock = Lock()
+        self._datastore = OrderedDict()
+        self._entry_limit = entry_limit
+
+
+    def get_data(self, key):
+        data = None
+        with self._datastore_lock:
+            if key in self._datastore:
+                data = self._datastore[key]
+                del self._datastore[key]
+                self._datastore[key] = data
+        return data
+
+
+    def add_data(self, data, key):
+        with self._datastore_lock:
+            if key in self._datastore:
+                del self._datastore[key]
+            self._datastore[key] = data
+            while self._entry_limit is not None and len(self._datastore) > self._entry_limit:
+                del self._datastore[next(iter(self._datastore))]
+
+
+    def delete_data_partial_tuple(self, partial_tuple):
+        with self._datastore_lock:
+            keys = [key for key in self._datastore
+                    if partial_tuple == key[:len(partial_tuple)]]
+            for key in keys:
+                del self._datastore[key]
+
+
+class LegacySessionCache(object):
+    """ Previous implementation of SessionCache, for comparison """
+
+    def __init__(self, session_lifetime=1200):
+        self._sessions_lock = Lock()
+        self._sessions = dict()
+        self._session_lifetime = session_lifetime
+
+
+    def purge_old_sessions(self):
+        for key in list(self._sessions.keys()):
+            if (time.time() - self._sessions[key].last_update) > self._session_lifetime:
+                del self._sessions[key]
+
+
+    def get_data(self, ses_id, key):
+        data = None
+        with self._sessions_lock:
+            if ses_id in self._sessions:
+                self._sessions[ses_id].last_update = time.time()
+                data = self._sessions[ses_id].data.get(key)
+            self.purge_old_sessions()
+        return data
+
+
+    def add_data(self, data, ses_id, key):
+        with self._sessions_lock:
+            if ses_id not in self._sessions:
+                self._sessions[ses_id] = session_cache.SessionCache.SessionData()
+            self._sessions[ses_id].last_update = time.time()
+            self._sessions[ses_id].data[key] = data
+            self.purge_old_sessions()
+
+
+def timed(func, *args):
+    """
+        Measures the time taken by a function.
+        Arguments:
+            func: function to call.
+            args: arguments of the function.
+        Returns:
+            The number of seconds taken by the call.
+    """
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def bench_max_size_cache(cache_class, size, num_ops):
+    """
+        Benchmarks the LRU update and the partial-tuple deletes of a MaxSizeCache.
+        Arguments:
+            cache_class: MaxSizeCache class to benchmark.
+            size: number of entries in the cache.
+            num_ops: number of lookups and deletes to perform.
+        Returns:
+            A tuple with the number of seconds taken by the lookups and the deletes.
+    """
+    # keys like the ones of MaxSizeResultCache: (qhash, qtype, engine, dsetname)
+    keys = [('qhash%d' % idx, 'text', 'engine', 'dset%d' % (idx % 4)) for idx in range(size)]
+    cache = cache_class(entry_limit=None)
+    for key in keys:
+        cache.add_data(None, key)
+    lookups = [random.choice(keys) for idx in range(num_ops)]
+    deletes = [key[:3] for key in random.sample(keys, min(num_ops, size) // 10)]
+
+    def lookup():
+        for key in lookups:
+            cache.get_data(key)
+
+    def delete():
+        for partial_tuple in deletes:
+            cache.delete_data_partial_tuple(partial_tuple)
+
+    return (timed(lookup), timed(delete))
+
+
+def bench_session_cache(cache_class, size, num_ops):
+    """
+        Benchmarks the accesses to a SessionCache, including the purge of
+        the expired sessions performed on each access.
+        Arguments:
+            cache_class: SessionCache class to benchmark.
+            size: number of sessions in the cache.
+            num_ops: number of accesses to perform.
+        Returns:
+            The number of seconds taken by the accesses.
+    """
+    cache = cache_class(session_lifetime=1200)
+    for idx in range(size):
+        cache.add_data(idx, 'session%d' % idx, 'key')
+    accesses = ['session%d' % random.randrange(size) for idx in range(num_ops)]
+
+    def access():
+        for ses_id in accesses:
+            cache.get_data(ses_id, 'key')
+
+    return timed(access)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the current and previous implementation of the base caches')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000], help='numbers of entries to test')
+    parser.add_argument('--ops', type=int, default=1000, help='number of operations per test')
+    args = parser.parse_args()
+
+    print ('%10s %-32s %12s %12s' % ('entries', 'operation', 'previous (s)', 'current (s)'))
+    for size in args.sizes:
+        (old_lookup, old_delete) = bench_max_size_cache(LegacyMaxSizeCache, size, args.ops)
+        (new_lookup, new_delete) = bench_max_size_cache(max_size_cache.MaxSizeCache, size, args.ops)
+        print ('%10d %-32s %12.4f %12.4f' % (size, 'MaxSizeCache.get_data', old_lookup, new_lookup))
+        print ('%10d %-32s %12.4f %12.4f' % (size, 'MaxSizeCache.delete_partial_tuple', old_delete, new_delete))
+        # the previous implementation walks all the sessions on every access,
+        # so use fewer accesses to keep the run time reasonable
+        num_ops = max(1, args.ops // 10)
+        old_access = bench_session_cache(LegacySessionCache, size, num_ops)
+        new_access = bench_session_cache(session_cache.SessionCache, size, num_ops)
+        print ('%10d %-32s %12.4f %12.4f' % (size, 'SessionCache.get_data (x%d)' % num_ops, old_access, new_access))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import zlib
+
+# registry of compression codecs: name -> (compress function, decompress function)
+_codecs = {}
+
+def register_codec(name, compress_func, decompress_func):
+    """
+        Registers a compression codec, replacing any codec with the same name.
+        Arguments:
+            name: name of the codec. It must be ASCII and at most 255 characters long.
+            compress_func: function receiving bytes and returning the compressed bytes.
+            decompress_func: function receiving compressed bytes and returning the
+                             original bytes.
+    """
+    if len(name.encode('ascii')) > 255:
+        raise ValueError('Codec name too long: %s' % name)
+    _codecs[name] = (compress_func, decompress_func)
+
+
+def get_codec_names():
+    """
+        Gets the names of the registered codecs.
+        Returns:
+            A sorted list of codec names.
+    """
+    return sorted(_codecs.keys())
+
+
+def compress(data, codec):
+    """
+        Compresses data with a codec.
+        Arguments:
+            data: bytes to compress.
+            codec: name of a registered codec.
+        Returns:
+            The compressed bytes.
+            It raises a ValueError if the codec is not registered.
+    """
+    if codec not in _codecs:
+        raise ValueError('Unknown compression codec: %s' % codec)
+    return _codecs[codec][0](data)
+
+
+def decompress(data, codec):
+    """
+        Decompresses data with a codec.
+        Arguments:
+            data: bytes to decompress.
+            codec: name of a registered codec.
+        Returns:
+            The decompressed bytes.
+            It raises a ValueError if the codec is not registered.
+    """
+    if codec not in _codecs:
+        raise ValueError('Unknown compression codec: %s' % codec)
+    return _codecs[codec][1](data)
+
+
+register_codec('zlib', lambda data: zlib.compress(data, 6), zlib.decompress)
+
+try:
+    import lzma
+    register_codec('lzma', lzma.compress, lzma.decompress)
+except ImportError:
+    # the lzma module is optional in some Python builds
+    pass
+
+try:
+    import bz2
+    register_codec('bz2', bz2.compress, bz2.decompress)
+except ImportError:
+    pass
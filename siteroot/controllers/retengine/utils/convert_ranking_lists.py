@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+    Converts the ranking lists stored in msgpack format ('.msgpack' files) to the
+    binary format that can be memory-mapped by the frontend ('.ranklist' files).
+
+    Usage example, from the 'siteroot/controllers' folder:
+
+        python -m retengine.utils.convert_ranking_lists /path/to/searchdata/rankinglists /path/to/searchdata/predefined_rankinglists
+
+    Folders are processed recursively, so the ranking lists of all engines are converted.
+    Both formats can be read by the frontend, so the conversion is optional and can be
+    done while the frontend is running. Use '--delete' to remove the '.msgpack' files
+    once they have been converted, and '--codec' to compress the converted files
+    (see retengine.utils.compression).
+"""
+
+import os
+import sys
+import argparse
+
+#  The line below requires msgpack-python==0.3.0 (if not already installed).
+#  Install it by running: 'pip install msgpack-python==0.3.0'
+import msgpack
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from retengine.models import rank_list
+from retengine.utils import compression
+
+
+def convert_file(msgpack_fname, delete=False, overwrite=False, codec=None):
+    """
+        Converts a ranking list from msgpack format to the binary format.
+        Arguments:
+            msgpack_fname: Full path to the '.msgpack' file.
+            delete: Boolean indicating whether to delete the '.msgpack' file
+                    after converting it.
+            overwrite: Boolean indicating whether to overwrite the output file,
+                       if it already exists.
+            codec: name of the codec used to compress the output file, or
+                   'None' to leave it uncompressed.
+        Returns:
+            True if the file was converted, False otherwise.
+    """
+    ranklist_fname = os.path.splitext(msgpack_fname)[0] + '.ranklist'
+    if os.path.isfile(ranklist_fname) and not overwrite:
+        print ('Skipping %s, already converted' % msgpack_fname)
+        return False
+
+    with open(msgpack_fname, 'rb') as rfile:
+        rlist = msgpack.load(rfile, encoding='utf-8')
+    rank_list.RankList.from_items(rlist).save(ranklist_fname, codec=codec)
+
+    if delete:
+        os.remove(msgpack_fname)
+    return True
+
+
+def convert_folder(path, delete=False, overwrite=False, codec=None):
+    """
+        Converts all ranking lists in msgpack format found in a folder
+        and its subfolders.
+        Arguments:
+            path: Full path to the folder.
+            delete: Boolean indicating whether to delete the '.msgpack' files
+                    after converting them.
+            overwrite: Boolean indicating whether to overwrite the output files,
+                       if they already exist.
+            codec: name of the codec used to compress the output files, or
+                   'None' to leave them uncompressed.
+        Returns:
+            The number of converted files.
+    """
+    count = 0
+    for root, dirnames, filenames in os.walk(path):
+        for filename in sorted(filenames):
+            if filename.endswith('.msgpack'):
+                fname = os.path.join(root, filename)
+                try:
+                    if convert_file(fname, delete, overwrite, codec):
+                        print ('Converted %s' % fname)
+                        count += 1
+                except Exception as e:
+                    print ('Failed to convert %s: %s' % (fname, e))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts msgpack ranking lists to the memory-mappable format')
+    parser.add_argument('folders', nargs='+', help='folders with ranking lists, e.g. rankinglists and predefined_rankinglists')
+    parser.add_argument('--delete', action='store_true', help='delete the msgpack files after converting them')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite existing converted files')
+    parser.add_argument('--codec', choices=compression.get_codec_names(), default=None,
+                        help='compress the converted files with this codec')
+    args = parser.parse_args()
+    total = 0
+    for folder in args.folders:
+        total += convert_folder(folder, args.delete, args.overwrite, args.codec)
+    print ('%d ranking lists converted' % total)
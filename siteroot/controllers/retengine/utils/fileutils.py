@@ -51,7 +51,7 @@ def delete_directory_subdirectories(path, name_filter=None):
                         shutil.rmtree(subdir_path)
 
 
-def delete_directory_contents(path, name_filter=None):
+def delete_directory_contents(path, name_filter=None, keep_prefixes=None):
     """
         Utility function to delete the contents of a directory.
         It generates the tree of the directory and makes the deletion
@@ -60,6 +60,8 @@ def delete_directory_contents(path, name_filter=None):
            path: Full path to the directory to be deleted.
            name_filter: When different to 'None', a string that must be
                         contained in a filename in order to delete it.
+           keep_prefixes: When different to 'None', tuple of prefixes of the
+                          filenames which must never be deleted.
     """
     empty_dirs = []
     print ('Removing directory contents of path: ' + path)
@@ -76,6 +78,8 @@ def delete_directory_contents(path, name_filter=None):
         """
         deleted_file_counter = 0
         for afile in dir_list:
+            if keep_prefixes and afile.startswith(keep_prefixes):
+                continue
             if name_filter:
                 if name_filter in afile:
                     print ('Removing file: ' + os.path.join(dir_path, afile))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+from threading import Lock, Event
+
+class SingleFlight(object):
+    """
+        Class for deduplicating concurrent calls.
+
+        When several threads call 'do' with the same key at the same time,
+        only the first one executes the function, while the others wait for
+        it to finish and receive the same result (or exception). Calls with
+        different keys never wait for each other.
+    """
+
+    class Call(object):
+        """ Class for storing the outcome of an in-flight call """
+        def __init__(self):
+            self.done = Event()
+            self.result = None
+            self.error = None
+
+
+    def __init__(self):
+        """ Initializes the class """
+        self._calls_lock = Lock()
+        self._calls = {}
+
+
+    def do(self, key, func, *args, **kwargs):
+        """
+            Executes a function, unless another thread is already executing
+            it for the same key, in which case its result is returned instead.
+            Arguments:
+                key: identifier of the call. It must be hashable.
+                func: function to execute.
+                args: positional arguments for func.
+                kwargs: keyword arguments for func.
+            Returns:
+                The value returned by func. If func raises an exception,
+                it is raised in all the threads waiting for the call.
+        """
+        with self._calls_lock:
+            call = self._calls.get(key, None)
+            is_leader = call is None
+            if is_leader:
+                call = self.Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._calls_lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
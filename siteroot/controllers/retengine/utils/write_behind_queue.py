@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+from threading import Condition, Thread
+from collections import OrderedDict
+
+class WriteBehindQueue(object):
+    """
+        Class for persisting data in the background with a dedicated thread.
+
+        Each write is identified by a key (e.g. the name of the output file).
+        If a key is enqueued again before it has been written, the pending
+        write is replaced, so that only the latest data is written. Writes are
+        performed in the order in which their keys were first enqueued.
+    """
+
+    def __init__(self, write_func, name='WriteBehindQueue'):
+        """
+            Initializes the queue. The thread is started on the first write.
+            Arguments:
+                write_func: function performing a write. It is called with the
+                            arguments passed to 'put'.
+                name: name of the writer thread.
+        """
+        self._write_func = write_func
+        self._name = name
+        self._cond = Condition()
+        self._pending = OrderedDict()
+        self._in_progress = None
+        self._thread = None
+        self._stopped = False
+
+
+    def put(self, key, *args):
+        """
+            Enqueues a write, replacing any pending write for the same key.
+            Arguments:
+                key: identifier of the write. It must be hashable.
+                args: arguments for the write function.
+        """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('%s has been stopped' % self._name)
+            self._pending[key] = args
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+
+    def peek(self, key):
+        """
+            Gets the arguments of a pending write, so that data can be read
+            back before it has been persisted.
+            Arguments:
+                key: identifier of the write.
+            Returns:
+                The tuple of arguments of the pending or in-progress write,
+                or 'None' if there is none for the key.
+        """
+        with self._cond:
+            if key in self._pending:
+                return self._pending[key]
+            if self._in_progress and self._in_progress[0] == key:
+                return self._in_progress[1]
+        return None
+
+
+    def discard(self, key_filter=None):
+        """
+            Removes pending writes and waits for the write in progress, if it
+            matches, so that deleted data is not written back afterwards.
+            Arguments:
+                key_filter: function receiving a key and returning True if the
+                            write must be discarded. If 'None', all the pending
+                            writes are discarded.
+        """
+        with self._cond:
+            for key in list(self._pending.keys()):
+                if key_filter is None or key_filter(key):
+                    del self._pending[key]
+            while (self._in_progress and
+                   (key_filter is None or key_filter(self._in_progress[0]))):
+                self._cond.wait()
+
+
+    def flush(self, timeout=None):
+        """
+            Waits until all the pending writes have been performed.
+            Arguments:
+                timeout: maximum number of seconds to wait, or 'None' to wait
+                         until all writes are done.
+            Returns:
+                True if all writes are done, False if the timeout expired.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._in_progress,
+                                       timeout)
+
+
+    def stop(self, flush=True, timeout=None):
+        """
+            Stops the writer thread. No more writes are accepted afterwards.
+            Arguments:
+                flush: Boolean indicating whether to perform the pending
+                       writes before stopping.
+                timeout: maximum number of seconds to wait for the pending writes.
+        """
+        if flush:
+            self.flush(timeout)
+        with self._cond:
+            self._stopped = True
+            if not flush:
+                self._pending.clear()
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+    def __len__(self):
+        """ Returns the number of pending writes """
+        with self._cond:
+            return len(self._pending) + (1 if self._in_progress else 0)
+
+
+    def _run(self):
+        """ Main loop of the writer thread """
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                self._in_progress = self._pending.popitem(last=False)
+            (key, args) = self._in_progress
+            try:
+                self._write_func(*args)
+            except Exception as e:
+                print ('%s: failed to write %s: %s' % (self._name, key, e))
+            finally:
+                with self._cond:
+                    self._in_progress = None
+                    self._cond.notify_all()
@@ -52,10 +52,10 @@ class PageManager(object):
             Extract the elements of the given page from the full list
             of elements.
             Arguments:
-                rlist: Full list of elements
+                rlist: Full list of elements (a list or a RankList)
                 page: Number of the page to be retrieved
             Returns:
-                A pair (a,b) where 'a' corresponds to the elements
+                A pair (a,b) where 'a' corresponds to the list of elements
                 in the requested page and 'b' corresponds to the
                 total number of pages that can be built from rlist.
         """
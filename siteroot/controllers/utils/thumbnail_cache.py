@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import tempfile
+from threading import Lock
+
+# fraction of the maximum size the cache is reduced to when it is pruned, so
+# that it is not pruned again on every new entry
+PRUNE_TARGET_RATIO = 0.8
+
+def get_render_key(path, **render_params):
+    """
+        Computes a key identifying the result of rendering an image, which changes
+        whenever the source image is modified.
+        Arguments:
+            path: full path to the source image.
+            render_params: parameters used to render the image. They must be
+                           serializable to JSON.
+        Returns:
+            A string with the key, or 'None' if the source image does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key_data = json.dumps([os.path.abspath(path), stat.st_mtime_ns, stat.st_size, render_params],
+                          sort_keys=True)
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+class ThumbnailCache:
+    """
+        Content-addressed cache of rendered images (thumbnails, regions, images
+        with a ROI drawn on them), stored on disk.
+
+        Each entry is named after a hash of the path of the source image, its
+        modification time and size, and the parameters used to render it, so
+        that a modified source image never hits a stale entry and no index has
+        to be kept. The entries are written atomically, so the cache can be
+        shared by several processes.
+
+        The cache is bounded by an approximate number of bytes. When it is
+        exceeded, the least recently used entries are deleted (the modification
+        time of an entry is updated every time it is read).
+    """
+
+    def __init__(self, cache_dir, max_bytes=512*1024*1024):
+        """
+            Initializes the cache.
+            Arguments:
+                cache_dir: folder where the entries are stored. It is created if needed.
+                max_bytes: approximate maximum number of bytes of all the entries.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        # approximate number of bytes in the cache, computed on first use
+        self._total_bytes = None
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            pass
+
+
+    def get_key(self, path, **render_params):
+        """
+            Computes the key of an entry.
+            Arguments:
+                path: full path to the source image.
+                render_params: parameters used to render the image. They must be
+                               serializable to JSON.
+            Returns:
+                A string with the key, or 'None' if the source image does not exist.
+        """
+        return get_render_key(path, **render_params)
+
+
+    def _get_entry_path(self, key):
+        """
+            Gets the path of the file of an entry. The files are spread over
+            subfolders, to avoid too many files in a single folder.
+            Arguments:
+                key: key of the entry
+            Returns:
+                The full path to the file.
+        """
+        return os.path.join(self.cache_dir, key[:2], key)
+
+
+    def get(self, key):
+        """
+            Reads an entry.
+            Arguments:
+                key: key of the entry
+            Returns:
+                The bytes of the entry, or 'None' if it is not in the cache.
+        """
+        entry_path = self._get_entry_path(key)
+        try:
+            with open(entry_path, 'rb') as fin:
+                data = fin.read()
+            # mark the entry as recently used
+            os.utime(entry_path)
+            return data
+        except OSError:
+            return None
+
+
+    def put(self, key, data):
+        """
+            Adds an entry, pruning the cache if it becomes too big.
+            Arguments:
+                key: key of the entry
+                data: bytes of the entry
+        """
+        entry_path = self._get_entry_path(key)
+        entry_dir = os.path.dirname(entry_path)
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+            # write to a temporary file first, so that other processes
+            # never read a partially written entry
+            (fd, tmp_path) = tempfile.mkstemp(dir=entry_dir)
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(data)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            print ('Could not write thumbnail cache entry: %s' % e)
+            return
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for (mtime, size, entry) in self._list_entries())
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._prune()
+
+
+    def _list_entries(self):
+        """
+            Lists the entries in the cache.
+            Returns:
+                A list of tuples with the modification time, size and path of each entry.
+        """
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(self.cache_dir):
+            for filename in filenames:
+                entry_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    # deleted by another process in the meantime
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+
+    def _prune(self):
+        """
+            Deletes the least recently used entries until the cache is well
+            below its maximum size. The lock must be held by the caller.
+        """
+        entries = self._list_entries()
+        entries.sort()
+        # other processes might have added or deleted entries, so start
+        # from the real size of the cache
+        self._total_bytes = sum(size for (mtime, size, entry) in entries)
+        target_bytes = self.max_bytes * PRUNE_TARGET_RATIO
+        for (mtime, size, entry_path) in entries:
+            if self._total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(entry_path)
+                self._total_bytes -= size
+            except OSError:
+                pass
+
+
+    def clear(self):
+        """ Deletes all the entries of the cache """
+        with self._lock:
+            for (mtime, size, entry_path) in self._list_entries():
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+            self._total_bytes = 0
@@ -24,10 +24,17 @@ var states = {
     fatal_error_or_socket_timeout: 800,
     invalid_qid: 850,
     result_read_error: 870,
+    cancelled: 880,
     inactive: 890
 };
 // global variable to store status struct returned from execquery
 var respStatus;
+// set when the query is done, so that it is not cancelled when leaving the page
+var queryFinished = false;
+// execquery holds each request until the status changes (long polling), for at
+// most longPollWait seconds, so the next request can be sent almost straight away
+var longPollWait = 20;
+var pollDelay = 100;
 var fullHomeLocation = location.protocol + '//' + window.location.hostname;
 if (location.port.length>0) {
     fullHomeLocation = fullHomeLocation + ':' + location.port + '/';
@@ -62,26 +69,34 @@ function getProgress() {
          is returned as a JSON string */
         respStatus = JSON.parse(http.responseText);
 
+        /* show the position of the query while it waits for other queries to finish */
+        var queueText = '';
+        if (respStatus.queue_position > 0) {
+            queueText = '(waiting, ' + respStatus.queue_position + ' in queue)';
+        }
+        document.getElementById('results-pi-queue').textContent = queueText;
+
         /* check on status (could be used to update progress checklist) */
         if (respStatus.state == states.processing) {
             document.getElementById('results-pi-processing').className = 'progress-processing';
             setTimeout(function() {
                 sendRequest(qsid);
-            } ,1000);
+            }, pollDelay);
         } else if (respStatus.state == states.training) {
             document.getElementById('results-pi-processing').className = 'progress-done';
             document.getElementById('results-pi-training').className = 'progress-processing';
-            setTimeout(function(){
+            setTimeout(function() {
                 sendRequest(qsid);
-            },1000);
+            }, pollDelay);
         } else if (respStatus.state == states.ranking) {
             document.getElementById('results-pi-processing').className = 'progress-done';
             document.getElementById('results-pi-training').className = 'progress-done';
             document.getElementById('results-pi-ranking').className = 'progress-processing';
-            setTimeout(function(){
+            setTimeout(function() {
                 sendRequest(qsid);
-            },1000);
+            }, pollDelay);
         } else if (respStatus.state == states.results_ready) {
+            queryFinished = true;
             /* finally, redirect to the results page */
             resultpagestr = fullHomeLocation + 'searchres?qsid=' + qsid
             /* use replace function so back button goes back two
@@ -90,7 +105,9 @@ function getProgress() {
         } else if ((respStatus.state == states.fatal_error_or_socket_timeout) ||
                    (respStatus.state == states.invalid_qid) ||
                    (respStatus.state == states.result_read_error) ||
+                   (respStatus.state == states.cancelled) ||
                    (respStatus.state == states.inactive)) {
+            queryFinished = true;
             // if there is an error, display an alert, then return home
             err_msg = ''
             if (respStatus.err_msg) {
@@ -109,6 +126,12 @@ function getProgress() {
 
 function sendRequest(qsid) {
     execstr = fullHomeLocation + 'execquery?qsid=' + qsid;
+    if (respStatus) {
+        /* send the last known status, so that the response is only sent when it changes */
+        var npaths = respStatus.postrainimg_paths.length + respStatus.curatedtrainimgs_paths.length;
+        execstr = execstr + '&wait=' + longPollWait + '&state=' + respStatus.state +
+                  '&npaths=' + npaths + '&qpos=' + respStatus.queue_position;
+    }
     /* if using IE, AJAX request are annoyingly cached, so add a random
      string to the end of the request to make it unique and prevent
      this */
@@ -121,3 +144,25 @@ function sendRequest(qsid) {
      * firefox */
     http.send(null);
 }
+
+/* cancel the query if the page is left before it is done, so that
+ * the backend does not keep working on it */
+function cancelQuery() {
+    if (queryFinished) {
+        return;
+    }
+    var qsid = document.getElementById('qpQsid').firstChild.nodeValue;
+    var cancelstr = fullHomeLocation + 'cancelquery';
+    if (navigator.sendBeacon) {
+        var data = new FormData();
+        data.append('qsid', qsid);
+        navigator.sendBeacon(cancelstr, data);
+    } else {
+        var cancelHttp = new XMLHttpRequest();
+        /* synchronous, as the page is being unloaded */
+        cancelHttp.open('post', cancelstr, false);
+        cancelHttp.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');
+        cancelHttp.send('qsid=' + encodeURIComponent(qsid));
+    }
+}
+window.addEventListener('pagehide', cancelQuery);
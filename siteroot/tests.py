@@ -1,3 +1,127 @@
-from django.test import TestCase
+import os
+import sys
+import random
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controllers'))
+from retengine.models import rank_list
+from retengine.managers.base_caches import max_size_cache, session_cache
+from retengine.models.rank_list import RankList
+
+
+class RankListTests(SimpleTestCase):
+    """ Tests of the compact container of ranking lists """
+
+    ITEMS = [{'path': 'a/b/', 'score': 1.0},
+             {'path': 'a/b/c.jpg', 'score': 0.5, 'roi': '1_2_3_2_3_4_1_4_1_2'},
+             {'path': 'x/'},
+             {'path': 'a/b/d.jpg', 'desc': 'caption'},
+             {'path': 'e.jpg', 'score': 0.25}]
+
+    def test_items_are_kept(self):
+        """ Paths ending in '/' share the string table with the folders of other paths """
+        self.assertEqual(list(RankList.from_items(self.ITEMS)), self.ITEMS)
+
+
+    def test_save_and_load(self):
+        """ A saved list reads back the same items, memory-mapped or not """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fname = os.path.join(tmp_dir, 'list.ranklist')
+            RankList.from_items(self.ITEMS).save(fname)
+            # map the file even if it is small
+            with mock.patch.object(rank_list, 'RANKLIST_MMAP_MIN_BYTES', 0):
+                for use_mmap in (True, False):
+                    rlist = RankList.load(fname, use_mmap=use_mmap)
+                    self.assertEqual(rlist._mmap is not None, use_mmap)
+                    self.assertEqual(list(rlist), self.ITEMS)
+
+
+def _run_threads(num_threads, num_ops, operation):
+    """
+        Runs an operation repeatedly in several threads at the same time.
+        Arguments:
+            num_threads: number of threads.
+            num_ops: number of operations of each thread.
+            operation: function performing one operation. It receives a random.Random instance.
+        Returns:
+            The list of exceptions raised by the threads.
+    """
+    failures = []
+
+    def worker(idx):
+        rand = random.Random(idx)
+        try:
+            for step in range(num_ops):
+                operation(rand)
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
+
+class BaseCachesConcurrencyTests(SimpleTestCase):
+    """ Stress tests of the base caches under concurrent access """
+
+    NUM_THREADS = 8
+    NUM_OPS = 5000
+    NUM_KEYS = 200
+
+    def test_max_size_cache(self):
+        """ The limits and the prefix index hold with concurrent reads, writes and deletes """
+        cache = max_size_cache.MaxSizeCache(entry_limit=self.NUM_KEYS // 2)
+        keys = [('qhash%d' % idx, 'text', 'engine%d' % (idx % 4)) for idx in range(self.NUM_KEYS)]
+
+        def operation(rand):
+            key = keys[rand.randrange(self.NUM_KEYS)]
+            choice = rand.random()
+            if choice < 0.7:
+                data = cache.get_data(key)
+                if data is not None and data != key[0]:
+                    raise AssertionError('wrong data for %s: %s' % (key, data))
+            elif choice < 0.95:
+                cache.add_data(key[0], key)
+            else:
+                cache.delete_data_partial_tuple(key[:1])
+
+        # avoid the messages printed on each eviction
+        with mock.patch('builtins.print'):
+            failures = _run_threads(self.NUM_THREADS, self.NUM_OPS, operation)
+        self.assertEqual(failures, [])
+        stats = cache.get_stats()
+        self.assertLessEqual(stats['entries'], self.NUM_KEYS // 2)
+        indexed = set()
+        for prefix_keys in cache._prefix_index.values():
+            indexed.update(prefix_keys)
+        self.assertEqual(indexed, set(cache._datastore))
+
+
+    def test_session_cache(self):
+        """ Sessions keep their own data with concurrent reads, writes and deletes """
+        cache = session_cache.SessionCache(session_lifetime=1200)
+        ses_ids = ['session%d' % idx for idx in range(self.NUM_KEYS)]
+
+        def operation(rand):
+            ses_id = ses_ids[rand.randrange(self.NUM_KEYS)]
+            choice = rand.random()
+            if choice < 0.7:
+                data = cache.get_data(ses_id, 'key')
+                if data is not None and data != ses_id:
+                    raise AssertionError('wrong data for %s: %s' % (ses_id, data))
+            elif choice < 0.95:
+                cache.add_data(ses_id, ses_id, 'key')
+            else:
+                cache.delete_session(ses_id)
+
+        self.assertEqual(_run_threads(self.NUM_THREADS, self.NUM_OPS, operation), [])
+        for (bucket, bucket_ses_ids) in cache._expiry_buckets.items():
+            for ses_id in bucket_ses_ids:
+                self.assertEqual(cache._sessions[ses_id].bucket, bucket)
@@ -36,6 +36,7 @@ urlpatterns = [
     url(r'^save_uber_classifier$', api_functions.save_uber_classifier, name='save_uber_classifier'),
     url(r'^is_backend_reachable', api_functions.get_backend_reachable, name='backendreachable'),
     url(r'^execquery$', api_functions.exec_query, name='exec_query'),
+    url(r'^cancelquery$', api_functions.cancel_query, name='cancel_query'),
     url(r'^uploadimage$', api_functions.upload_image, name='uploadimage'),
     url(r'^(?P<img_set>thumbnails|datasets|postrainimgs|curatedtrainimgs|uploadedimgs|regions)/(.*/)', api_functions.get_image, name='getimage'),
     url(r'^text_suggestions', api_functions.get_text_suggestions, name='text_suggestions'),
@@ -56,6 +56,16 @@ class AdminPages:
         for engine in cached_text_queries.keys():
             engines_names[engine] = self.visor_controller.opts.engines_dict[engine]['full_name']
 
+        cache_warmup_progress = {}
+        for engine, progress in self.visor_controller.interface.get_cache_warmup_progress().items():
+            cache_warmup_progress[self.visor_controller.opts.engines_dict[engine]['full_name']] = progress
+
+        query_metrics = self.visor_controller.interface.query_manager.get_metrics()
+        running_per_engine = {}
+        for engine, running in query_metrics['running_per_engine'].items():
+            running_per_engine[self.visor_controller.opts.engines_dict[engine]['full_name']] = running
+        query_metrics['running_per_engine'] = running_per_engine
+
         # compute home location taking account any possible redirections
         home_location = settings.SITE_PREFIX + '/'
         if 'HTTP_X_FORWARDED_HOST' in request.META:
@@ -90,6 +100,8 @@ class AdminPages:
         'ENGINES_NAMES': engines_names,
         'ENGINES_WITH_PIPELINE': engines_with_pipeline,
         'CACHED_TEXT_QUERIES' : cached_text_queries,
+        'CACHE_WARMUP_PROGRESS' : cache_warmup_progress,
+        'QUERY_METRICS' : query_metrics,
         'MAX_TOTAL_SIZE_UPLOAD_INDIVIDUAL_FILES': MAX_TOTAL_SIZE_UPLOAD_INDIVIDUAL_FILES,
         'MAX_NUMBER_UPLOAD_INDIVIDUAL_FILES': MAX_NUMBER_UPLOAD_INDIVIDUAL_FILES,
         'VALID_IMG_EXTENSIONS_STR': VALID_IMG_EXTENSIONS_STR
@@ -1,24 +1,79 @@
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, Http404, StreamingHttpResponse, FileResponse
 from django.shortcuts import redirect, render_to_response, render
 from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
 from django.contrib.auth.decorators import login_required
 
 import urllib.parse
 import os
 import sys
 import json
+import csv
 import threading
 import ast
 import tempfile
 import shutil
 import importlib
+import itertools
+import mimetypes
 
 import retengine.engine.backend_client
 from views import api_globals
 sys.path.append(os.path.join(os.path.dirname(__file__), '../../pipeline')) # add this to be able to load all data ingestion pipelines
 
+# maximum number of seconds a long-polling request to exec_query is held
+EXECQUERY_MAX_WAIT = 25
+# number of items whose ROIs are requested at once when saving results as a VIA CSV file
+VIA_CSV_BATCH_SIZE = 100
+# header of the CSV files for the VGG Image Annotator (VIA)
+VIA_CSV_HEADER = ['filename', 'file_size', 'file_attributes', 'region_count', 'region_id',
+                  'region_shape_attributes', 'region_attributes']
+
+
+class _LineBuffer(object):
+    """ File-like object for csv.writer, which returns each line instead of storing it """
+    def write(self, value):
+        return value
+
+
+def _as_number(value):
+    """
+        Converts a float to an integer if it has no decimals, so that
+        it is written as such to JSON.
+    """
+    if value.is_integer():
+        return int(value)
+    return value
+
+
+def _is_not_modified(request, etag, last_modified):
+    """
+        Checks the conditional headers of a GET request against the validators
+        of the requested resource. As in RFC 7232, If-Modified-Since is only
+        considered when If-None-Match is not present.
+        Arguments:
+            request: request object
+            etag: strong ETag of the resource, quoted
+            last_modified: modification time of the resource, in seconds since the epoch
+        Returns:
+            True if the copy of the resource of the client is still valid, False otherwise.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            return True
+        # weak comparison, as required for If-None-Match
+        client_etags = [item.strip() for item in if_none_match.split(',')]
+        client_etags = [item[2:] if item.startswith('W/') else item for item in client_etags]
+        return etag in client_etags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
 class APIFunctions:
     """
         This class provides general REST methods that complement the user/admin pages
@@ -81,10 +136,14 @@ class APIFunctions:
             See https://www.robots.ox.ac.uk/~vgg/software/via/
             Only GET requests are allowed.
             Arguments:
-               request: request object specifying the id of the query to be saved
+               request: request object specifying the id of the query to be saved. If
+                        'save_copy' is '1', the file is also saved in the static area
+                        of the site.
             Returns:
-               Redirects to a CSV file in the static area of the site
-               HTTP 400 if the query id is missing or something else goes wrong.
+               HTTP 200 streaming the CSV file as it is generated
+               HTTP 400 if the query id is missing or something else goes wrong before the
+               file starts to be sent. If the ROIs of a later batch of items cannot be
+               obtained, the file ends with an error line.
         """
         query_id = request.GET.get('qsid', None)
 
@@ -117,73 +176,136 @@ class APIFunctions:
             if page > page_count:
                 return HttpResponseBadRequest("Incorrect page specified")
 
-            for idx in idx_list:
-                int_idx = int(idx)
-                if 'roi' in rlist[int_idx]:
-                    # in this case the roi should come in string form x1_y1_x2_y1_x2_y2_x1_y2_x1_y1
-                    roi_as_list = rlist[int_idx]['roi'].split('_')
-                    rlist[int_idx]['rois'] = [ roi_as_list ]
-                elif self.visor_controller.opts.engines_dict[engine]['backend_port']:
-                    # check if we can retrieve ALL rois for the image
-                    backend_port = self.visor_controller.opts.engines_dict[engine]['backend_port']
-                    ses = retengine.engine.backend_client.Session(backend_port)
-                    func_in = {}
-                    func_in['func'] = 'getRoiList'
-                    func_in['frame_path'] = rlist[int_idx]['path']
-                    roi_request = json.dumps(func_in)
-                    response = ses.custom_request(roi_request)
-                    json_response = json.loads(response)
-                    if 'rois' in json_response and len(json_response['rois']) > 0:
-                        rlist[int_idx]['rois'] = json_response['rois']
-
-            # create file using query_id and only the items with indexes included in the idx_list
-            with open(os.path.join(os.path.dirname(__file__), '..', 'static', 'lists', '%s_%s.csv' % (query_id, page)), 'w') as fout:
-                fout.write('filename,file_size,file_attributes,region_count,region_id,region_shape_attributes,region_attributes\n')
-                for idx in idx_list:
-                    int_idx = int(idx)
-                    if 'rois' in rlist[int_idx]:
-                        num_rois = len(rlist[int_idx]['rois'])
-                        for idx in range(num_rois):
-                            fout.write(rlist[int_idx]['path'] + ',')
-                            fout.write('-1,')
-                            if 'desc' in rlist[int_idx] and rlist[int_idx]['desc'] not in rlist[int_idx]['path']:
-                                fout.write('"{""CAPTION"":""' + rlist[int_idx]['desc'] +'""}",')
-                            else:
-                                fout.write('{},')
-                            fout.write(str(num_rois) + ',')
-                            fout.write(str(idx) + ',')
-                            # ROI should be [x1, y1, x2, y1, x2, y2, x1, y2, x1, y1]
-                            x1 = rlist[int_idx]['rois'][idx][0]
-                            y1 = rlist[int_idx]['rois'][idx][1]
-                            width = float(rlist[int_idx]['rois'][idx][2]) - float(x1)
-                            height = float(rlist[int_idx]['rois'][idx][5]) - float(y1)
-                            fout.write('"{""name"":""rect"",""x"":'+ x1 + ',')
-                            fout.write('""y"":' + y1 + ',')
-                            fout.write('""width"":' + str(width) + ',')
-                            fout.write('""height"":' + str(height) + '}",')
-                            if len(rlist[int_idx]['rois'][idx])> 10:
-                                fout.write('"{""LABEL"":""' + rlist[int_idx]['rois'][idx][10] +'""}"\n')
-                            else:
-                                fout.write('{}\n')
-                    elif 'desc' in rlist[int_idx] and rlist[int_idx]['desc'] not in rlist[int_idx]['path']:
-                        fout.write(rlist[int_idx]['path'] + ',-1,')
-                        fout.write('"{""CAPTION"":""' + rlist[int_idx]['desc'] +'""}",')
-                        fout.write('0,0,{},{}\n')
-                    else:
-                        fout.write(rlist[int_idx]['path'] + ',-1,{},0,0,{},{}\n')
+            items = [rlist[int(idx)] for idx in idx_list]
+            backend_port = self.visor_controller.opts.engines_dict[engine]['backend_port']
 
-            # respond with a redirect
-            home_location = settings.SITE_PREFIX + '/'
-            if 'HTTP_X_FORWARDED_HOST' in request.META:
-                home_location = 'http://' + request.META['HTTP_X_FORWARDED_HOST'] + home_location
+            # optionally keep a copy of the file in the static area of the site
+            copy_path = None
+            if request.GET.get('save_copy', None) == '1':
+                copy_path = os.path.join(os.path.dirname(__file__), '..', 'static', 'lists', '%s_%s.csv' % (query_id, page))
 
-            return redirect(home_location + ('static/lists/%s_%s.csv' % (query_id, page)))
+            # stream the file as it is generated, so that the ROIs of the items are
+            # requested to the backend while the first lines are sent. The first batch
+            # is generated here, so that errors can still be reported as such
+            first_rows = self._get_via_csv_batch_rows(items[:VIA_CSV_BATCH_SIZE], backend_port)
+            rows = itertools.chain([VIA_CSV_HEADER], first_rows,
+                                   self._get_via_csv_rows(items[VIA_CSV_BATCH_SIZE:], backend_port))
+            response = StreamingHttpResponse(self._stream_csv(rows, copy_path), content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="%s_%s.csv"' % (query_id, page)
+            return response
 
         except Exception as e:
 
             return HttpResponseBadRequest(str(e))
 
 
+    def _get_via_csv_batch_rows(self, batch, backend_port):
+        """
+            Gets the rows of a CSV file for the VGG Image Annotator (VIA) version 2.0.10
+            for a batch of items, with one row per region of interest of each item, or a
+            single row for the items without ROIs. The ROIs not included in the items are
+            requested to the backend at once. All the rows of the batch are built before
+            returning, so that a bad ROI or backend reply never produces a partial batch.
+            Arguments:
+               batch: list of items of a ranking list
+               backend_port: port of the backend of the engine, or 'None'
+            Returns:
+               A list of lists of strings.
+               It raises an exception if the rows cannot be built.
+        """
+        # check if we can retrieve ALL rois for the images
+        roi_lists = {}
+        paths_without_roi = [item['path'] for item in batch if 'roi' not in item]
+        if backend_port and paths_without_roi:
+            ses = retengine.engine.backend_client.Session(backend_port)
+            roi_lists = ses.get_roi_lists(paths_without_roi)
+
+        rows = []
+        for item in batch:
+            if 'roi' in item:
+                # in this case the roi should come in string form x1_y1_x2_y1_x2_y2_x1_y2_x1_y1
+                rois = [ item['roi'].split('_') ]
+            else:
+                rois = roi_lists.get(item['path'], None)
+
+            file_attributes = {}
+            if 'desc' in item and item['desc'] not in item['path']:
+                file_attributes['CAPTION'] = item['desc']
+            file_attributes = json.dumps(file_attributes)
+
+            if not rois:
+                rows.append([item['path'], '-1', file_attributes, '0', '0', '{}', '{}'])
+                continue
+
+            for (roi_idx, roi) in enumerate(rois):
+                # ROI should be [x1, y1, x2, y1, x2, y2, x1, y2, x1, y1]
+                if len(roi) < 6:
+                    raise ValueError('Invalid region of interest for %s' % item['path'])
+                x1 = float(roi[0])
+                y1 = float(roi[1])
+                shape = json.dumps({'name': 'rect',
+                                    'x': _as_number(x1),
+                                    'y': _as_number(y1),
+                                    'width': float(roi[2]) - x1,
+                                    'height': float(roi[5]) - y1})
+                region_attributes = '{}'
+                if len(roi) > 10:
+                    region_attributes = json.dumps({'LABEL': roi[10]})
+                rows.append([item['path'], '-1', file_attributes, str(len(rois)), str(roi_idx),
+                             shape, region_attributes])
+        return rows
+
+
+    def _get_via_csv_rows(self, items, backend_port):
+        """
+            Generates the rows of a CSV file for the VGG Image Annotator (VIA) version 2.0.10,
+            in batches of VIA_CSV_BATCH_SIZE items (see _get_via_csv_batch_rows).
+            Arguments:
+               items: list of items of a ranking list
+               backend_port: port of the backend of the engine, or 'None'
+            Returns:
+               A generator of lists of strings, without the header of the file.
+        """
+        for start_idx in range(0, len(items), VIA_CSV_BATCH_SIZE):
+            for row in self._get_via_csv_batch_rows(items[start_idx:start_idx + VIA_CSV_BATCH_SIZE], backend_port):
+                yield row
+
+
+    def _stream_csv(self, rows, copy_path=None):
+        """
+            Formats rows as the lines of a CSV file, as they are generated.
+            As the response has already started, an error while generating the rows
+            is reported with a last line starting with '# ERROR', so that the file is
+            not mistaken for a complete one, and the copy of the file is deleted.
+            Arguments:
+               rows: iterable of lists of strings
+               copy_path: path of a file where the lines are also written, or 'None'
+            Returns:
+               A generator of the lines of the CSV file.
+        """
+        writer = csv.writer(_LineBuffer(), lineterminator='\n')
+        fout = None
+        complete = False
+        try:
+            if copy_path:
+                fout = open(copy_path, 'w', newline='')
+            try:
+                for row in rows:
+                    line = writer.writerow(row)
+                    if fout:
+                        fout.write(line)
+                    yield line
+                complete = True
+            except Exception as e:
+                print (e)
+                yield '# ERROR: the file is incomplete (%s)\n' % str(e).replace('\n', ' ')
+        finally:
+            if fout:
+                fout.close()
+                if not complete:
+                    os.remove(copy_path)
+
+
     @method_decorator(require_GET)
     def save_uber_classifier(self, request):
         """
@@ -248,6 +370,9 @@ class APIFunctions:
 
         self.visor_controller.interface.clear_cache(cache_type)
         self.visor_controller.query_key_cache.clear_all_sessions()
+        if cache_type in ['text', 'image', 'ranking_lists']:
+            # the ROIs of the results were cached along with them
+            self.visor_controller.roi_cache.clear_cache()
         return HttpResponse()
 
 
@@ -278,6 +403,10 @@ class APIFunctions:
         """
             Callback function for executing query.
             Only GET requests are allowed.
+            If the request also specifies the last status known by the client ('state',
+            'npaths' with the number of training images and 'qpos' with the position in
+            the queue) and a 'wait' time in seconds, the response is delayed until the
+            status changes or the wait time (at most EXECQUERY_MAX_WAIT) is over.
             Arguments:
                request: request object specifying the id of the query to be executed
             Returns:
@@ -287,7 +416,16 @@ class APIFunctions:
         if query_id == None:
             raise Http404("Query ID not specified. Query does not exist")
 
-        query_data = self.visor_controller.execquery_impl(query_id, request.session.session_key, False)
+        try:
+            wait = min(float(request.GET.get('wait', 0)), EXECQUERY_MAX_WAIT)
+            progress_key = (int(request.GET['state']), int(request.GET['npaths']), int(request.GET['qpos']))
+        except (KeyError, ValueError):
+            wait = 0
+        if wait > 0:
+            query_data = self.visor_controller.execquery_wait_impl(query_id, request.session.session_key,
+                                                                   progress_key, wait)
+        else:
+            query_data = self.visor_controller.execquery_impl(query_id, request.session.session_key, False)
 
         # transform system paths to browser-like paths before sending out the response
         for idx in range(len(query_data.status.postrainimg_paths)):
@@ -298,6 +436,31 @@ class APIFunctions:
         return HttpResponse(json.dumps(query_data.status.to_dict()))
 
 
+    @method_decorator(csrf_exempt)
+    @method_decorator(require_POST)
+    def cancel_query(self, request):
+        """
+            Cancels the execution of a query, e.g. when the user leaves the page
+            showing its progress, so that the backend does not keep working on it.
+            Only POST requests are allowed. This method is not CSRF protected, so
+            that it can be called with navigator.sendBeacon when the page is closed.
+            Arguments:
+               request: request object specifying the id of the query to be cancelled
+            Returns:
+               HTTP 200 containing a dictionary with the status of the query when it
+               was cancelled, HTTP 404 if the query does not exist.
+        """
+        query_id = request.POST.get('qsid', None)
+        if query_id == None:
+            raise Http404("Query ID not specified. Query does not exist")
+
+        status = self.visor_controller.cancel_query(query_id)
+        if status == None:
+            raise Http404("No query has been started for the specified query ID")
+
+        return HttpResponse(json.dumps(status.to_dict()))
+
+
     @method_decorator(require_GET)
     def get_backend_reachable(self, request):
         """
@@ -312,6 +475,52 @@ class APIFunctions:
         return HttpResponse(self.visor_controller.is_backend_reachable())
 
 
+    def _get_image_passthrough_response(self, real_path):
+        """
+            Builds a response sending an image file of the datasets as it is, without decoding
+            it, as configured in the 'passthrough' option of the IMAGE_SERVING settings.
+            With 'file', the file is streamed by Django (or by the server, if it supports
+            sendfile). With 'x-accel-redirect', the file is sent by nginx, from the internal
+            location given by the 'x_accel_redirect_prefix' option.
+            Only files inside the datasets folder (after resolving '..' and symbolic links)
+            and with an image extension are sent this way.
+            Arguments:
+               real_path: full path to the image file
+            Returns:
+               The response object, or 'None' if the image must be processed to be sent.
+            Raises:
+               Http404 if the file is outside the datasets folder.
+        """
+        passthrough = self.visor_controller.image_serving_opts.get('passthrough', None)
+        if not passthrough:
+            return None
+
+        datasets_path = os.path.realpath(settings.PATHS['datasets'])
+        resolved_path = os.path.realpath(real_path)
+        if os.path.commonpath([resolved_path, datasets_path]) != datasets_path:
+            raise Http404('Requested image does not exist')
+
+        # never send other kinds of files without checking they are images
+        content_type = mimetypes.guess_type(resolved_path)[0]
+        if not content_type or not content_type.startswith('image/'):
+            return None
+
+        if passthrough == 'x-accel-redirect':
+            relative_path = os.path.relpath(resolved_path, datasets_path)
+            prefix = self.visor_controller.image_serving_opts.get('x_accel_redirect_prefix', '/protected_datasets/')
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + urllib.parse.quote(relative_path)
+            return response
+
+        try:
+            response = FileResponse(open(resolved_path, 'rb'), content_type=content_type)
+            response['Content-Length'] = os.path.getsize(resolved_path)
+            return response
+        except (IOError, OSError) as e:
+            print (e)
+            return None
+
+
     @method_decorator(require_GET)
     def get_image(self, request, img_set):
         """
@@ -322,7 +531,8 @@ class APIFunctions:
             Arguments:
                request: request object specifying the relative path to the file in the site
             Returns:
-               HTTP 200 containing the image data, HTTP 404 is the image is not found
+               HTTP 200 containing the image data, HTTP 304 if the copy of the client is still valid,
+               HTTP 404 is the image is not found
         """
         url_path = request.get_full_path()
         roi_dict = None
@@ -386,13 +596,41 @@ class APIFunctions:
         if not os.path.exists(real_path):
             raise Http404('Requested image ' + url_path + ' does not exist')
 
-        img = self.visor_controller.get_image(real_path, roi_dict, as_thumbnail=(img_set == 'thumbnails'), just_ROI=(img_set == 'regions'))
+        as_thumbnail = (img_set == 'thumbnails')
+        just_ROI = (img_set == 'regions')
 
-        response = HttpResponse(content_type="image/*")
-        if not img.format:
-            img.save(response, "JPEG")
+        # check the validators of the image before reading it, so that the
+        # copies cached by the browser are not rendered again
+        etag, last_modified = self.visor_controller.get_image_validators(real_path, roi_dict,
+                                                                          as_thumbnail=as_thumbnail,
+                                                                          just_ROI=just_ROI)
+        if etag and _is_not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = None
+            # full-size dataset images without a ROI need no processing, so send the original file
+            if img_set == 'datasets' and not roi_dict:
+                response = self._get_image_passthrough_response(real_path)
+            if not response:
+                (img_data, img_ok) = self.visor_controller.get_encoded_image(real_path, roi_dict,
+                                                                             as_thumbnail=as_thumbnail,
+                                                                             just_ROI=just_ROI)
+                response = HttpResponse(img_data, content_type="image/*")
+                if not img_ok:
+                    # the image could not be read, so make sure the placeholder
+                    # sent instead is not kept by the browser
+                    patch_cache_control(response, no_store=True)
+                    return response
+
+        if etag:
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        max_age = self.visor_controller.image_serving_opts.get('http_max_age', {}).get(img_set, 0)
+        if max_age > 0:
+            patch_cache_control(response, max_age=max_age)
         else:
-            img.save(response, img.format)
+            # the browser can keep the image, but must check it is still valid
+            patch_cache_control(response, no_cache=True)
         return response
 
 
@@ -1037,6 +1275,9 @@ class APIFunctions:
             redirect_to = settings.SITE_PREFIX + '/admintools'
             return render_to_response("alert_and_redirect.html", context={'REDIRECT_TO': redirect_to, 'MESSAGE': message})
 
+        # the cached ROIs of the results come from the data that has just been cleared
+        self.visor_controller.roi_cache.clear_cache()
+
         message = 'The backend data has been cleared!.'
         redirect_to = settings.SITE_PREFIX + '/admintools'
         return render_to_response("alert_and_redirect.html", context={'REDIRECT_TO': redirect_to, 'MESSAGE': message})
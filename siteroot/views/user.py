@@ -14,8 +14,6 @@ import os
 import urllib.parse
 from PIL import Image
 import copy
-import requests
-import time
 import re
 
 # add 'controllers' to the path so that we can import stuff from it
@@ -24,7 +22,11 @@ sys.path.append(os.path.join(settings.BASE_DIR, 'siteroot', 'controllers'))
 # imports from the controller
 from retengine.engine import backend_client
 from retengine import query_translations
-from retengine.models import opts
+from retengine.models import opts, rank_list
+
+# maximum number of seconds a search waits for an identical query started by
+# another request, before redirecting to the 'wait for it' page
+IDENTICAL_QUERY_WAIT_TIMEOUT = 10
 
 class UserPages:
     """
@@ -320,26 +322,21 @@ class UserPages:
             #      to start the query immediately, but then it takes longer to switch to the searchproc page
             #query_ses_info = self.visor_controller.create_query_session(query, request.session.session_key)
 
-            # check whether the query is cached...
-            try:
-                # but use a lock to guarantee this thread's exclusive access
-                self.visor_controller.query_available_lock.acquire()
-                # check if query in cache
-
-                query_ses_info['cached'] = self.visor_controller.check_query_in_cache_no_locking(query, request.session.session_key)
-                if not query_ses_info['cached']:
-                    # if it is not cached, check the status of the query, in case another thread is running it
-                    status = self.visor_controller.interface.query_manager.get_query_status_from_definition(query)
-                    if status != None and status.state < opts.States.results_ready:
-                        # if another thread is running it and it is not done, redirect to the 'wait for it' page,
-                        # which will automatically redirect to this page to retry the search
-                        if query_string[0] == '#':
-                            query_string = query_string.replace('#', '%23') #  html-encode curated search character
-                            query_type = opts.Qtypes.text # every curated query is a text query
-                        return redirect(settings.SITE_PREFIX + '/waitforit?q=%s&qtype=%s&dsetname=%s&engine=%s' % (query_string, query_type, dataset_name, engine))
-            finally:
-                # release access
-                self.visor_controller.query_available_lock.release()
+            # check whether the query is cached. No lock is needed: concurrent
+            # starts of the same query are deduplicated by the query manager
+            query_ses_info['cached'] = self.visor_controller.check_query_in_cache_no_locking(query, request.session.session_key)
+            if not query_ses_info['cached']:
+                # if it is not cached, check the status of the query, in case another thread is running it.
+                # If so, wait for it for a while, instead of sending the user to the 'wait for it' page straight away
+                status = self.visor_controller.interface.query_manager.wait_for_query_from_definition(query,
+                                                                                                    timeout=IDENTICAL_QUERY_WAIT_TIMEOUT)
+                if status != None and status.state < opts.States.results_ready:
+                    # if the other thread is still running it, redirect to the 'wait for it' page,
+                    # which will automatically redirect to this page to retry the search
+                    if query_string[0] == '#':
+                        query_string = query_string.replace('#', '%23') #  html-encode curated search character
+                        query_type = opts.Qtypes.text # every curated query is a text query
+                    return redirect(settings.SITE_PREFIX + '/waitforit?q=%s&qtype=%s&dsetname=%s&engine=%s' % (query_string, query_type, dataset_name, engine))
 
             if query_ses_info['cached']:
                 # if cached then redirect to searchres immediately with the query_ses_id
@@ -357,35 +354,13 @@ class UserPages:
                     # skip the visual feedback and go directly to the results page. In any other case it is recommended
                     # to let the code in 'searchproc.html' run.
                     try:
-                        search_finished = False
-                        seconds_between_requests = 0.25 # Adjust to your needs, but if results are almost instant this should be ok.
-                        if 'HTTP_X_FORWARDED_HOST' not in request.META:
-                            host = request.META['HTTP_HOST']
-                            if host.startswith('127.0.0.1') or host.startswith('localhost') and (
-                               'SERVER_PORT' in request.META and request.META['SERVER_PORT'] not in host):
-                                host = host.split(':')[0]
-                                host = host + ':' + request.META['SERVER_PORT']
-                            home_location = 'http://' + host + home_location
-                        else:
-                            if 'SERVER_PORT' in request.META:
-                                home_location = 'http://127.0.0.1:' + request.META['SERVER_PORT'] + settings.SITE_PREFIX + '/'
-                            else:
-                                home_location = 'http://127.0.0.1:8000' + settings.SITE_PREFIX + '/'
-
-                        while not search_finished:
-                            # Start query or get query status
-                            result = requests.get(home_location + 'execquery?qsid=' + query_ses_info['query_ses_id'])
-                            response = result.json()
-                            # Check response
-                            if response['state'] >= opts.States.fatal_error_or_socket_timeout:
-                                # if something went wrong, get brutally out of the try
-                                raise Exception(response['err_msg'])
-                            if response['state'] < opts.States.results_ready:
-                                # if not ready, sleep a bit
-                                time.sleep(seconds_between_requests)
-                            else:
-                                # otherwise, get out of the try normally
-                                search_finished = True
+                        # wait for the query in this process. The results are collected later by searchres
+                        query_data = self.visor_controller.wait_for_query(query_ses_info['query_ses_id'],
+                                                                          request.session.session_key)
+                        # Check response
+                        if query_data.status.state >= opts.States.fatal_error_or_socket_timeout:
+                            # if something went wrong, get brutally out of the try
+                            raise Exception(query_data.status.err_msg)
                     except Exception as e:
                         # display error message and go back home
                         redirect_to = settings.SITE_PREFIX
@@ -591,10 +566,13 @@ class UserPages:
         # For the instances engine, if the query included a ROI, remove results without ROI
         query_string = query_translations.query_to_querystr(query)
         if 'roi' in query_string and engine == 'instances':
-            rlist = []
-            for ritem in query_data.rlist:
-                if 'roi' in ritem:
-                    rlist.append(ritem)
+            if isinstance(query_data.rlist, rank_list.RankList):
+                rlist = query_data.rlist.subset_with_roi()
+            else:
+                rlist = []
+                for ritem in query_data.rlist:
+                    if 'roi' in ritem:
+                        rlist.append(ritem)
         else:
             rlist = query_data.rlist
 
@@ -630,8 +608,15 @@ class UserPages:
 
         # set paths of image thumbnails
         sa_thumbs = 'thumbnails/%s/' % query['dsetname']
+        backend_rois = {}
         if rois:
             sa_thumbs = 'regions/%s/' % query['dsetname']
+            if self.visor_controller.opts.engines_dict[engine]['backend_port']:
+                # If the ROI of some items was not specified, do a final attempt to
+                # retrieve them from the backend, all at once
+                paths_without_roi = [ritem['path'] for ritem in rlist if 'roi' not in ritem]
+                if paths_without_roi:
+                    backend_rois = self.visor_controller.get_rois(query, engine, paths_without_roi)
 
         # prepare the details of every item in the list, for rendering the page
         for ritem in rlist:
@@ -652,24 +637,11 @@ class UserPages:
             if 'roi' in ritem:
                 thumbnailroi = ',roi:' + ritem['roi']
                 ritem['thumbnailroi'] = thumbnailroi
-            elif rois and self.visor_controller.opts.engines_dict[engine]['backend_port']:
-                # If the ROI was not specified, do a final attempt to retrieve it
-                # from the backend
-                query = self.visor_controller.query_key_cache.get_query_details(query_id)
-                backend_port = self.visor_controller.opts.engines_dict[engine]['backend_port']
-                ses = backend_client.Session(backend_port)
-                func_in = {}
-                func_in['func'] = 'getRoi'
-                func_in['frame_path'] = ritem['path']
-                func_in['query_string'] = query['qdef']
-                roi_request = json.dumps(func_in)
-                roi_response = ses.custom_request(roi_request)
-                json_response = json.loads(roi_response)
-                if 'roi' in json_response and len(json_response['roi']) > 0:
-                    roi = json_response['roi']
-                    if isinstance(roi, list):
-                        roi = '_'.join(roi[:10]) # string roi should be x1_y1_x2_y1_x2_y2_x1_y2_x1_y1
-                    ritem['thumbnailroi'] = ',roi:' + roi
+            elif ritem['path'] in backend_rois:
+                roi = backend_rois[ritem['path']]
+                if isinstance(roi, list):
+                    roi = '_'.join(roi[:10]) # string roi should be x1_y1_x2_y1_x2_y2_x1_y2_x1_y1
+                ritem['thumbnailroi'] = ',roi:' + roi
 
         # compute home location taking into account any possible redirections
         home_location = settings.SITE_PREFIX + '/'
@@ -845,10 +817,13 @@ class UserPages:
         # For the instances engine, if the query included a ROI, remove results without ROI
         query_string = query_translations.query_to_querystr(query)
         if 'roi' in query_string and engine == 'instances':
-            rlist = []
-            for ritem in query_data.rlist:
-                if 'roi' in ritem:
-                    rlist.append(ritem)
+            if isinstance(query_data.rlist, rank_list.RankList):
+                rlist = query_data.rlist.subset_with_roi()
+            else:
+                rlist = []
+                for ritem in query_data.rlist:
+                    if 'roi' in ritem:
+                        rlist.append(ritem)
         else:
             rlist = query_data.rlist
 
@@ -966,17 +941,10 @@ class UserPages:
             # from the backend
             query = self.visor_controller.query_key_cache.get_query_details(query_id)
             if query:
-                backend_port = self.visor_controller.opts.engines_dict[engine]['backend_port']
-                ses = backend_client.Session(backend_port)
-                func_in = {}
-                func_in['func'] = 'getRoi'
-                func_in['frame_path'] = imagename
-                func_in['query_string'] = query['qdef']
-                request = json.dumps(func_in)
-                response = ses.custom_request(request)
-                json_response = json.loads(response)
-                if 'roi' in json_response and  len(json_response['roi']) > 0:
-                    roi = json_response['roi']
+                # the ROI is probably cached, if the results were shown in the ROI grid
+                backend_rois = self.visor_controller.get_rois(query, engine, [imagename])
+                if imagename in backend_rois:
+                    roi = backend_rois[imagename]
 
         all_rois = None
         if self.visor_controller.opts.engines_dict[engine]['backend_port']:
@@ -221,6 +221,8 @@ VISOR = {
                                   'skip_query_progress': False,
                                   'engine_for_similar_search': 'cpuvisor-srv',
                                   'improc_timeout': 10,
+                                  'featcomp_workers': 4, # max. number of concurrent feature computations in the backend
+                                  'max_running_queries': 4, # max. number of queries of this engine running at the same time
                                   'data_manager_module': 'data_pipeline_cpuvisor'
                                 },
 
@@ -302,6 +304,18 @@ RETENGINE = {
     'rf_rank_type' : 'full',
     'rf_rank_topn' : 2000,
     'rf_train_type' : 'regular',
+    'backend_pool_size' : 8, # max. number of simultaneous connections to each backend
+    'mem_cache_max_bytes' : 256*1024*1024, # approx. max. size of the in-memory results cache of each engine
+    'shared_cache_dir' : None, # set to a folder (e.g. in /dev/shm) to share the caches of results and query
+                               # sessions between the processes of a multi-process deployment (e.g. uWSGI)
+    'ranklist_codec' : None, # set to 'zlib', 'lzma' or 'bz2' to compress the ranking lists saved to disk. Compressed
+                             # lists take less space but cannot be memory-mapped, so they are slower to load
+    'cache_warmup_lists' : 100, # number of most used ranking lists of each engine loaded in memory on startup
+    'cache_warmup_max_bytes' : 128*1024*1024, # approx. max. size of the lists loaded on startup, per engine
+    'worker_idle_timeout' : 300, # seconds without status requests after which a query is cancelled and its
+                                 # backend query ID released
+    'max_running_queries' : None, # max. number of queries running at the same time. None uses all pool_workers but one
+    'query_priorities' : { 'dsetimage': 0, 'refine': 0, 'curated': 1, 'image': 1, 'text': 2 }, # lower values run first
 
 }
 
@@ -316,6 +330,18 @@ IMSEARCHTOOLS = {
     'num_pos_train' : 20,
 }
 
+# Settings for serving the images of the site
+IMAGE_SERVING = {
+    'thumbnail_cache_dir' : os.path.join( BASE_FRONTEND_DATA_DIR, 'searchdata', 'thumbnails_cache'), # folder of the cache of
+                                                # thumbnails, regions and images with a ROI. None disables the cache
+    'thumbnail_cache_max_bytes' : 512*1024*1024, # approx. max. size of the cache of thumbnails
+    'http_max_age' : { 'thumbnails': 86400, 'regions': 86400, 'datasets': 3600 }, # seconds the browser can keep the images of
+                                                # each image set without checking them. Sets not listed are always checked
+    'passthrough' : 'file', # how to send full-size dataset images without a ROI, without decoding them: 'file' streams
+                            # the file, 'x-accel-redirect' lets nginx send it, None decodes and re-encodes the image
+    'x_accel_redirect_prefix' : '/protected_datasets/', # 'internal' nginx location aliased to PATHS['datasets']
+}
+
 # Base folder of scripts to manage the service
 MANAGE_SERVICE_SCRIPTS_BASE_PATH = os.path.join(BASE_DIR, 'scripts')
 